@@ -0,0 +1,230 @@
+"""
+Content-addressed store for firmware images, with a name-to-hash catalog.
+
+Every image is split into fixed 64 KB chunks stored once by SHA-256, so the
+bootloader, partition table and boot_app0 that every product variant ships
+are kept a single time, as are the unchanged leading chunks of app builds.
+An image is identified by the SHA-256 of its contents; names (usually the
+path below BIN_DIR) point at a hash in the catalog. Files are only rehashed
+when their size or mtime changed.
+
+    python artifact_store.py add bin/*.bin
+    python artifact_store.py list
+    python artifact_store.py export Blink.ino.bin /tmp/Blink.ino.bin
+    python artifact_store.py prune
+
+Rebuilding an image points its name at the new contents; prune() then drops
+the contents no name points at any more, and the chunks only they used.
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+CHUNK_SIZE = 0x10000
+PRUNE_GRACE = 3600  # Seconds an image or chunk file is kept even if unreferenced, in case it is being added
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS artifacts (
+    sha256 TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    chunks TEXT NOT NULL,
+    added_at REAL NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS names (
+    name TEXT PRIMARY KEY,
+    sha256 TEXT NOT NULL REFERENCES artifacts(sha256),
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    sha256 TEXT NOT NULL
+);
+"""
+
+
+class ArtifactStore:
+    """Chunked, deduplicated image storage plus the catalog of names."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.chunk_dir = os.path.join(directory, 'chunks')
+        os.makedirs(self.chunk_dir, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, 'catalog.sqlite'), check_same_thread=False)
+        self._db.executescript(SCHEMA)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(artifacts)")]
+        if 'added_at' not in columns:
+            # Catalogs from before the grace period for images
+            self._db.execute("ALTER TABLE artifacts ADD COLUMN added_at REAL NOT NULL DEFAULT 0")
+        self._db.commit()
+
+    def _chunk_path(self, digest):
+        return os.path.join(self.chunk_dir, digest[:2], digest)
+
+    def _put_chunk(self, data):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def _known_hash(self, path, st):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT sha256 FROM files WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, st.st_size, st.st_mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def add(self, path, name=None):
+        """
+        Store a file and point name (its base name by default) at it. Returns its SHA-256.
+
+        A file whose size and mtime are unchanged since it was last added is
+        not read again.
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        digest = self._known_hash(path, st)
+        if digest is None:
+            with open(path, 'rb') as f:
+                data = f.read()
+            digest = self.put(data)
+            with self._lock, self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO files (path, size, mtime_ns, sha256) VALUES (?, ?, ?, ?)",
+                    (path, st.st_size, st.st_mtime_ns, digest),
+                )
+        self.name(name or os.path.basename(path), digest)
+        return digest
+
+    def put(self, data):
+        """Store image contents. Returns their SHA-256."""
+        digest = hashlib.sha256(data).hexdigest()
+        if self.size(digest) is not None:
+            return digest
+        chunks = [self._put_chunk(data[pos:pos + CHUNK_SIZE]) for pos in range(0, len(data), CHUNK_SIZE)]
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR IGNORE INTO artifacts (sha256, size, chunks, added_at) VALUES (?, ?, ?, ?)",
+                (digest, len(data), ','.join(chunks), time.time()),
+            )
+        return digest
+
+    def name(self, name, digest):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO names (name, sha256, updated_at) VALUES (?, ?, ?)",
+                (name, digest, time.time()),
+            )
+
+    def resolve(self, name):
+        """The SHA-256 a name points at, or None."""
+        with self._lock:
+            row = self._db.execute("SELECT sha256 FROM names WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else None
+
+    def size(self, digest):
+        with self._lock:
+            row = self._db.execute("SELECT size FROM artifacts WHERE sha256 = ?", (digest,)).fetchone()
+        return row[0] if row else None
+
+    def read(self, digest):
+        """Reassemble an image from its chunks."""
+        with self._lock:
+            row = self._db.execute("SELECT chunks FROM artifacts WHERE sha256 = ?", (digest,)).fetchone()
+        if row is None:
+            raise KeyError(digest)
+        parts = []
+        for chunk in row[0].split(',') if row[0] else []:
+            with open(self._chunk_path(chunk), 'rb') as f:
+                parts.append(f.read())
+        return b''.join(parts)
+
+    def names(self):
+        """(name, sha256, size) of every catalog entry."""
+        with self._lock:
+            return self._db.execute(
+                "SELECT names.name, names.sha256, artifacts.size FROM names "
+                "JOIN artifacts ON artifacts.sha256 = names.sha256 ORDER BY names.name"
+            ).fetchall()
+
+    def prune(self):
+        """
+        Drop images no name points at and chunks no image uses. Returns (images, chunks) removed.
+
+        Images and chunk files younger than PRUNE_GRACE are kept, since
+        put() and name() are separate steps for an image being added.
+        """
+        cutoff = time.time() - PRUNE_GRACE
+        with self._lock, self._db:
+            images = self._db.execute(
+                "DELETE FROM artifacts WHERE sha256 NOT IN (SELECT sha256 FROM names) AND added_at <= ?", (cutoff,)
+            ).rowcount
+            self._db.execute("DELETE FROM files WHERE sha256 NOT IN (SELECT sha256 FROM artifacts)")
+            used = set()
+            for (chunks,) in self._db.execute("SELECT chunks FROM artifacts"):
+                used.update(chunks.split(',') if chunks else [])
+        chunks = 0
+        for entry in os.scandir(self.chunk_dir):
+            if not entry.is_dir():
+                continue
+            for chunk in os.scandir(entry.path):
+                if chunk.name in used or chunk.stat().st_mtime > cutoff:
+                    continue
+                try:
+                    os.remove(chunk.path)
+                    chunks += 1
+                except FileNotFoundError:
+                    pass
+        return images, chunks
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the firmware artifact store.")
+    parser.add_argument('--store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'state', 'artifacts'))
+    commands = parser.add_subparsers(dest='command', required=True)
+    add = commands.add_parser('add', help="Store files, named by their base name or --prefix + base name")
+    add.add_argument('paths', nargs='+')
+    add.add_argument('--prefix', default='')
+    commands.add_parser('list', help="Show the catalog")
+    export = commands.add_parser('export', help="Write a stored image to a file")
+    export.add_argument('name')
+    export.add_argument('path')
+    commands.add_parser('prune', help="Drop images no name points at and their chunks")
+    args = parser.parse_args()
+
+    store = ArtifactStore(args.store)
+    if args.command == 'add':
+        for path in args.paths:
+            name = args.prefix + os.path.basename(path)
+            print(f"{store.add(path, name)}  {name}")
+    elif args.command == 'list':
+        for name, digest, size in store.names():
+            print(f"{digest}  {size:>9}  {name}")
+    elif args.command == 'export':
+        digest = store.resolve(args.name)
+        if digest is None:
+            parser.error(f"{args.name} is not in the catalog")
+        with open(args.path, 'wb') as f:
+            f.write(store.read(digest))
+    elif args.command == 'prune':
+        images, chunks = store.prune()
+        print(f"Removed {images} images and {chunks} chunks.")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,653 @@
+"""
+Flash engine that drives many ports from one asyncio event loop.
+
+FlashJob runs esptool's blocking calls on a thread per port, which is fine
+for a handful of boards but costs a thread, its stack and a compression
+pipeline thread per port on a 48-port station. Here every port is a file
+descriptor registered with the event loop: a reader callback decodes SLIP
+frames as bytes arrive, writes go out without blocking, and each command
+waits on its response with a deadline. Images are hashed and compressed by
+ImagePreparer's fixed thread pool, so the thread count stays the same
+however many ports are added.
+
+The protocol is esptool's: the same commands, reset sequences, flasher stub
+and chip definitions, with esptool's own classes used for their constants.
+What is left out is what FlashJob adds around the write (journal, caches,
+personalization, eFuse snapshot, retries down the baud ladder); a failed
+port fails its job and the others carry on.
+
+The event loop needs POSIX file descriptors, so this is for Linux and macOS
+station PCs. Boards on USB-OTG (ESP32-S2/S3 native USB without the
+USB-Serial/JTAG peripheral) re-enumerate on reset and still go through
+FlashJob.
+
+    python async_engine.py /dev/ttyUSB0 /dev/ttyUSB1 ... --image 0x0 bootloader.bin --image 0x8000 partitions.bin \\
+        --image 0xe000 boot_app0.bin --image 0x10000 app.bin --baud 921600
+
+benchmarks/bench_async_scaling.py compares it with a thread per port on
+simulated boards.
+"""
+import argparse
+import asyncio
+import hashlib
+import os
+import struct
+import sys
+import threading
+import time
+
+import serial
+from esp_pylib.serial_reset import DEFAULT_RESET_DELAY, PIN_HIGH, PIN_LOW, set_dtr, set_rts
+from esptool.cmds import ADESTO_VENDOR_ID, DETECTED_FLASH_SIZES, DETECTED_FLASH_SIZES_ADESTO
+from esptool.loader import (DEFAULT_TIMEOUT, MEM_END_ROM_TIMEOUT, SYNC_TIMEOUT, ESPLoader, StubFlasher,
+                            timeout_per_mb)
+from esptool.targets import CHIP_DEFS, ROM_LIST
+from esptool.util import FatalError, flash_size_bytes
+
+import flash_engine
+from boot_check import native_usb
+
+ESP_CMDS = ESPLoader.ESP_CMDS
+SYNC_DATA = b"\x07\x07\x12\x20" + 32 * b"\x55"
+CONNECT_ATTEMPTS = 7
+SYNC_ATTEMPTS = 5  # Per reset, as esptool does
+RESPONSE_TRIES = 100  # Packets skipped while looking for a command's response
+READ_SIZE = 64 * 1024
+MD5_TIMEOUT_PER_MB = 8
+BAUD_SETTLE = 0.05  # Seconds of garbage after a baud rate change, dropped
+
+# SPI peripheral bits for a user command, as in esptool's run_spiflash_command()
+SPIFLASH_RDID = 0x9F
+SPI_USR_COMMAND = 1 << 31
+SPI_USR_MISO = 1 << 28
+SPI_CMD_USR = 1 << 18
+SPI_USR2_COMMAND_LEN_SHIFT = 28
+SPI_MISO_BITLEN_SHIFT = 8  # In SPI_USER1 on chips without separate data length registers
+
+
+def checksum(data):
+    """ESPLoader.checksum, folding the bytes with big-int XORs instead of a Python loop."""
+    value = int.from_bytes(data, 'little')
+    size = len(data)
+    while size > 1:
+        half = (size + 1) // 2
+        value = (value & ((1 << (half * 8)) - 1)) ^ (value >> (half * 8))
+        size = half
+    return value ^ ESPLoader.ESP_CHECKSUM_MAGIC
+
+
+class AsyncPort:
+    """A serial port whose SLIP packets are read and written on the event loop, without a thread."""
+
+    def __init__(self, port, baud=ESPLoader.ESP_ROM_BAUD):
+        self.port = port
+        self.baud = baud
+        self._serial = None
+        self._fd = None
+        self._loop = None
+        self._packets = asyncio.Queue()
+        self._buffer = bytearray()
+        self._in_frame = False
+
+    def open(self):
+        self._loop = asyncio.get_running_loop()
+        port = serial.Serial()
+        port.port = self.port
+        port.baudrate = self.baud
+        port.dtr = False
+        port.rts = False
+        port.open()
+        if not hasattr(port, 'fileno'):
+            port.close()
+            raise FatalError(f"{self.port} has no file descriptor for the event loop; use FlashJob on this OS.")
+        self._serial = port
+        self._fd = port.fileno()
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+        return self
+
+    def _on_readable(self):
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._fail(e)
+            return
+        if not data:
+            self._fail(FatalError(f"{self.port} was closed by the device."))
+            return
+        self._feed(data)
+
+    def _fail(self, error):
+        self._loop.remove_reader(self._fd)
+        self._packets.put_nowait(error)
+
+    def _feed(self, data):
+        """Split SLIP frames out of the byte stream; anything outside frames (boot log) is dropped."""
+        buffer = self._buffer
+        buffer += data
+        while True:
+            if not self._in_frame:
+                start = buffer.find(0xC0)
+                if start < 0:
+                    buffer.clear()
+                    return
+                del buffer[:start + 1]
+                self._in_frame = True
+            end = buffer.find(0xC0)
+            if end < 0:
+                return
+            frame = bytes(buffer[:end])
+            del buffer[:end + 1]
+            if frame:
+                self._in_frame = False
+                self._packets.put_nowait(frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb'))
+
+    async def write(self, packet):
+        frame = b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+        view = memoryview(frame)
+        while view:
+            try:
+                view = view[os.write(self._fd, view):]
+            except BlockingIOError:
+                pass
+            if view:
+                writable = self._loop.create_future()
+                self._loop.add_writer(self._fd, writable.set_result, None)
+                try:
+                    await writable
+                finally:
+                    self._loop.remove_writer(self._fd)
+
+    async def read(self, timeout):
+        """The next SLIP packet, or FatalError after timeout seconds."""
+        try:
+            packet = await asyncio.wait_for(self._packets.get(), timeout)
+        except asyncio.TimeoutError:
+            raise FatalError("Timed out waiting for packet header")
+        if isinstance(packet, Exception):
+            raise FatalError(f"Serial error on {self.port}: {packet}")
+        return packet
+
+    def flush_input(self):
+        self._serial.reset_input_buffer()
+        self._buffer.clear()
+        self._in_frame = False
+        while not self._packets.empty():
+            self._packets.get_nowait()
+
+    def set_baud(self, baud):
+        self._serial.baudrate = baud
+        self.baud = baud
+
+    def set_lines(self, dtr=None, rts=None):
+        if dtr is not None:
+            set_dtr(self._serial, dtr)
+        if rts is not None:
+            set_rts(self._serial, rts)
+
+    @property
+    def is_open(self):
+        return self._serial is not None
+
+    def close(self):
+        if self._serial is None:
+            return
+        self._loop.remove_reader(self._fd)
+        self._loop.remove_writer(self._fd)
+        self._serial.close()
+        self._serial = None
+
+
+class AsyncLoader:
+    """esptool's serial protocol over an AsyncPort: ROM loader first, flasher stub after run_stub()."""
+
+    def __init__(self, port, log=print):
+        self.port = port
+        self.log = log
+        self.rom = None  # esptool ROM class of the detected chip
+        self.is_stub = False
+
+    async def command(self, op, data=b'', chk=0, timeout=DEFAULT_TIMEOUT):
+        await self.port.write(struct.pack('<BBHI', 0x00, op, len(data), chk) + data)
+        deadline = time.monotonic() + timeout
+        for _ in range(RESPONSE_TRIES):
+            packet = await self.port.read(max(deadline - time.monotonic(), 0))
+            if len(packet) < 8:
+                continue
+            resp, op_ret, _, value = struct.unpack('<BBHI', packet[:8])
+            body = packet[8:]
+            if resp != 1:
+                continue
+            if op_ret == op:
+                return value, body
+            if len(body) > 1 and body[0] != 0 and body[1] == ESPLoader.ROM_INVALID_RECV_MSG:
+                await asyncio.sleep(0.2)  # The ROM repeats the complaint a few times
+                self.port.flush_input()
+                raise FatalError(f"Command {op:#04x} is not supported by this loader.")
+        raise FatalError("Response doesn't match request.")
+
+    async def check_command(self, description, op, data=b'', chk=0, resp_data_len=0, timeout=DEFAULT_TIMEOUT):
+        value, body = await self.command(op, data, chk, timeout)
+        if len(body) < resp_data_len + 2:
+            if body[:1] not in (b'', b'\x00'):
+                raise FatalError.WithResult(f"Failed to {description}", body[:2])
+            raise FatalError(f"Failed to {description}. Only got {len(body)} byte status response.")
+        status = body[resp_data_len:resp_data_len + 2]
+        if status[0] != 0:
+            raise FatalError.WithResult(f"Failed to {description}", status)
+        return body[:resp_data_len] if resp_data_len else value
+
+    async def reset_to_bootloader(self, usb_jtag):
+        """esptool's classic (or USB-Serial/JTAG) bootloader reset, with awaits instead of sleeps."""
+        if usb_jtag:
+            self.port.set_lines(rts=PIN_HIGH, dtr=PIN_HIGH)
+            await asyncio.sleep(0.1)
+            self.port.set_lines(dtr=PIN_LOW, rts=PIN_HIGH)
+            await asyncio.sleep(0.1)
+            self.port.set_lines(rts=PIN_LOW)
+            self.port.set_lines(dtr=PIN_HIGH, rts=PIN_LOW)
+            await asyncio.sleep(0.1)
+            self.port.set_lines(dtr=PIN_HIGH, rts=PIN_HIGH)
+        else:
+            self.port.set_lines(dtr=PIN_HIGH, rts=PIN_LOW)
+            await asyncio.sleep(0.1)
+            self.port.set_lines(dtr=PIN_LOW, rts=PIN_HIGH)
+            await asyncio.sleep(DEFAULT_RESET_DELAY)
+            self.port.set_lines(dtr=PIN_HIGH)
+
+    async def hard_reset(self, usb_jtag):
+        self.port.set_lines(rts=PIN_LOW)
+        await asyncio.sleep(0.2 if usb_jtag else 0.1)
+        self.port.set_lines(rts=PIN_HIGH)
+
+    async def sync(self):
+        value, _ = await self.command(ESP_CMDS['SYNC'], SYNC_DATA, timeout=SYNC_TIMEOUT)
+        # The ROM answers a SYNC eight times, with a non-zero value; a stub left running answers with 0
+        stub_detected = value == 0
+        for _ in range(7):
+            packet = await self.port.read(DEFAULT_TIMEOUT)
+            stub_detected &= packet[4:8] == bytes(4)
+        self.is_stub = stub_detected
+
+    async def connect(self, mode='default-reset', usb_jtag=False, attempts=CONNECT_ATTEMPTS):
+        last_error = None
+        for _ in range(attempts):
+            if mode != 'no-reset':
+                self.port.flush_input()
+                await self.reset_to_bootloader(usb_jtag or mode == 'usb-reset')
+            for _ in range(SYNC_ATTEMPTS):
+                try:
+                    self.port.flush_input()
+                    await self.sync()
+                    return
+                except FatalError as e:
+                    last_error = e
+                    await asyncio.sleep(0.05)
+        raise FatalError(f"Failed to connect to {self.port.port}: {last_error}")
+
+    async def read_reg(self, address):
+        return await self.check_command("read target memory", ESP_CMDS['READ_REG'], struct.pack('<I', address))
+
+    async def write_reg(self, address, value, mask=0xFFFFFFFF, delay_us=0):
+        await self.check_command("write target memory", ESP_CMDS['WRITE_REG'],
+                                 struct.pack('<IIII', address, value, mask, delay_us))
+
+    async def read_spiflash(self, command, read_bits):
+        """
+        Run a SPI flash command that only reads, up to 32 bits.
+
+        esptool's run_spiflash_command() without data, address or dummy
+        cycles: the SPI peripheral's user command registers are set up
+        for the command and restored afterwards.
+        """
+        rom = self.rom
+        base = rom.SPI_REG_BASE
+        cmd_reg, usr_reg = base, base + rom.SPI_USR_OFFS
+        usr1_reg, usr2_reg, w0_reg = base + rom.SPI_USR1_OFFS, base + rom.SPI_USR2_OFFS, base + rom.SPI_W0_OFFS
+        old_usr = await self.read_reg(usr_reg)
+        old_usr2 = await self.read_reg(usr2_reg)
+        if rom.SPI_MOSI_DLEN_OFFS is not None:
+            await self.write_reg(base + rom.SPI_MISO_DLEN_OFFS, read_bits - 1)
+        else:
+            await self.write_reg(usr1_reg, (read_bits - 1) << SPI_MISO_BITLEN_SHIFT)
+        await self.write_reg(usr_reg, SPI_USR_COMMAND | SPI_USR_MISO)
+        await self.write_reg(usr2_reg, (7 << SPI_USR2_COMMAND_LEN_SHIFT) | command)
+        await self.write_reg(w0_reg, 0)
+        await self.write_reg(cmd_reg, SPI_CMD_USR)
+        for _ in range(10):
+            if not await self.read_reg(cmd_reg) & SPI_CMD_USR:
+                break
+        else:
+            raise FatalError("SPI command did not complete in time")
+        value = await self.read_reg(w0_reg)
+        await self.write_reg(usr_reg, old_usr)
+        await self.write_reg(usr2_reg, old_usr2)
+        return value
+
+    async def detect_flash_size(self):
+        """The flash size in bytes from the chip's JEDEC ID, as esptool detects it, or None if unknown."""
+        flash_id = await self.read_spiflash(SPIFLASH_RDID, 24)
+        if flash_id & 0xFF == ADESTO_VENDOR_ID:
+            size = DETECTED_FLASH_SIZES_ADESTO.get((flash_id >> 8) & 0x1F)
+        else:
+            size = DETECTED_FLASH_SIZES.get(flash_id >> 16)
+        return flash_size_bytes(size) if size else None
+
+    async def flash_set_parameters(self, size):
+        """Tell the stub the flash size, as FlashJob.connect() does through esptool."""
+        await self.check_command("set SPI params", ESP_CMDS['SPI_SET_PARAMS'],
+                                 struct.pack('<IIIIII', 0, size, 64 * 1024, 4 * 1024, 256, 0xFFFF))
+
+    async def detect_chip(self):
+        """The ROM class of the connected chip: by chip ID where the ROM reports one, else by magic value."""
+        try:
+            info = await self.check_command("get security info", ESP_CMDS['GET_SECURITY_INFO'], resp_data_len=20)
+            chip_id = struct.unpack('<IBBBBBBBBII', info)[9]
+            for cls in ROM_LIST:
+                if not cls.USES_MAGIC_VALUE and cls.IMAGE_CHIP_ID == chip_id:
+                    self.rom = cls
+                    return cls
+            raise FatalError(f"Unexpected chip ID value {chip_id}.")
+        except FatalError:
+            if self.rom is not None:
+                raise
+        magic = await self.read_reg(ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR)
+        for cls in ROM_LIST:
+            if cls.USES_MAGIC_VALUE and cls.MAGIC_VALUE == magic:
+                self.rom = cls
+                return cls
+        raise FatalError(f"Unexpected chip magic value {magic:#010x}.")
+
+    async def run_stub(self):
+        if self.is_stub:
+            self.log("Stub flasher is already running. No upload is necessary.")
+            return
+        stub = StubFlasher(self.rom)
+        for data, address in [(stub.text, stub.text_start), (stub.data, stub.data_start)]:
+            if data is None:
+                continue
+            block_size = self.rom.ESP_RAM_BLOCK
+            blocks = (len(data) + block_size - 1) // block_size
+            await self.check_command("enter RAM download mode", ESP_CMDS['MEM_BEGIN'],
+                                     struct.pack('<IIII', len(data), blocks, block_size, address))
+            for seq in range(blocks):
+                block = bytes(data[seq * block_size:(seq + 1) * block_size])
+                await self.check_command("write to target RAM", ESP_CMDS['MEM_DATA'],
+                                         struct.pack('<IIII', len(block), seq, 0, 0) + block, checksum(block))
+        try:
+            await self.check_command("leave RAM download mode", ESP_CMDS['MEM_END'],
+                                     struct.pack('<II', int(stub.entry == 0), stub.entry), timeout=MEM_END_ROM_TIMEOUT)
+        except FatalError:
+            pass  # The ROM may be gone before its answer is out, as in esptool
+        greeting = await self.port.read(DEFAULT_TIMEOUT)
+        if greeting != b'OHAI':
+            raise FatalError(f"Failed to start stub flasher. Unexpected response: {greeting}")
+        self.is_stub = True
+
+    async def change_baud(self, baud):
+        await self.command(ESP_CMDS['CHANGE_BAUDRATE'], struct.pack('<II', baud, self.port.baud))
+        self.port.set_baud(baud)
+        await asyncio.sleep(BAUD_SETTLE)
+        self.port.flush_input()
+
+    async def spi_attach(self):
+        await self.check_command("configure SPI flash pins", ESP_CMDS['SPI_ATTACH'], struct.pack('<I', 0))
+
+    async def write_segment(self, segment, block_size, progress=None):
+        """Send one compressed segment to the stub. Returns the timeout for the final finish."""
+        payload = segment.payload
+        blocks = (len(payload) + block_size - 1) // block_size
+        await self.check_command("enter compressed flash mode", ESP_CMDS['FLASH_DEFL_BEGIN'],
+                                 struct.pack('<IIIII', segment.raw_size, blocks, block_size, segment.address, 0))
+        # Blocks inflate to about raw_size / blocks each; the stub erases lazily on top of that
+        per_block = segment.raw_size * block_size // max(len(payload), 1)
+        timeout = DEFAULT_TIMEOUT
+        for seq in range(blocks):
+            block = payload[seq * block_size:(seq + 1) * block_size]
+            await self.check_command(f"write compressed data to flash after seq {seq}", ESP_CMDS['FLASH_DEFL_DATA'],
+                                     struct.pack('<IIII', len(block), seq, 0, 0) + block, checksum(block),
+                                     timeout=timeout)
+            # The stub ACKs a block right away and writes it while the next one arrives
+            timeout = flash_engine.block_timeout(self.rom.STUB_CLASS, per_block)
+            if progress is not None:
+                progress(segment, min((seq + 1) * per_block, segment.raw_size))
+        return timeout
+
+    async def flash_defl_finish(self, timeout):
+        await self.check_command("leave compressed flash mode", ESP_CMDS['FLASH_DEFL_END'],
+                                 struct.pack('<I', 1), timeout=timeout)
+
+    async def flash_md5(self, address, size):
+        digest = await self.check_command("calculate md5sum", ESP_CMDS['SPI_FLASH_MD5'],
+                                          struct.pack('<IIII', address, size, 0, 0), resp_data_len=16,
+                                          timeout=timeout_per_mb(MD5_TIMEOUT_PER_MB, size))
+        return digest.hex()
+
+
+async def wait_prepared(preparation):
+    """Await an ImagePreparer Preparation without parking a thread on it."""
+    loop = asyncio.get_running_loop()
+    if not isinstance(preparation, flash_engine.Preparation):
+        # A plain list of regions is prepared on the loop's default executor
+        return await loop.run_in_executor(None, flash_engine.FlashJob(None, preparation).prepare)
+    ready = loop.create_future()
+
+    def on_done(_):
+        loop.call_soon_threadsafe(lambda: ready.done() or ready.set_result(None))
+
+    preparation.add_done_callback(on_done)
+    await ready
+    return preparation.wait()
+
+
+class AsyncFlashJob:
+    """
+    Connects to a device on one port and writes a set of prepared regions, as a coroutine.
+
+    regions is a Preparation from ImagePreparer (or a list of Region, as for
+    FlashJob). progress and the record follow FlashJob.
+    """
+
+    def __init__(self, port, regions, chip='auto', baud=flash_engine.DEFAULT_BAUD, before='default-reset',
+                 after='hard-reset', verify=flash_engine.VERIFY_MD5, progress=None, log=print):
+        if verify != flash_engine.VERIFY_MD5:
+            raise ValueError("The asyncio engine verifies by MD5 only.")
+        self.port = port
+        self.regions = regions
+        self.chip = chip
+        self.baud = baud
+        self.before = before
+        self.after = after
+        self.verify = verify
+        self.progress = progress
+        self.log = log
+        self.timings = {}
+        self.verification = []
+        self.chip_name = None
+        self.flash_size = None  # Bytes, detected on connect
+        self.bytes_sent = 0
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._prepared = None
+        self._cancel = threading.Event()
+
+    phase = flash_engine.FlashJob.phase
+    cancel = flash_engine.FlashJob.cancel
+    cancelled = flash_engine.FlashJob.cancelled
+    check_cancelled = flash_engine.FlashJob.check_cancelled
+
+    @property
+    def record(self):
+        return {
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+            'port': self.port,
+            'chip': self.chip_name or self.chip,
+            'baud': self.baud,
+            'images': [
+                {'address': r.address, 'name': r.name, 'size': len(r.data), 'md5': r.md5}
+                for r in self._prepared or []
+            ],
+            'bytes_sent': self.bytes_sent,
+            'timings': dict(self.timings),
+            'verification': [r.as_dict() for r in self.verification],
+        }
+
+    async def run(self):
+        self.started_at = time.time()
+        try:
+            await self._run()
+            self.result = 'ok'
+        except BaseException as e:
+            self.result, self.error = 'cancelled' if self.cancelled else 'failed', str(e) or type(e).__name__
+            raise
+        finally:
+            self.finished_at = time.time()
+
+    async def _run(self):
+        self.timings = {}
+        prepared = asyncio.ensure_future(wait_prepared(self.regions))
+        usb_jtag = native_usb(self.port)
+        port = AsyncPort(self.port)
+        loader = AsyncLoader(port, self.log)
+        try:
+            with self.phase('connect'):
+                port.open()
+                await loader.connect(self.before, usb_jtag)
+                if self.chip == 'auto':
+                    await loader.detect_chip()
+                else:
+                    loader.rom = CHIP_DEFS[self.chip]
+                self.chip_name = loader.rom.CHIP_NAME
+                await loader.run_stub()
+                if self.baud != port.baud and not usb_jtag:
+                    await loader.change_baud(self.baud)
+                await loader.spi_attach()
+                self.flash_size = await loader.detect_flash_size()
+                if self.flash_size is not None:
+                    await loader.flash_set_parameters(self.flash_size)
+            self.log(f"Connected to {self.chip_name}, stub running.")
+            if self.flash_size is None:
+                self.log("Could not detect the flash size, the stub keeps its default.")
+            with self.phase('prepare_wait'):
+                regions = await prepared
+            regions = self._prepared = flash_engine.place_regions(loader.rom, regions)
+            with self.phase('write'):
+                await self._write(loader, regions)
+            with self.phase('verify'):
+                for region in regions:
+                    start = time.perf_counter()
+                    digest = await loader.flash_md5(region.address, len(region.data))
+                    detail = ''
+                    if digest == region.md5:
+                        pass
+                    elif digest == hashlib.md5(b'\xff' * len(region.data)).hexdigest():
+                        detail = "region is empty"
+                    else:
+                        detail = f"flash MD5 {digest}, expected {region.md5}"
+                    result = flash_engine.VerifyResult(region, self.verify, not detail,
+                                                       time.perf_counter() - start, detail)
+                    self.log(f"Verify {result}")
+                    self.verification.append(result)
+            failed = [r.name for r in self.verification if not r.ok]
+            if failed:
+                raise FatalError(f"Verification failed for {', '.join(failed)}!")
+            if self.after == 'hard-reset':
+                await loader.hard_reset(usb_jtag)
+        except BaseException:
+            if self.cancelled and port.is_open:
+                # Out of the stub and the half-finished command, as FlashJob leaves it
+                try:
+                    await loader.hard_reset(usb_jtag)
+                    self.log("Cancelled, the board was reset.")
+                except OSError as e:
+                    self.log(f"Could not reset the board after cancelling: {e}")
+            raise
+        finally:
+            prepared.cancel()
+            port.close()
+        self.log(f"Phase timings: {flash_engine.format_timings(self.timings)}.")
+
+    async def _write(self, loader, regions):
+        block_size = loader.rom.STUB_CLASS.FLASH_WRITE_SIZE
+        total = sum(len(region.data) for region in regions)
+        acked = {}
+
+        def progress(segment, raw_acked):
+            acked[segment.address] = raw_acked
+            if self.progress is not None:
+                self.progress({'written': sum(acked.values()), 'total': total})
+            self.check_cancelled()
+
+        timeout = DEFAULT_TIMEOUT
+        for region in sorted(regions, key=lambda r: r.address):
+            self.log(f"Writing {region.name} at {region.address:#010x}...")
+            for segment in region.segments:
+                timeout = await loader.write_segment(segment, block_size, progress)
+                self.bytes_sent += len(segment.payload)
+        # Not ACKed until the last block has really reached the flash
+        await loader.flash_defl_finish(timeout)
+
+
+class AsyncFlashEngine:
+    """Runs AsyncFlashJobs side by side on one event loop in the calling thread."""
+
+    def __init__(self, max_concurrent=None):
+        self.max_concurrent = max_concurrent
+
+    async def run_jobs(self, jobs):
+        """Run every job; returns the exception of each job, or None where it succeeded."""
+        limit = asyncio.Semaphore(self.max_concurrent or max(len(jobs), 1))
+
+        async def run(job):
+            async with limit:
+                try:
+                    await job.run()
+                except Exception as e:
+                    job.log(f"Failed: {e}")
+                    return e
+                return None
+
+        return await asyncio.gather(*(run(job) for job in jobs))
+
+    def run(self, jobs):
+        return asyncio.run(self.run_jobs(jobs))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Flash many ports at once from one event loop.")
+    parser.add_argument('ports', nargs='+')
+    parser.add_argument('--image', nargs=2, action='append', required=True, metavar=('ADDRESS', 'FILE'))
+    parser.add_argument('--baud', type=int, default=flash_engine.DEFAULT_BAUD)
+    parser.add_argument('--chip', default='auto')
+    parser.add_argument('--before', default='default-reset', choices=['default-reset', 'usb-reset', 'no-reset'])
+    parser.add_argument('--after', default='hard-reset', choices=['hard-reset', 'no-reset'])
+    args = parser.parse_args()
+
+    regions = [flash_engine.Region(int(address, 0), path, bootloader=int(address, 0) == 0)
+               for address, path in args.image]
+    preparer = flash_engine.ImagePreparer()
+    preparation = preparer.prepare(regions)
+    jobs = [
+        AsyncFlashJob(port, preparation, chip=args.chip, baud=args.baud, before=args.before, after=args.after,
+                      log=lambda message, port=port: print(f"[{port}] {message}"))
+        for port in args.ports
+    ]
+    start = time.perf_counter()
+    errors = AsyncFlashEngine().run(jobs)
+    preparer.shutdown()
+    failed = [job.port for job, error in zip(jobs, errors) if error is not None]
+    print(f"{len(jobs) - len(failed)} of {len(jobs)} boards flashed in {time.perf_counter() - start:.1f} s.")
+    if failed:
+        print(f"Failed: {', '.join(failed)}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
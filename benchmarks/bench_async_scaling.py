@@ -0,0 +1,295 @@
+"""
+Flashes N simulated boards at once, one thread per port against one asyncio event loop.
+
+The thread-per-port rows run esptool's own connect, stub upload and baud
+change on a thread per port and write with flash_engine.write_regions, which
+adds its compression pipeline thread, as FlashJob does. The asyncio rows run
+AsyncFlashJob for every port on one loop. Both get the same prepared images.
+
+No hardware is needed: each board is a pseudo-terminal served by a simulated
+ESP32 in a separate process (one event loop for all of them). It answers as
+the ROM loader until the stub is uploaded and started, then as the stub,
+inflates what it is sent into a simulated flash and hashes it back for
+verification. Its flash reports the JEDEC ID of a 4 MB chip. Each request and response takes 10 bits per byte at the
+current baud rate. Every row runs in a fresh process, which reports wall
+time, CPU time, its peak thread count and how far its peak RSS grew.
+
+    python benchmarks/bench_async_scaling.py [--ports 8 16 32 48] [--app-size 0.5] [--baud 921600]
+"""
+import argparse
+import asyncio
+import hashlib
+import multiprocessing
+import os
+import pty
+import resource
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tty
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from esptool.loader import ESPLoader  # noqa: E402
+from esptool.targets import CHIP_DEFS  # noqa: E402
+
+import async_engine  # noqa: E402
+import flash_engine  # noqa: E402
+from bench_pipeline import make_regions  # noqa: E402
+
+CMDS = ESPLoader.ESP_CMDS
+ESP32 = CHIP_DEFS['esp32']
+ROM_BAUD = ESPLoader.ESP_ROM_BAUD
+SAMPLE_INTERVAL = 0.02  # Seconds between thread count samples
+FLASH_ID = 0x164020  # JEDEC ID the simulated flash answers RDID with: a 4 MB chip
+
+
+class SimulatedBoard:
+    """An ESP32 behind a pseudo-terminal: ROM loader, then stub, with a flash that keeps what it is sent."""
+
+    def __init__(self, loop, fd):
+        self.loop = loop
+        self.fd = fd
+        self.baud = ROM_BAUD
+        self.stub = False
+        self.link_free = 0.0  # When the simulated line is done with what it carries
+        self.flash = bytearray()
+        self.inflate = None
+        self.address = 0
+        self.buffer = bytearray()
+        self.pending = bytearray()
+        os.set_blocking(fd, False)
+        loop.add_reader(fd, self.on_readable)
+
+    def on_readable(self):
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError:
+            self.loop.remove_reader(self.fd)
+            return
+        self.buffer += data
+        while True:
+            start = self.buffer.find(0xC0)
+            end = self.buffer.find(0xC0, start + 1)
+            if start < 0 or end < 0:
+                return
+            frame = bytes(self.buffer[start + 1:end])
+            del self.buffer[:end + 1]
+            if frame:
+                packet = frame.replace(b'\xdb\xdc', b'\xc0').replace(b'\xdb\xdd', b'\xdb')
+                self.handle(packet, len(frame) + 2)
+
+    def transfer(self, size):
+        """Time the line is done carrying size bytes sent now or after what it already carries."""
+        self.link_free = max(self.loop.time(), self.link_free) + size * 10 / self.baud
+        return self.link_free
+
+    def send(self, packet, at):
+        frame = b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+        self.loop.call_at(at + len(frame) * 10 / self.baud, self.write, frame)
+
+    def write(self, frame):
+        self.pending += frame
+        self.flush()
+
+    def flush(self):
+        try:
+            written = os.write(self.fd, self.pending)
+        except BlockingIOError:
+            written = 0
+        except OSError:
+            return
+        del self.pending[:written]
+        self.loop.remove_writer(self.fd)
+        if self.pending:
+            self.loop.add_writer(self.fd, self.flush)
+
+    def respond(self, op, at, value=0, body=b'', status=b'\x00\x00'):
+        if not self.stub:
+            status += b'\x00\x00'  # ROM loaders send two reserved status bytes more
+        self.send(struct.pack('<BBHI', 1, op, len(body) + len(status), value) + body + status, at)
+
+    def handle(self, packet, size):
+        received = self.transfer(size)
+        _, op, _, _ = struct.unpack('<BBHI', packet[:8])
+        data = packet[8:]
+        if op == CMDS['SYNC']:
+            for _ in range(1 if self.stub else 8):
+                self.respond(op, received, value=0 if self.stub else 0x20120707)
+        elif op == CMDS['READ_REG']:
+            address = struct.unpack('<I', data[:4])[0]
+            value = 0  # SPI user commands complete at once
+            if address == ESPLoader.CHIP_DETECT_MAGIC_REG_ADDR:
+                value = ESP32.MAGIC_VALUE
+            elif address == ESP32.SPI_REG_BASE + ESP32.SPI_W0_OFFS:
+                value = FLASH_ID
+            self.respond(op, received, value=value)
+        elif op == CMDS['GET_SECURITY_INFO'] and not self.stub:
+            self.respond(op, received, status=b'\x01' + bytes([ESPLoader.ROM_INVALID_RECV_MSG]))
+        elif op == CMDS['MEM_END']:
+            self.respond(op, received)
+            self.stub = True
+            self.send(b'OHAI', received + 0.001)
+        elif op == CMDS['CHANGE_BAUDRATE']:
+            self.respond(op, received)
+            self.baud = struct.unpack('<I', data[:4])[0]
+        elif op == CMDS['FLASH_DEFL_BEGIN']:
+            self.address = struct.unpack('<IIII', data[:16])[3]
+            self.inflate = zlib.decompressobj()
+            self.respond(op, received)
+        elif op == CMDS['FLASH_DEFL_DATA']:
+            chunk = self.inflate.decompress(data[16:])
+            end = self.address + len(chunk)
+            if end > len(self.flash):
+                self.flash += b'\xff' * (end - len(self.flash))
+            self.flash[self.address:end] = chunk
+            self.address = end
+            self.respond(op, received)
+        elif op == CMDS['SPI_FLASH_MD5']:
+            address, length = struct.unpack('<II', data[:8])
+            content = bytes(self.flash[address:address + length])
+            content += b'\xff' * (length - len(content))
+            self.respond(op, received, body=hashlib.md5(content).digest())
+        else:
+            self.respond(op, received)  # MEM_BEGIN/DATA, SPI_ATTACH, FLASH_DEFL_END, ...
+
+
+def serve(fds, ready, stop):
+    """Process body: simulate a board on every pty master until stop is set."""
+    async def main():
+        loop = asyncio.get_running_loop()
+        boards = [SimulatedBoard(loop, fd) for fd in fds]
+        ready.set()
+        while not stop.is_set():
+            await asyncio.sleep(0.1)
+        return boards
+
+    asyncio.run(main())
+
+
+def open_boards(count):
+    """count pty pairs: (master fds, slave paths). The slaves stay open so the masters never see EOF."""
+    masters, paths, keep = [], [], []
+    for _ in range(count):
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+        masters.append(master)
+        paths.append(os.ttyname(slave))
+        keep.append(slave)
+    return masters, paths, keep
+
+
+def peak_threads(stop, peak):
+    while not stop.is_set():
+        peak[0] = max(peak[0], threading.active_count())
+        time.sleep(SAMPLE_INTERVAL)
+
+
+def flash_threaded(port, regions, baud):
+    from esptool.cmds import detect_chip
+    esp = detect_chip(port, ROM_BAUD, connect_mode='no-reset')
+    esp = esp.run_stub()
+    flash_engine.send_blocks_untraced(esp)
+    esp.change_baud(baud)
+    esp.flash_spi_attach(0)
+    flash_engine.write_regions(esp, regions, log=lambda *_: None)
+    results = flash_engine.verify_regions(esp, regions, log=lambda *_: None)
+    esp._port.close()
+    if not all(r.ok for r in results):
+        raise RuntimeError(f"Verification failed on {port}")
+
+
+def run_threaded(paths, preparation, baud):
+    regions = preparation.wait()
+    errors = []
+
+    def run(port):
+        try:
+            flash_threaded(port, regions, baud)
+        except Exception as e:
+            errors.append(f"{port}: {e}")
+
+    threads = [threading.Thread(target=run, args=(port,)) for port in paths]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return errors
+
+
+def run_async(paths, preparation, baud):
+    jobs = [
+        async_engine.AsyncFlashJob(port, preparation, chip='esp32', baud=baud, before='no-reset', after='no-reset',
+                                   log=lambda *_: None)
+        for port in paths
+    ]
+    return [f"{job.port}: {error}" for job, error in zip(jobs, async_engine.AsyncFlashEngine().run(jobs))
+            if error is not None]
+
+
+def measure(engine, count, layout, baud, results):
+    """Child process body: flash count boards with one engine and report what it cost."""
+    from esptool.logger import log
+    log.set_verbosity('silent')
+    masters, paths, keep = open_boards(count)
+    ready, stop = multiprocessing.Event(), multiprocessing.Event()
+    simulator = multiprocessing.get_context('fork').Process(target=serve, args=(masters, ready, stop))
+    simulator.start()
+    ready.wait()
+
+    preparer = flash_engine.ImagePreparer()
+    preparation = preparer.prepare([flash_engine.Region(a, p) for a, p in layout])
+    preparation.wait()
+    idle_threads = threading.active_count()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_before = time.process_time()
+    sampling, peak = threading.Event(), [0]
+    sampler = threading.Thread(target=peak_threads, args=(sampling, peak), daemon=True)
+    sampler.start()
+    start = time.perf_counter()
+    run = run_async if engine == 'asyncio' else run_threaded
+    errors = run(paths, preparation, baud)
+    wall = time.perf_counter() - start
+    sampling.set()
+    sampler.join()
+    results.put({
+        'wall': wall,
+        'cpu': time.process_time() - cpu_before,
+        'threads': peak[0] - idle_threads - 1,  # Less the sampler
+        'rss': (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before) / 1024,
+        'errors': errors,
+    })
+    stop.set()
+    simulator.join()
+    preparer.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--ports', type=int, nargs='+', default=[8, 16, 32, 48])
+    parser.add_argument('--app-size', type=float, default=0.5, help='Application size in MB (0 keeps Blink as-is)')
+    parser.add_argument('--baud', type=int, default=921600)
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as workdir:
+        layout = make_regions(workdir, args.app_size)
+        print(f"{'ports':>5} {'engine':<16} {'wall':>8} {'cpu':>8} {'threads':>8} {'rss +MB':>8}")
+        for count in args.ports:
+            for engine in ('thread-per-port', 'asyncio'):
+                results = context.Queue()
+                child = context.Process(target=measure, args=(engine, count, layout, args.baud, results))
+                child.start()
+                row = results.get()
+                child.join()
+                print(f"{count:>5} {engine:<16} {row['wall']:>7.2f}s {row['cpu']:>7.2f}s {row['threads']:>8} "
+                      f"{row['rss']:>8.1f}")
+                for error in row['errors'][:3]:
+                    print(f"      {error}")
+
+
+if __name__ == '__main__':
+    main()
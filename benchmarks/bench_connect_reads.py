@@ -0,0 +1,97 @@
+"""
+Counts the round trips and time spent identifying a chip, with and without the eFuse snapshot.
+
+No hardware is needed: a simulated stub answers READ_REG from a fake eFuse
+memory, a fixed word per address, and charges a fixed USB turnaround per
+round trip plus 10 bits per byte at the baud rate. The getters are
+esptool's own, for each chip class.
+
+    python benchmarks/bench_connect_reads.py [--latency 0.004] [--baud 921600]
+"""
+import argparse
+import os
+import random
+import struct
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from esptool.targets import CHIP_DEFS  # noqa: E402
+
+from efuse_snapshot import RoundTripCounter, snapshot_efuses  # noqa: E402
+
+GETTERS = ('get_chip_description', 'get_chip_features', 'read_mac', 'get_flash_cap', 'get_psram_cap')
+
+
+def efuse_word(address):
+    """The simulated word at address, the same on every run and in both modes."""
+    return random.Random(address).getrandbits(32) & 0x0FFF0FFF
+
+
+def simulated_stub(chip, latency, baud):
+    """A stub loader of the given chip whose serial link is simulated."""
+    cls = CHIP_DEFS[chip].STUB_CLASS
+    esp = cls.__new__(cls)
+    esp._port = SimpleNamespace(timeout=3)
+    esp._trace_enabled = False
+    esp.secure_download_mode = False
+    esp.cache = {}
+    memory = {}
+    responses = []
+    state = {'turnaround': False}
+
+    def write(packet):
+        time.sleep((len(packet) + 2) * 10 / baud)
+        _, op, _, _ = struct.unpack('<BBHI', packet[:8])
+        address = struct.unpack('<I', packet[8:12])[0]
+        value = memory.setdefault(address, efuse_word(address))
+        responses.append(struct.pack('<BBHI', 1, op, 2, value) + b'\x00\x00')
+        state['turnaround'] = True
+
+    def read():
+        if state['turnaround']:
+            time.sleep(latency)
+            state['turnaround'] = False
+        response = responses.pop(0)
+        time.sleep((len(response) + 2) * 10 / baud)
+        return response
+
+    esp.write = write
+    esp.read = read
+    return esp
+
+
+def identify(esp):
+    for getter in GETTERS:
+        if hasattr(esp, getter):
+            getattr(esp, getter)()
+
+
+def run(chip, latency, baud, snapshot):
+    esp = simulated_stub(chip, latency, baud)
+    counter = RoundTripCounter(esp)
+    start = time.perf_counter()
+    if snapshot:
+        snapshot_efuses(esp)
+    identify(esp)
+    return counter.count, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--latency', type=float, default=0.004, help='USB turnaround per round trip, in seconds')
+    parser.add_argument('--baud', type=int, default=921600)
+    parser.add_argument('--chips', nargs='+', default=['esp32', 'esp32s2', 'esp32s3', 'esp32c3', 'esp32c6'])
+    args = parser.parse_args()
+
+    print(f"{'chip':<9} {'before':>16} {'after':>16}")
+    for chip in args.chips:
+        before = run(chip, args.latency, args.baud, snapshot=False)
+        after = run(chip, args.latency, args.baud, snapshot=True)
+        print(f"{chip:<9} {before[0]:>3} trips {before[1] * 1000:>4.0f} ms {after[0]:>3} trips {after[1] * 1000:>4.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
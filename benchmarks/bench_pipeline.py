@@ -0,0 +1,144 @@
+"""
+Compares sequential compress-then-send against the pipelined flash engine.
+
+No hardware is needed: a simulated stub loader charges 10 bits per byte at the
+given baud rate plus a fixed ACK round trip per command, and decompresses what
+it receives so the result is checked as well as timed. Both runs are checked
+the same way, after their clock stops.
+
+    python benchmarks/bench_pipeline.py [--baud 921600 2000000] [--app-size 4]
+"""
+import argparse
+import hashlib
+import os
+import sys
+import tempfile
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import flash_engine  # noqa: E402
+
+BIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin')
+LAYOUT = [
+    (0x0, 'Blink.ino.bootloader.bin'),
+    (0x8000, 'Blink.ino.partitions.bin'),
+    (0xe000, 'boot_app0.bin'),
+    (0x10000, 'Blink.ino.bin'),
+]
+
+
+class SimulatedLink:
+    """Just enough of a stub ESPLoader to time the write path against a virtual UART."""
+
+    IS_STUB = True
+    FLASH_WRITE_SIZE = 0x4000
+    secure_download_mode = False
+
+    def __init__(self, baud, ack_latency=0.002):
+        self.baud = baud
+        self.ack_latency = ack_latency
+        self.flash = {}
+        self.wire_time = 0.0
+
+    def _send(self, size):
+        cost = (size + 16) * 10 / self.baud + self.ack_latency
+        self.wire_time += cost
+        time.sleep(cost)
+
+    def flash_defl_begin(self, size, compsize, offset):
+        self._send(16)
+        self._address, self._inflate = offset, zlib.decompressobj()
+
+    def flash_defl_block(self, data, seq, timeout=None):
+        self._send(len(data))
+        chunk = self._inflate.decompress(data)
+        self.flash[self._address] = chunk
+        self._address += len(chunk)
+
+    def flash_begin(self, size, offset):
+        self._send(16)
+        self._address, self._inflate = offset, None
+
+    def flash_block(self, data, seq, timeout=None):
+        self._send(len(data))
+        self.flash[self._address] = data
+        self._address += len(data)
+
+    def flash_defl_finish(self, reboot=False, timeout=None):
+        self._send(4)
+
+    flash_finish = flash_defl_finish
+
+    def flash_md5sum(self, address, size):
+        self._send(16)
+        data = b''
+        while len(data) < size:
+            data += self.flash[address + len(data)]
+        return hashlib.md5(data[:size]).hexdigest()
+
+
+def make_regions(workdir, app_size_mb):
+    regions = []
+    for address, name in LAYOUT:
+        with open(os.path.join(BIN_DIR, name), 'rb') as f:
+            data = f.read()
+        if name == 'Blink.ino.bin' and app_size_mb:
+            # Tile the real app up to a production-sized image. Copies are far
+            # more than a deflate window apart, so the compression ratio and
+            # cost stay those of real firmware.
+            data = (data * (int(app_size_mb * 1024 * 1024) // len(data) + 1))[:int(app_size_mb * 1024 * 1024)]
+        path = os.path.join(workdir, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        regions.append((address, path))
+    return regions
+
+
+def run_sequential(layout, baud):
+    esp = SimulatedLink(baud)
+    start = time.perf_counter()
+    regions = [flash_engine.Region(a, p).load() for a, p in layout]
+    segments = [s for r in regions for s in flash_engine.split_segments(r, segment_size=1 << 30)]
+    for segment in segments:
+        flash_engine.write_segment(esp, segment)
+    esp.flash_defl_finish()
+    elapsed = time.perf_counter() - start
+    check_written(esp, regions)
+    return elapsed
+
+
+def run_pipelined(layout, baud):
+    esp = SimulatedLink(baud)
+    regions = [flash_engine.Region(a, p) for a, p in layout]
+    start = time.perf_counter()
+    flash_engine.write_regions(esp, regions, log=lambda *_: None)
+    elapsed = time.perf_counter() - start
+    check_written(esp, regions)
+    return elapsed
+
+
+def check_written(esp, regions):
+    """Both runs are checked the same way, after their clock stopped."""
+    for region in regions:
+        assert esp.flash_md5sum(region.address, len(region.data)) == region.md5
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--baud', type=int, nargs='+', default=[921600, 2000000])
+    parser.add_argument('--app-size', type=float, default=2, help='Application size in MB (0 keeps Blink as-is)')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        layout = make_regions(workdir, args.app_size)
+        print(f"{'baud':>9} {'sequential':>11} {'pipelined':>10} {'saved':>7}")
+        for baud in args.baud:
+            sequential = run_sequential(layout, baud)
+            pipelined = run_pipelined(layout, baud)
+            print(f"{baud:>9} {sequential:>10.2f}s {pipelined:>9.2f}s {sequential - pipelined:>6.2f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+"""
+Times stub-to-verified on a native USB link, UART-style flow against the USB fast path.
+
+The UART-style flow changes the baud rate and sends blocks through esptool's
+command(); the fast path skips the rate change and the trace formatting.
+
+No hardware is needed: a simulated ESP32-C3 stub behind its USB-Serial/JTAG
+port moves host data at USB full-speed bulk rate whatever the port's baud
+rate, answers each command on a 1 ms USB frame boundary, and inflates and
+hashes what it receives so the result is checked as well as timed. The
+commands are esptool's own.
+
+    python benchmarks/bench_usb_link.py [--app-size 2] [--runs 3]
+"""
+import argparse
+import hashlib
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from esptool.logger import log  # noqa: E402
+from esptool.targets import CHIP_DEFS  # noqa: E402
+
+import flash_engine  # noqa: E402
+from bench_pipeline import make_regions  # noqa: E402
+
+USB_RATE = 1.0e6  # Bytes per second a full-speed bulk endpoint carries in practice
+FRAME = 0.001
+
+
+def simulated_usb_stub(chip='esp32c3'):
+    """A stub loader whose port is the chip's own USB-Serial/JTAG peripheral."""
+    cls = CHIP_DEFS[chip].STUB_CLASS
+    esp = cls.__new__(cls)
+    esp._port = SimpleNamespace(timeout=3, baudrate=115200, port='/dev/ttyACM0', flushInput=lambda: None)
+    esp._trace_enabled = False
+    esp.secure_download_mode = False
+    esp.cache = {'usb_vid': esp.ESPRESSIF_VID, 'usb_pid': esp.USB_JTAG_SERIAL_PID}
+    cmds = esp.ESP_CMDS
+    flash = bytearray(b'\xff' * 0x400000)
+    state = {}
+    responses = []
+
+    def write(packet):
+        time.sleep(len(packet) / USB_RATE)
+        _, op, _, _ = struct.unpack('<BBHI', packet[:8])
+        data = packet[8:]
+        body = b''
+        if op == cmds['FLASH_DEFL_BEGIN']:
+            state['address'] = struct.unpack('<IIII', data[:16])[3]
+            state['inflate'] = zlib.decompressobj()
+        elif op == cmds['FLASH_DEFL_DATA']:
+            chunk = state['inflate'].decompress(data[16:])
+            flash[state['address']:state['address'] + len(chunk)] = chunk
+            state['address'] += len(chunk)
+        elif op == cmds['SPI_FLASH_MD5']:
+            address, size = struct.unpack('<II', data[:8])
+            body = hashlib.md5(flash[address:address + size]).digest()
+        responses.append(struct.pack('<BBHI', 1, op, len(body) + 2, 0) + body + b'\x00\x00')
+
+    def read():
+        # The device answers on the next frame the host polls its IN endpoint in
+        now = time.perf_counter()
+        time.sleep((math.floor(now / FRAME) + 1) * FRAME - now)
+        return responses.pop(0)
+
+    esp.write = write
+    esp.read = read
+    return esp
+
+
+def run(layout, baud, fast):
+    """Seconds from the stub being up to every region verified."""
+    esp = simulated_usb_stub()
+    regions = [flash_engine.Region(a, p).prepare() for a, p in layout]
+    start = time.perf_counter()
+    if fast:
+        flash_engine.send_blocks_untraced(esp)
+    if not fast or flash_engine.link_type(esp) == flash_engine.LINK_UART:
+        esp.change_baud(baud)
+    flash_engine.write_regions(esp, regions, log=lambda *_: None)
+    results = flash_engine.verify_regions(esp, regions, log=lambda *_: None)
+    assert all(r.ok for r in results)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--app-size', type=float, default=2, help='Application size in MB (0 keeps Blink as-is)')
+    parser.add_argument('--runs', type=int, default=3, help='Best of this many runs per row')
+    args = parser.parse_args()
+    log.set_verbosity('silent')
+
+    with tempfile.TemporaryDirectory() as workdir:
+        layout = make_regions(workdir, args.app_size)
+        rows = [
+            ('UART flow, 921600', 921600, False),
+            ('UART flow, 2000000', 2000000, False),
+            ('USB fast path', 921600, True),
+        ]
+        times = {}
+        print(f"{'path':<20} {'time':>8}")
+        for label, baud, fast in rows:
+            times[label] = min(run(layout, baud, fast) for _ in range(args.runs))
+            print(f"{label:<20} {times[label]:>7.3f}s")
+        saved = times['UART flow, 921600'] - times['USB fast path']
+        print(f"Fast path saves {saved * 1000:.0f} ms per board; the baud rate itself changes nothing on this link.")
+
+
+if __name__ == '__main__':
+    main()
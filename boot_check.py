@@ -0,0 +1,167 @@
+"""
+Boot acceptance: after the reset, the board has to print what a working board prints.
+
+A BootCheck holds regexes that all have to show up in the serial output
+(e.g. "READY" or the expected version string), optional regexes that fail
+the board as soon as they show up (a panic, a brownout), and a timeout
+counted from the reset. Time-to-ready is the time from the reset to the
+last expected match.
+
+FlashJob(boot_check=...) runs it right after the reset on the monitor it
+starts on the flashed port, so a board that does not boot fails its job.
+Already flashed boards are checked from the command line, all ports at the
+same time:
+
+    python boot_check.py /dev/ttyUSB0 /dev/ttyUSB1 --expect READY --expect "v1\\.4\\.\\d+" --timeout 10
+"""
+import argparse
+import re
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import serial
+from esptool.loader import ESPLoader
+from esptool.reset import HardReset
+from serial.tools import list_ports
+
+from serial_monitor import SerialMonitor
+
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_FAIL = [r'Guru Meditation Error', r'Brownout detector was triggered', r'abort\(\) was called']
+TAIL_SIZE = 64 * 1024  # Characters of output kept for matching across reads
+
+
+class BootResult:
+    """Outcome of a boot check; elapsed is the time-to-ready when ok."""
+
+    def __init__(self, ok, elapsed, matches, detail=''):
+        self.ok = ok
+        self.elapsed = elapsed
+        self.matches = matches  # pattern -> (matched text, seconds after the reset)
+        self.detail = detail
+
+    def as_dict(self):
+        return {
+            'ok': self.ok,
+            'elapsed': round(self.elapsed, 3),
+            'matches': {pattern: [text, round(at, 3)] for pattern, (text, at) in self.matches.items()},
+            'detail': self.detail,
+        }
+
+    def __str__(self):
+        if self.ok:
+            return f"Booted, ready after {self.elapsed:.2f} s ({', '.join(t for t, _ in self.matches.values())})"
+        return f"Boot check failed after {self.elapsed:.2f} s: {self.detail}"
+
+
+class BootCheck:
+    """Expected and failing patterns plus a timeout, for the output after a reset."""
+
+    def __init__(self, expect, fail=DEFAULT_FAIL, timeout=DEFAULT_TIMEOUT, baud=115200):
+        if not expect:
+            raise ValueError("A boot check needs at least one expected pattern.")
+        self.expect = [re.compile(pattern) for pattern in expect]
+        self.fail = [re.compile(pattern) for pattern in fail]
+        self.timeout = timeout
+        self.baud = baud
+
+    def run(self, ring, reset_at, log=print):
+        """
+        Watch a SerialMonitor's ring buffer, filled since the reset at reset_at (perf_counter).
+
+        Returns a BootResult as soon as every expected pattern matched, a
+        failing one matched, or the timeout ran out.
+        """
+        pending = list(self.expect)
+        matches = {}
+        text = ''
+        position = 0
+        deadline = reset_at + self.timeout
+        while True:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                missing = ', '.join(repr(p.pattern) for p in pending)
+                return BootResult(False, self.timeout, matches, f"no {missing} within {self.timeout:.0f} s")
+            if not ring.wait(position, remaining):
+                continue
+            data, position, _ = ring.read_since(position)
+            now = time.perf_counter() - reset_at
+            text = (text + data.decode('utf-8', 'replace'))[-TAIL_SIZE:]
+            for pattern in self.fail:
+                match = pattern.search(text)
+                if match:
+                    return BootResult(False, now, matches, f"{match.group(0)!r}")
+            for pattern in list(pending):
+                match = pattern.search(text)
+                if match:
+                    matches[pattern.pattern] = (match.group(0), now)
+                    pending.remove(pattern)
+            if not pending:
+                result = BootResult(True, now, matches)
+                log(str(result) + ".")
+                return result
+
+
+def native_usb(port):
+    """Whether port is a chip's own USB peripheral, which needs the longer reset sequence."""
+    for info in list_ports.comports():
+        if info.device == port:
+            return info.vid == ESPLoader.ESPRESSIF_VID
+    return False
+
+
+def reset_and_monitor(port, baud, log=print):
+    """Open port, reset the board and monitor it from its first byte. Returns (monitor, reset time)."""
+    handle = serial.Serial()
+    handle.port = port
+    handle.baudrate = baud
+    handle.dtr = False
+    handle.rts = False
+    handle.open()
+    # Whatever the board printed before the reset must not count
+    handle.reset_input_buffer()
+    HardReset(handle, uses_usb=native_usb(port))()
+    reset_at = time.perf_counter()
+    return SerialMonitor(handle, baud, log=log).start(), reset_at
+
+
+def check_port(port, check, log=print):
+    """Reset the board on port and run the check on its output."""
+    monitor, reset_at = reset_and_monitor(port, check.baud, log=log)
+    try:
+        return check.run(monitor.ring, reset_at, log=lambda m: log(f"{port}: {m}"))
+    finally:
+        monitor.stop()
+
+
+def check_ports(ports, check, log=print):
+    """Check every port at once. Returns port -> BootResult, or the exception for a port that failed to open."""
+    def run(port):
+        try:
+            return check_port(port, check, log)
+        except (serial.SerialException, OSError) as e:
+            return e
+
+    with ThreadPoolExecutor(max_workers=max(len(ports), 1), thread_name_prefix='boot-check') as executor:
+        return dict(zip(ports, executor.map(run, ports)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reset boards and check that they boot.")
+    parser.add_argument('ports', nargs='+')
+    parser.add_argument('--expect', action='append', required=True, help="Regex that must show up (repeatable)")
+    parser.add_argument('--fail', action='append', help="Regex that fails the board (repeatable, replaces the defaults)")
+    parser.add_argument('--timeout', type=float, default=DEFAULT_TIMEOUT)
+    parser.add_argument('--baud', type=int, default=115200)
+    args = parser.parse_args()
+
+    check = BootCheck(args.expect, args.fail if args.fail is not None else DEFAULT_FAIL, args.timeout, args.baud)
+    results = check_ports(args.ports, check, log=lambda m: None)
+    for port, result in results.items():
+        print(f"{port}: {result}")
+    sys.exit(0 if all(isinstance(r, BootResult) and r.ok for r in results.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""
+Chip type last detected behind each USB adapter, keyed by USB serial number or location.
+
+A production jig keeps flashing the same kind of board through the same
+adapter, so after the first detection later connects name the chip directly
+and go straight to the right ROM class. esptool still checks the chip ID or
+magic value on connect, so a stale entry costs one reconnect, not a bad flash.
+"""
+import json
+import os
+import threading
+
+
+class ChipCache:
+    """esptool chip name (a CHIP_DEFS key) per USB serial number or location."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._chips = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._chips = json.load(f)
+            except (OSError, ValueError):
+                self._chips = {}
+
+    def lookup(self, key):
+        if not key:
+            return None
+        with self._lock:
+            return self._chips.get(key)
+
+    def store(self, key, chip):
+        if not key:
+            return
+        with self._lock:
+            if self._chips.get(key) == chip:
+                return
+            self._chips[key] = chip
+            self._save()
+
+    def forget(self, key):
+        with self._lock:
+            if self._chips.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._chips, f)
+        os.replace(tmp, self.path)
@@ -0,0 +1,587 @@
+"""
+Local HTTP/JSON control API, for flashing stations driven by a MES instead of the GUI.
+
+    POST   /jobs              {"port": "/dev/ttyUSB0", "profile": "blink"} -> 202 {"id": 12}
+                              images by hash or catalog name instead of (or over) a profile:
+                              "images": [{"address": "0x10000", "sha256": "..."}, {"address": "0x0", "name": "..."}]
+                              optional: "priority", "baud", "verify" ("md5"/"readback"), "chip", "boot_expect"
+    GET    /jobs              pending, running and recent jobs (?state=done&limit=50)
+    GET    /jobs/<id>         one job, with its full record once it finished
+    DELETE /jobs/<id>         cancel a job; a running one stops at its next block and ends up cancelled
+    GET    /events            Server-Sent Events: job state changes, progress and log lines
+                              (?job=<id> for one job, which ends the stream when the job ends)
+    GET    /ports             serial ports with USB details, hub and whether a job runs on them
+    GET    /profiles          the profiles from profiles.json
+    GET    /artifacts         the image catalog
+    PUT    /artifacts/<name>  upload an image (raw body) -> {"sha256": "..."}
+
+Every request is served on its own thread and SSE clients only ever wait on
+the event bus, so dozens of clients cost a thread each and never hold up a
+flashing thread: jobs publish an event with one append under a short lock.
+There is no authentication; the server listens on localhost unless told
+otherwise.
+
+profiles.json maps a profile name to its images and settings:
+
+    {"blink": {"images": [{"address": "0x0", "name": "Blink.ino.bootloader.bin"}, ...],
+               "baud": 921600, "verify": "md5", "boot_expect": "READY"}}
+
+With --simulate N the station also has N simulated boards (ports sim0,
+sim1, ...). Their jobs prepare the real images, then take as long as the
+compressed data would take on the wire, with the same progress and result
+events, so a MES integration can be tested without hardware:
+
+    python control_api.py --simulate 4
+    curl -N localhost:8765/events &
+    curl -X POST localhost:8765/jobs -d '{"port": "sim0", "profile": "blink"}'
+"""
+import argparse
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+from serial.tools import list_ports
+
+import flash_engine
+from artifact_store import ArtifactStore
+from boot_check import BootCheck
+from chip_cache import ChipCache
+from device_cache import DeviceCache
+from flash_journal import FlashJournal
+from hub_limits import HubLimits, hub_of
+from job_history import JobHistory
+from job_queue import CANCELLED, DEFAULT_CONCURRENCY, DONE, FAILED, SHUTDOWN_TIMEOUT, JobScheduler
+from port_health import PortHealth
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+STATE_DIR = os.path.join(BASE_DIR, 'state')
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+EVENTS_KEPT = 10000  # Events a reconnecting client can catch up on (Last-Event-ID)
+KEEPALIVE = 15.0  # Seconds between SSE comments on an idle stream
+PROGRESS_INTERVAL = 0.25  # Seconds between write progress events per job
+MAX_BODY = 64 * 1024 * 1024  # Largest upload, an image
+MAX_JSON = 1024 * 1024
+SIMULATED_CONNECT = 0.5  # Seconds a simulated board takes to connect
+VERIFY_MODES = (flash_engine.VERIFY_MD5, flash_engine.VERIFY_READBACK)
+
+
+class RequestError(Exception):
+    """A request the API rejects, with the HTTP status to answer."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+class EventBus:
+    """Numbered events fanned out to any number of waiting readers."""
+
+    def __init__(self, kept=EVENTS_KEPT):
+        self._events = deque(maxlen=kept)
+        self._lock = threading.Condition()
+        self.last = 0  # Number of the newest event
+
+    def publish(self, event):
+        with self._lock:
+            self.last += 1
+            self._events.append((self.last, event))
+            self._lock.notify_all()
+
+    def read_since(self, last, timeout):
+        """
+        (events, missed): the events numbered after last, waiting up to timeout for one.
+
+        missed counts the events that already dropped out of the history.
+        """
+        with self._lock:
+            self._lock.wait_for(lambda: self.last > last, timeout)
+            if not self._events or self.last <= last:
+                return [], 0
+            first = self._events[0][0]
+            missed = max(first - last - 1, 0)
+            return list(self._events)[max(last + 1 - first, 0):], missed
+
+
+class JobEvents:
+    """
+    A job's log and progress callbacks, published with its id.
+
+    The job may start, and report, before submit() has returned its id, so
+    anything reported earlier is held until bind().
+    """
+
+    def __init__(self, bus, port, log=print):
+        self.bus = bus
+        self.port = port
+        self.echo = log
+        self.id = None
+        self.last_progress = {}
+        self._early = []
+        self._progress_at = 0.0
+        self._lock = threading.Lock()
+
+    def bind(self, job_id):
+        with self._lock:
+            self.id = job_id
+            early, self._early = self._early, None
+            for event in early:
+                self._publish(event)
+
+    def _publish(self, event):
+        event.update(id=self.id, port=self.port)
+        self.bus.publish(event)
+
+    def publish(self, event):
+        with self._lock:
+            if self.id is None:
+                self._early.append(event)
+            else:
+                self._publish(event)
+
+    def log(self, line):
+        self.echo(f"[{self.port}] {line}")
+        self.publish({'type': 'log', 'line': str(line)})
+
+    def progress(self, update):
+        self.last_progress.update(update)
+        if 'written' in update and update['written'] < update['total']:
+            now = time.monotonic()
+            if now - self._progress_at < PROGRESS_INTERVAL:
+                return
+            self._progress_at = now
+        self.publish({'type': 'progress', **update})
+
+
+class SimulatedFlashJob:
+    """
+    A flash job for a simulated board, for testing clients of the API.
+
+    The images are prepared for real; connecting, writing and verifying
+    only take the time they would on the wire at the job's baud rate.
+    """
+
+    def __init__(self, port, regions, baud=flash_engine.DEFAULT_BAUD, verify=flash_engine.VERIFY_MD5,
+                 progress=None, log=print):
+        self.port = port
+        self.regions = regions
+        self.baud = baud
+        self.verify = verify
+        self.progress = progress
+        self.log = log
+        self.timings = {}
+        self.verification = []
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._prepared = None
+        self._cancel = threading.Event()
+
+    phase = flash_engine.FlashJob.phase
+    cancel = flash_engine.FlashJob.cancel
+    cancelled = flash_engine.FlashJob.cancelled
+    check_cancelled = flash_engine.FlashJob.check_cancelled
+
+    def run(self):
+        self.started_at = time.time()
+        try:
+            with self.phase('connect'):
+                time.sleep(SIMULATED_CONNECT)
+            with self.phase('prepare_wait'):
+                regions = self._prepared = self.regions.wait()
+            total = sum(len(region.data) for region in regions)
+            written = 0
+            with self.phase('write'):
+                for region in regions:
+                    for segment in region.segments:
+                        time.sleep(len(segment.payload) * 10 / self.baud)
+                        written += segment.raw_size
+                        if self.progress is not None:
+                            self.progress({'written': written, 'total': total})
+                        self.check_cancelled()
+            with self.phase('verify'):
+                for region in regions:
+                    wire = len(region.data) if self.verify == flash_engine.VERIFY_READBACK else 0
+                    time.sleep(wire * 10 / self.baud)
+                    self.verification.append(flash_engine.VerifyResult(region, self.verify, True, 0.0))
+            self.log(f"Simulated board on {self.port} flashed and verified.")
+            self.result = 'ok'
+        except BaseException as e:
+            self.result, self.error = 'cancelled' if self.cancelled else 'failed', str(e) or type(e).__name__
+            raise
+        finally:
+            self.finished_at = time.time()
+
+    @property
+    def record(self):
+        return {
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+            'port': self.port,
+            'chip': 'simulated',
+            'baud': self.baud,
+            'images': [
+                {'address': r.address, 'name': r.name, 'size': len(r.data), 'md5': r.md5}
+                for r in self._prepared or []
+            ],
+            'timings': dict(self.timings),
+            'verification': [r.as_dict() for r in self.verification],
+        }
+
+
+def parse_address(value):
+    if isinstance(value, int):
+        return value
+    try:
+        return int(str(value), 0)
+    except ValueError:
+        raise RequestError(f"Bad address {value!r}")
+
+
+class Station:
+    """The queue, images and state shared by every API request."""
+
+    def __init__(self, store, profiles=None, state_dir=STATE_DIR, max_concurrent=DEFAULT_CONCURRENCY,
+                 simulate=0, log=print):
+        self.store = store
+        self.profiles = profiles or {}
+        self.log = log
+        self.bus = EventBus()
+        self.preparer = flash_engine.ImagePreparer()
+        self.simulated = [f"sim{n}" for n in range(simulate)]
+        self.events = {}  # job id -> JobEvents, while it is pending or running
+        self.state = {}
+        if state_dir:
+            self.state = {
+                'journal': FlashJournal(os.path.join(state_dir, 'journal')),
+                'port_health': PortHealth(os.path.join(state_dir, 'port_health.json')),
+                'device_cache': DeviceCache(os.path.join(state_dir, 'devices.sqlite')),
+                'history': JobHistory(os.path.join(state_dir, 'history.sqlite'), log=log),
+                'chip_cache': ChipCache(os.path.join(state_dir, 'chips.json')),
+            }
+        limits = HubLimits(os.path.join(state_dir, 'hubs.json') if state_dir else None, log=log)
+        self.scheduler = JobScheduler(max_concurrent, on_change=self._on_change, log=log, limits=limits)
+
+    def _on_change(self, queued):
+        self.bus.publish({'type': 'job', **queued.as_dict()})
+        if queued.state in (DONE, FAILED, CANCELLED):
+            self.events.pop(queued.id, None)
+
+    def regions(self, images):
+        if not isinstance(images, list) or not all(isinstance(image, dict) for image in images):
+            raise RequestError("images must be a list of objects with an address and a sha256 or name.")
+        regions = []
+        for image in images:
+            address = parse_address(image.get('address'))
+            sha256 = image.get('sha256')
+            name = image.get('name')
+            if sha256 is None:
+                if name is None:
+                    raise RequestError("An image needs a sha256 or a catalog name.")
+                sha256 = self.store.resolve(name)
+                if sha256 is None:
+                    raise RequestError(f"No image named {name!r} in the catalog.", 404)
+            elif self.store.size(sha256) is None:
+                raise RequestError(f"No image with SHA-256 {sha256} in the store.", 404)
+            regions.append(flash_engine.Region.from_store(
+                address, self.store, sha256, name or sha256[:12], bootloader=(address == 0x0)
+            ))
+        if not regions:
+            raise RequestError("No images given, by profile or by hash.")
+        return regions
+
+    def submit(self, request):
+        """Queue a flash job from an API request. Returns its QueuedJob."""
+        port = request.get('port')
+        if not port:
+            raise RequestError("A port is needed.")
+        profile = {}
+        if request.get('profile') is not None:
+            profile = self.profiles.get(request['profile'])
+            if profile is None:
+                raise RequestError(f"No profile named {request['profile']!r}.", 404)
+        settings = dict(profile, **{k: v for k, v in request.items() if v is not None})
+        verify = settings.get('verify', flash_engine.VERIFY_MD5)
+        if verify not in VERIFY_MODES:
+            raise RequestError(f"verify must be one of {', '.join(VERIFY_MODES)}.")
+        boot_check = None
+        if settings.get('boot_expect'):
+            try:
+                boot_check = BootCheck([settings['boot_expect']])
+            except re.error as e:
+                raise RequestError(f"boot_expect is not a valid regex: {e}")
+        try:
+            baud = int(settings.get('baud', flash_engine.DEFAULT_BAUD))
+            priority = int(settings.get('priority', 0))
+        except (TypeError, ValueError):
+            raise RequestError("baud and priority must be integers.")
+        try:
+            preparation = self.preparer.prepare(self.regions(settings.get('images', [])))
+        except flash_engine.FatalError as e:
+            raise RequestError(str(e))
+
+        events = JobEvents(self.bus, port, log=self.log)
+        if port in self.simulated:
+            job = SimulatedFlashJob(port, preparation, baud=baud, verify=verify,
+                                    progress=events.progress, log=events.log)
+        else:
+            job = flash_engine.FlashJob(
+                port, preparation,
+                chip=settings.get('chip', 'auto'),
+                baud=baud,
+                verify=verify,
+                boot_check=boot_check,
+                progress=events.progress,
+                log=events.log,
+                **self.state
+            )
+        queued = self.scheduler.submit(job, priority)
+        self.events[queued.id] = events
+        if queued.state in (DONE, FAILED, CANCELLED):
+            # Finished before submit() returned, _on_change had nothing to drop yet
+            self.events.pop(queued.id, None)
+        events.bind(queued.id)
+        return queued
+
+    def describe(self, queued, full=False):
+        """A job as JSON: queue state and timings, progress while it runs, its record when asked."""
+        description = queued.as_dict()
+        events = self.events.get(queued.id)
+        if events is not None:
+            description['progress'] = dict(events.last_progress)
+        if full and queued.started_at is not None and hasattr(queued.job, 'record'):
+            description['record'] = queued.job.record
+        return description
+
+    def jobs(self, state=None, limit=None):
+        pending, running, finished = self.scheduler.snapshot()
+        jobs = [self.describe(q) for q in running + pending + finished if state is None or q.state == state]
+        return jobs[:limit] if limit else jobs
+
+    def ports(self):
+        busy = {q.port for q in self.scheduler.snapshot()[1]}
+        ports = [
+            {
+                'device': info.device,
+                'description': info.description,
+                'serial_number': info.serial_number,
+                'vid': info.vid,
+                'pid': info.pid,
+                'location': info.location,
+                'hub': hub_of(info.location),
+                'busy': info.device in busy,
+            }
+            for info in list_ports.comports()
+        ]
+        ports += [{'device': port, 'description': 'Simulated board', 'busy': port in busy} for port in self.simulated]
+        return ports
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """Cancel pending and running jobs, give them up to timeout seconds and close the state files."""
+        self.scheduler.shutdown(timeout)
+        self.preparer.shutdown()
+        if 'history' in self.state:
+            self.state['history'].close()
+
+
+class ControlHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'ESP32Flasher'
+
+    @property
+    def station(self):
+        return self.server.station
+
+    def log_message(self, format, *args):
+        pass  # Requests are not worth a console line each; job events are
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def read_body(self, limit):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > limit:
+            raise RequestError(f"Body larger than {limit} bytes.", 413)
+        return self.rfile.read(length)
+
+    def read_json(self):
+        try:
+            body = json.loads(self.read_body(MAX_JSON) or b'{}')
+        except ValueError as e:
+            raise RequestError(f"Bad JSON: {e}")
+        if not isinstance(body, dict):
+            raise RequestError("Expected a JSON object.")
+        return body
+
+    def job_id(self, part):
+        try:
+            return int(part)
+        except ValueError:
+            raise RequestError(f"Bad job id {part!r}")
+
+    def handle_request(self, method):
+        url = urlparse(self.path)
+        parts = [unquote(p) for p in url.path.strip('/').split('/') if p]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        try:
+            route = (method, parts[0] if parts else '', len(parts))
+            if route == ('GET', 'events', 1):
+                return self.stream_events(query)
+            if route == ('GET', 'jobs', 1):
+                limit = int(query['limit']) if 'limit' in query else None
+                return self.send_json({'jobs': self.station.jobs(query.get('state'), limit)})
+            if route == ('POST', 'jobs', 1):
+                queued = self.station.submit(self.read_json())
+                return self.send_json({'id': queued.id, 'state': queued.state}, 202)
+            if route in (('GET', 'jobs', 2), ('DELETE', 'jobs', 2)):
+                queued = self.station.scheduler.get(self.job_id(parts[1]))
+                if queued is None:
+                    raise RequestError(f"No job {parts[1]}.", 404)
+                if method == 'DELETE' and not self.station.scheduler.cancel(queued.id):
+                    raise RequestError(f"Job {queued.id} is {queued.state} and cannot be cancelled.", 409)
+                return self.send_json(self.station.describe(queued, full=True))
+            if route == ('GET', 'ports', 1):
+                return self.send_json({'ports': self.station.ports()})
+            if route == ('GET', 'profiles', 1):
+                return self.send_json({'profiles': self.station.profiles})
+            if route == ('GET', 'artifacts', 1):
+                names = [{'name': n, 'sha256': h, 'size': s} for n, h, s in self.station.store.names()]
+                return self.send_json({'artifacts': names})
+            if route == ('PUT', 'artifacts', 2):
+                sha256 = self.station.store.put(self.read_body(MAX_BODY))
+                self.station.store.name(parts[1], sha256)
+                return self.send_json({'name': parts[1], 'sha256': sha256}, 201)
+            raise RequestError(f"No {method} {url.path}", 404)
+        except RequestError as e:
+            self.send_json({'error': str(e)}, e.status)
+        except (ValueError, TypeError, AttributeError, KeyError) as e:
+            # A body of the wrong shape
+            self.send_json({'error': f"Malformed request: {e}"}, 400)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client went away, nobody to answer
+        except Exception as e:
+            self.station.log(f"{method} {url.path} failed: {e!r}")
+            self.send_json({'error': f"Internal error: {e}"}, 500)
+
+    def stream_events(self, query):
+        """Server-Sent Events until the client goes away, or its job ends with ?job=."""
+        job_id = self.job_id(query['job']) if 'job' in query else None
+        last = self.headers.get('Last-Event-ID')
+        last = int(last) if last and last.isdigit() else self.station.bus.last
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-cache')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        if job_id is not None:
+            queued = self.station.scheduler.get(job_id)
+            if queued is None:
+                self.wfile.write(f"event: error\ndata: {json.dumps({'error': f'No job {job_id}.'})}\n\n".encode())
+                return
+            # The job's state now, in case it changed before the client connected
+            self.wfile.write(f"event: job\ndata: {json.dumps(queued.as_dict())}\n\n".encode())
+            if queued.state in (DONE, FAILED, CANCELLED):
+                return
+        try:
+            while not self.server.stopping.is_set():
+                events, missed = self.station.bus.read_since(last, KEEPALIVE)
+                if not events:
+                    self.wfile.write(b": keepalive\n\n")
+                    self.wfile.flush()
+                    continue
+                lines = []
+                if missed:
+                    lines.append(f"event: missed\ndata: {json.dumps({'missed': missed})}\n\n")
+                ended = False
+                for number, event in events:
+                    last = number
+                    if job_id is not None and event.get('id') != job_id:
+                        continue
+                    lines.append(f"id: {number}\nevent: {event['type']}\ndata: {json.dumps(event, default=str)}\n\n")
+                    if job_id is not None and event['type'] == 'job':
+                        ended = event['state'] in (DONE, FAILED, CANCELLED)
+                if lines:
+                    self.wfile.write(''.join(lines).encode())
+                    self.wfile.flush()
+                if ended:
+                    return
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class ControlServer(ThreadingHTTPServer):
+    """The API over a Station, one thread per request."""
+
+    daemon_threads = True
+
+    def __init__(self, station, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        super().__init__((host, port), ControlHandler)
+        self.station = station
+        self.stopping = threading.Event()
+
+    def shutdown(self):
+        self.stopping.set()
+        super().shutdown()
+
+
+def load_profiles(path):
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the flashing station's HTTP/JSON control API.")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Keep it on localhost, there is no authentication")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--profiles', default=os.path.join(BASE_DIR, 'profiles.json'))
+    parser.add_argument('--store', default=os.path.join(STATE_DIR, 'artifacts'))
+    parser.add_argument('--parallel', type=int, default=DEFAULT_CONCURRENCY, help="Jobs at a time")
+    parser.add_argument('--simulate', type=int, default=0, metavar='N', help="Add N simulated boards, sim0...")
+    args = parser.parse_args()
+
+    station = Station(ArtifactStore(args.store), load_profiles(args.profiles), max_concurrent=args.parallel,
+                      simulate=args.simulate)
+    server = ControlServer(station, args.host, args.port)
+    print(f"Control API on http://{args.host}:{args.port}/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stopping.set()
+        server.server_close()
+        print("Waiting for running jobs to finish...")
+        station.shutdown()
+
+
+if __name__ == '__main__':
+    main()
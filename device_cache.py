@@ -0,0 +1,62 @@
+"""
+Local SQLite cache of what was last written to each device, keyed by MAC address.
+
+Boards that come back from test or rework are often flashed again with the
+firmware they already hold. With this cache the flasher only has to confirm a
+matching region with an on-device MD5 instead of rewriting it, and regions
+known to differ skip that check entirely.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS device_regions (
+    mac TEXT NOT NULL,
+    address INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    md5 TEXT NOT NULL,
+    written_at REAL NOT NULL,
+    PRIMARY KEY (mac, address)
+)
+"""
+
+
+class DeviceCache:
+    """Region hashes last written to each device."""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute(SCHEMA)
+        self._db.commit()
+
+    def lookup(self, mac):
+        """Map of address to (size, md5) last written to the device."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT address, size, md5 FROM device_regions WHERE mac = ?", (mac,)
+            ).fetchall()
+        return {address: (size, md5) for address, size, md5 in rows}
+
+    def store(self, mac, images):
+        """Record (address, size, md5) of each image written to the device."""
+        now = time.time()
+        with self._lock, self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO device_regions (mac, address, size, md5, written_at) VALUES (?, ?, ?, ?, ?)",
+                [(mac, address, size, md5, now) for address, size, md5 in images],
+            )
+
+    def forget(self, mac):
+        """Drop everything known about a device, e.g. after a failed write."""
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM device_regions WHERE mac = ?", (mac,))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
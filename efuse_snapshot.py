@@ -0,0 +1,72 @@
+"""
+Per-connection snapshot of the eFuse registers, serving esptool's chip getters.
+
+esptool's getters (get_chip_description, get_chip_features, get_pkg_version,
+get_flash_cap, get_psram_cap, read_mac, ...) each read the eFuse words they
+need with their own READ_REG round trip, and between them read the same few
+words over and over. eFuses do not change while a device is connected, so
+every word of the eFuse read window is read from the device at most once per
+connection and answered from the snapshot after that.
+
+The loaders have no bulk memory read, and the stub keeps only one command
+pending, so the reads themselves cannot be batched into fewer commands.
+"""
+from esptool.loader import DEFAULT_TIMEOUT
+
+EFUSE_WINDOW = 0x40  # Bytes from the first eFuse read register; covers block 0 and the MAC words
+
+
+class RoundTripCounter:
+    """Counts the commands a loader sent and waited on a response for."""
+
+    def __init__(self, esp):
+        self.count = 0
+        self._command = esp.command
+        esp.command = self._counted_command
+
+    def _counted_command(self, op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT):
+        if op is not None and wait_response:
+            self.count += 1
+        return self._command(op, data, chk, wait_response, timeout)
+
+
+def efuse_window(esp):
+    """(first, end) addresses of the eFuse read registers, or None for chips without them."""
+    base = getattr(esp, 'EFUSE_RD_REG_BASE', None)
+    if base is None:
+        return None
+    return base, base + EFUSE_WINDOW
+
+
+def snapshot_efuses(esp):
+    """
+    Answer repeated reads of the eFuse window from memory for the rest of the connection.
+
+    Returns the snapshot, address to value, which fills up as words are read.
+    Install it on the loader run_stub returned; reads outside the window
+    always go to the device.
+    """
+    snapshot = {}
+    window = efuse_window(esp)
+    if window is None:
+        return snapshot
+    first, end = window
+    read_reg = esp.read_reg
+
+    def cached_read_reg(addr, timeout=DEFAULT_TIMEOUT):
+        if not first <= addr < end:
+            return read_reg(addr, timeout)
+        if addr not in snapshot:
+            snapshot[addr] = read_reg(addr, timeout)
+        return snapshot[addr]
+
+    esp.read_reg = cached_read_reg
+    return snapshot
+
+
+def chip_summary(esp):
+    """The description line esptool prints on connect, e.g. 'ESP32-C3 (QFN32) (revision v0.4), WiFi, BLE'."""
+    try:
+        return ", ".join([esp.get_chip_description()] + list(esp.get_chip_features()))
+    except (NotImplementedError, AttributeError):
+        return esp.CHIP_NAME
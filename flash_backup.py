@@ -0,0 +1,375 @@
+"""
+Full-flash backups of a device to a file on disk.
+
+The whole flash is read with a single bulk READ_FLASH command through the
+stub (see flash_engine.stream_flash), which keeps the link busy with
+sector-sized packets, and lands in a preallocated, memory-mapped file. The
+ROM's read_flash_slow, one 64-byte command per block, is only a fallback for
+when the stub cannot be loaded. In secure download mode neither works, the
+ROM refuses flash reads altogether.
+
+Incremental backups keep every 4 KB sector once in a content-addressed store
+and describe each snapshot by its list of sector hashes. Only 64 KB blocks
+whose on-device MD5 changed since the device's previous snapshot are looked
+at sector by sector, and only changed sectors are read back.
+
+    python flash_backup.py snapshot --port /dev/ttyUSB0
+    python flash_backup.py restore --port /dev/ttyUSB0 backups/store/snapshots/<mac>/<time>.json
+"""
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import time
+
+from esptool.cmds import reset_chip
+from esptool.util import FatalError
+
+from flash_engine import (
+    DEFAULT_BAUD, FlashJob, Region, device_mac, format_timings, stream_flash, usb_identity
+)
+from flash_journal import ERASE_BLOCK_SIZE
+
+PROGRESS_INTERVAL = 1.0  # Seconds between progress lines
+
+
+def preallocate(f, size):
+    """Reserve size bytes for f up front, so the file does not grow block by block."""
+    f.truncate(size)
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(f.fileno(), 0, size)
+        except OSError:
+            pass  # Not supported by every filesystem, the truncate is enough
+
+
+def read_to_file(esp, path, size, address=0, log=print, check_cancelled=None):
+    """
+    Stream size bytes of flash starting at address into path.
+
+    The data goes to path + '.part' first and only replaces path once the
+    device's digest of the transfer matched. check_cancelled, if given, is
+    called after every chunk and raises to stop the transfer; the device is
+    then mid-read and has to be reset. Returns the elapsed seconds.
+    """
+    if not esp.IS_STUB:
+        log("The flasher stub is not running, reading through the ROM 64 bytes at a time. This is slow.")
+    tmp = path + '.part'
+    start = time.perf_counter()
+    try:
+        with open(tmp, 'wb+') as f:
+            preallocate(f, size)
+            with mmap.mmap(f.fileno(), size) as out:
+                pos = 0
+                last_report = start
+                for chunk in stream_flash(esp, address, size):
+                    out[pos:pos + len(chunk)] = chunk
+                    pos += len(chunk)
+                    if check_cancelled is not None:
+                        check_cancelled()
+                    now = time.perf_counter()
+                    if now - last_report >= PROGRESS_INTERVAL:
+                        last_report = now
+                        log(f"Read {pos // 1024} of {size // 1024} KB ({pos / 1024 / (now - start):.1f} KB/s)...")
+                out.flush()
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+    elapsed = time.perf_counter() - start
+    log(f"Read {size} bytes in {elapsed:.2f} s ({size / 1024 / elapsed:.1f} KB/s) to {path}.")
+    return elapsed
+
+
+class BackupJob(FlashJob):
+    """
+    Connects to a device on one port and copies its flash to a file.
+
+    size defaults to the detected flash size. Connecting, chip detection and
+    the start baud rate work as for FlashJob.
+    """
+
+    def __init__(self, port, path, chip='auto', baud=DEFAULT_BAUD, before='default-reset',
+                 after='hard-reset', size=None, port_health=None, chip_cache=None, log=print):
+        super().__init__(port, [], chip=chip, baud=baud, before=before, after=after,
+                         port_health=port_health, chip_cache=chip_cache, log=log)
+        self.path = path
+        self.size = size
+
+    def _run(self):
+        self.timings = {}
+        self.usb_serial, self.usb_location = usb_identity(self.port)
+        baud = self.baud
+        if self.port_health is not None:
+            baud = self.port_health.start_baud(self.port, self.baud)
+        with self.phase('connect'):
+            esp = self.connect(baud)
+        try:
+            self.chip_name = esp.CHIP_NAME
+            self.mac = device_mac(esp)
+            if esp.secure_download_mode:
+                raise FatalError("Flash cannot be read in secure download mode.")
+            size = self.size or self.flash_size
+            if not size:
+                raise FatalError("Could not detect the flash size, pass the size to back up.")
+            self.log(f"Backing up {size // 1024} KB of flash from {self.mac or self.port}...")
+            with self.phase('read'):
+                read_to_file(esp, self.path, size, log=self.log, check_cancelled=self.check_cancelled)
+            reset_chip(esp, self.after)
+        except BaseException:
+            if self.cancelled:
+                self.reset_cancelled(esp)
+            raise
+        finally:
+            esp._port.close()
+            self._esp = None
+        self.log(f"Phase timings: {format_timings(self.timings)}.")
+
+
+class SectorStore:
+    """
+    Content-addressed store of flash sectors, plus snapshots per device.
+
+    Sectors are files named by their SHA-256, so identical sectors (erased
+    space, shared bootloaders and apps) are kept once across all devices.
+    A snapshot is a JSON manifest listing the hash of every sector.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.sector_dir = os.path.join(directory, 'sectors')
+        self.snapshot_dir = os.path.join(directory, 'snapshots')
+
+    def _sector_path(self, digest):
+        return os.path.join(self.sector_dir, digest[:2], digest)
+
+    def put(self, data):
+        """Store a sector unless it is already there. Returns its hash."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._sector_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            with open(tmp, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        return digest
+
+    def get(self, digest):
+        with open(self._sector_path(digest), 'rb') as f:
+            return f.read()
+
+    def snapshots(self, mac):
+        """Manifest paths of a device's snapshots, oldest first."""
+        directory = os.path.join(self.snapshot_dir, mac.replace(':', ''))
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.json'))
+
+    def latest(self, mac):
+        paths = self.snapshots(mac)
+        return load_snapshot(paths[-1]) if paths else None
+
+    def save_snapshot(self, snapshot):
+        directory = os.path.join(self.snapshot_dir, snapshot['mac'].replace(':', ''))
+        os.makedirs(directory, exist_ok=True)
+        created = snapshot['created']
+        name = time.strftime('%Y%m%d-%H%M%S', time.localtime(created)) + f"-{int(created * 1000) % 1000:03d}.json"
+        path = os.path.join(directory, name)
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(snapshot, f)
+        os.replace(tmp, path)
+        return path
+
+    def data(self, snapshot):
+        """The full flash contents a snapshot describes."""
+        return b''.join(self.get(digest) for digest in snapshot['sectors'])
+
+
+def load_snapshot(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def snapshot_region(store, path):
+    """A region that writes a snapshot back as one streamed write from address 0."""
+    snapshot = load_snapshot(path)
+    region = Region(0x0, path)
+    region.data = store.data(snapshot)
+    region.md5 = hashlib.md5(region.data).hexdigest()
+    return region
+
+
+def changed_sectors(esp, previous, sector_size, check_cancelled=None):
+    """
+    Indexes of sectors whose on-device MD5 differs from the previous snapshot.
+
+    One MD5 command per 64 KB block first, then per sector only inside the
+    blocks that changed. check_cancelled, if given, is called before every
+    block and raises to stop the comparison.
+    """
+    per_block = ERASE_BLOCK_SIZE // sector_size
+    changed = []
+    for block, block_md5 in enumerate(previous['block_md5']):
+        if check_cancelled is not None:
+            check_cancelled()
+        if esp.flash_md5sum(block * ERASE_BLOCK_SIZE, ERASE_BLOCK_SIZE) == block_md5:
+            continue
+        for index in range(block * per_block, (block + 1) * per_block):
+            if esp.flash_md5sum(index * sector_size, sector_size) != previous['sector_md5'][index]:
+                changed.append(index)
+    return changed
+
+
+def sector_runs(indexes):
+    """Group sorted sector indexes into (first, count) runs of neighbours."""
+    runs = []
+    for index in indexes:
+        if runs and runs[-1][0] + runs[-1][1] == index:
+            runs[-1][1] += 1
+        else:
+            runs.append([index, 1])
+    return runs
+
+
+def read_sectors(esp, store, indexes, sector_size, check_cancelled=None):
+    """
+    Read the given sectors, one bulk read per run, into the store. Returns {index: hash}.
+
+    check_cancelled, if given, is called after every chunk as in read_to_file().
+    """
+    digests = {}
+    for first, count in sector_runs(indexes):
+        chunks = []
+        for chunk in stream_flash(esp, first * sector_size, count * sector_size):
+            chunks.append(chunk)
+            if check_cancelled is not None:
+                check_cancelled()
+        data = b''.join(chunks)
+        for i in range(count):
+            digests[first + i] = store.put(data[i * sector_size:(i + 1) * sector_size])
+    return digests
+
+
+class SnapshotJob(BackupJob):
+    """
+    Takes an incremental, deduplicated snapshot of a device's flash.
+
+    The first snapshot of a MAC address reads the whole flash; later ones
+    only read sectors that changed since the previous snapshot.
+    """
+
+    def __init__(self, port, store, chip='auto', baud=DEFAULT_BAUD, before='default-reset',
+                 after='hard-reset', size=None, port_health=None, chip_cache=None, log=print):
+        super().__init__(port, None, chip=chip, baud=baud, before=before, after=after, size=size,
+                         port_health=port_health, chip_cache=chip_cache, log=log)
+        self.store = store
+
+    def _run(self):
+        self.timings = {}
+        self.usb_serial, self.usb_location = usb_identity(self.port)
+        baud = self.baud
+        if self.port_health is not None:
+            baud = self.port_health.start_baud(self.port, self.baud)
+        with self.phase('connect'):
+            esp = self.connect(baud)
+        try:
+            self.chip_name = esp.CHIP_NAME
+            self.mac = device_mac(esp)
+            if esp.secure_download_mode:
+                raise FatalError("Flash cannot be read in secure download mode.")
+            if self.mac is None:
+                raise FatalError("Could not read the MAC address to find previous snapshots.")
+            size = self.size or self.flash_size
+            if not size or size % ERASE_BLOCK_SIZE:
+                raise FatalError("Could not detect the flash size, pass the size to back up.")
+            sector_size = esp.FLASH_SECTOR_SIZE
+            count = size // sector_size
+
+            previous = self.store.latest(self.mac)
+            if previous is not None and (previous['size'] != size or previous['sector_size'] != sector_size):
+                previous = None
+            with self.phase('compare'):
+                if previous is None:
+                    changed = list(range(count))
+                else:
+                    changed = changed_sectors(esp, previous, sector_size, self.check_cancelled)
+            self.log(f"{len(changed)} of {count} sectors changed since the last snapshot of {self.mac}.")
+            with self.phase('read'):
+                start = time.perf_counter()
+                digests = read_sectors(esp, self.store, changed, sector_size, self.check_cancelled)
+                if changed:
+                    elapsed = time.perf_counter() - start
+                    read_kb = len(changed) * sector_size / 1024
+                    self.log(f"Read {read_kb:.0f} KB in {elapsed:.2f} s ({read_kb / elapsed:.1f} KB/s).")
+
+            sectors = list(previous['sectors']) if previous else [None] * count
+            sector_md5 = list(previous['sector_md5']) if previous else [None] * count
+            for index, digest in digests.items():
+                sectors[index] = digest
+                sector_md5[index] = hashlib.md5(self.store.get(digest)).hexdigest()
+            per_block = ERASE_BLOCK_SIZE // sector_size
+            block_md5 = list(previous['block_md5']) if previous else [None] * (size // ERASE_BLOCK_SIZE)
+            for block in {index // per_block for index in digests}:
+                data = b''.join(self.store.get(d) for d in sectors[block * per_block:(block + 1) * per_block])
+                block_md5[block] = hashlib.md5(data).hexdigest()
+
+            self.path = self.store.save_snapshot({
+                'mac': self.mac,
+                'chip': self.chip_name,
+                'size': size,
+                'sector_size': sector_size,
+                'created': time.time(),
+                'sectors': sectors,
+                'sector_md5': sector_md5,
+                'block_md5': block_md5,
+            })
+            self.log(f"Snapshot saved to {self.path}.")
+            reset_chip(esp, self.after)
+        except BaseException:
+            if self.cancelled:
+                self.reset_cancelled(esp)
+            raise
+        finally:
+            esp._port.close()
+            self._esp = None
+        self.log(f"Phase timings: {format_timings(self.timings)}.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Back up and restore the flash of a device.")
+    parser.add_argument('--store', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backups', 'store'))
+    parser.add_argument('--baud', type=int, default=DEFAULT_BAUD)
+    commands = parser.add_subparsers(dest='command', required=True)
+    backup = commands.add_parser('backup', help="Copy the whole flash to a file")
+    backup.add_argument('--port', required=True)
+    backup.add_argument('path')
+    snapshot = commands.add_parser('snapshot', help="Take an incremental snapshot into the store")
+    snapshot.add_argument('--port', required=True)
+    restore = commands.add_parser('restore', help="Write a snapshot back to a device")
+    restore.add_argument('--port', required=True)
+    restore.add_argument('snapshot')
+    export = commands.add_parser('export', help="Write a snapshot out as a plain flash image")
+    export.add_argument('snapshot')
+    export.add_argument('path')
+    args = parser.parse_args()
+
+    store = SectorStore(args.store)
+    if args.command == 'backup':
+        BackupJob(args.port, args.path, baud=args.baud).run()
+    elif args.command == 'snapshot':
+        SnapshotJob(args.port, store, baud=args.baud).run()
+    elif args.command == 'restore':
+        FlashJob(args.port, [snapshot_region(store, args.snapshot)], baud=args.baud).run()
+    elif args.command == 'export':
+        with open(args.path, 'wb') as f:
+            f.write(store.data(load_snapshot(args.snapshot)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,1310 @@
+"""
+Flash engine that drives esptool as a library instead of through esptool.main().
+
+Images are split into erase-aligned segments which are deflated on a producer
+thread while the previous segment is on the wire. zlib releases the GIL while
+it compresses, so the serial link and the CPU are busy at the same time
+instead of taking turns.
+
+When the files are known ahead of time, ImagePreparer does the reading,
+validation, hashing and compression of every region on a thread pool before
+the device is even connected, and the pipeline just replays the result.
+"""
+import hashlib
+import inspect
+import os
+import queue
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
+
+from esptool.cmds import attach_flash, connect_esp, detect_flash_size, reset_chip, run_stub
+from esptool.loader import DEFAULT_TIMEOUT, ERASE_WRITE_TIMEOUT_PER_MB, MAX_TIMEOUT, ESPLoader, timeout_per_mb
+from esptool.targets import CHIP_DEFS
+from esptool.util import FatalError, UnsupportedCommandError, flash_size_bytes, pad_to
+from serial import SerialException
+from serial.tools import list_ports
+
+from efuse_snapshot import RoundTripCounter, chip_summary, snapshot_efuses
+from serial_monitor import SerialMonitor
+from flash_journal import ERASE_BLOCK_SIZE
+from port_health import baud_ladder
+
+DEFAULT_BAUD = 921600
+COMPRESSION_LEVEL = 9
+
+# Write attempts per job before giving up, and the backoff between them
+WRITE_ATTEMPTS = 4
+RETRY_BACKOFF = 0.5
+MAX_RETRY_BACKOFF = 4.0
+
+PARTITION_TABLE_MAGIC = b'\xaa\x50'  # Starts every entry of a binary partition table
+
+# Post-flash verification modes: the on-device MD5 of each region (milliseconds
+# of host time), or a full streamed readback compared chunk by chunk for audits.
+VERIFY_MD5 = 'md5'
+VERIFY_READBACK = 'readback'
+
+# Each segment is compressed as its own deflate stream and written with its own
+# flash_defl_begin. It has to be a multiple of the 4 KB flash sector so every
+# segment starts on an erase boundary; 256 KB keeps the extra begin commands
+# negligible while letting the first segment hit the wire almost immediately.
+SEGMENT_SIZE = 0x40000
+
+# How many compressed segments the producer may run ahead of the sender.
+PIPELINE_DEPTH = 2
+
+# Prepared regions ImagePreparer keeps for reuse, least recently used first
+# out: the four images of several profiles.
+PREPARED_KEPT = 32
+
+# Adaptive write block size. The stub's receive buffer (the loader's
+# FLASH_WRITE_SIZE) is the upper limit; below it the largest power of two is
+# picked whose block still crosses the measured link within MAX_BLOCK_TIME,
+# which bounds per-block timeouts and the work lost to a retry. The stub
+# holds a single pending command, so one block is in flight while it writes
+# the previous one, never more. A failed write halves the upper limit and the
+# link is measured again after the reconnect.
+MIN_BLOCK_SIZE = 0x400
+MAX_BLOCK_TIME = 0.25
+PROBE_BLOCKS = 4
+BLOCKS_IN_FLIGHT = 1
+
+# How the host reaches the chip: through a USB-UART bridge, or through the
+# chip's own USB peripheral, which ignores the baud rate altogether.
+LINK_UART = 'uart'
+LINK_USB_JTAG_SERIAL = 'usb-jtag-serial'
+LINK_USB_OTG = 'usb-otg'
+
+
+class JobCancelled(Exception):
+    """Raised in a job's thread once it notices that it was cancelled."""
+
+
+class Region:
+    """
+    A file to be written at a given flash address.
+
+    A bootloader region is moved to the detected chip's bootloader offset
+    (0x1000 on ESP32, 0x0 on ESP32-C3 and S3, ...) once the chip is known.
+    """
+
+    def __init__(self, address, path, bootloader=False):
+        self.address = address
+        self.path = os.path.abspath(path)
+        self.name = os.path.basename(path)
+        self.bootloader = bootloader
+        self.data = None
+        self.md5 = None
+        self.segments = None  # Filled in by prepare()
+        self.prepare_time = None
+        self.store = None  # ArtifactStore holding the contents, see from_store()
+        self.sha256 = None
+
+    @classmethod
+    def from_store(cls, address, store, sha256, name, bootloader=False):
+        """A region whose contents come from an ArtifactStore instead of a file."""
+        region = cls(address, name, bootloader)
+        region.name = name
+        region.path = f"store:{sha256}"  # Not a file, but says where the contents come from in messages
+        region.store = store
+        region.sha256 = sha256
+        return region
+
+    @property
+    def key(self):
+        """Identifies the contents this region was (or would be) built from."""
+        if self.sha256 is not None:
+            return (self.address, self.sha256)
+        st = os.stat(self.path)
+        return (self.address, self.path, st.st_size, st.st_mtime_ns)
+
+    def load(self):
+        if self.data is None:
+            if self.store is not None:
+                data = self.store.read(self.sha256)
+            else:
+                with open(self.path, 'rb') as f:
+                    data = f.read()
+            self.data = pad_to(data, 4)
+            self.md5 = hashlib.md5(self.data).hexdigest()
+        return self
+
+    def prepare(self, executor=None):
+        """Load, hash and compress every segment, in parallel if an executor is given."""
+        self.load()
+        offsets = range(0, len(self.data), SEGMENT_SIZE)
+        if executor is None:
+            self.segments = [make_segment(self, offset) for offset in offsets]
+        else:
+            self.segments = list(executor.map(lambda offset: make_segment(self, offset), offsets))
+        return self
+
+    def relocated(self, address):
+        """The same loaded and prepared image at another address."""
+        if address == self.address:
+            return self
+        region = Region(address, self.path, self.bootloader)
+        region.path, region.name, region.store, region.sha256 = self.path, self.name, self.store, self.sha256
+        region.data, region.md5, region.prepare_time = self.data, self.md5, self.prepare_time
+        if self.segments is not None:
+            # Compression does not depend on the address, the payloads are reused as they are
+            region.segments = [
+                Segment(region, s.offset, s.raw_size, s.payload, s.compressed, s.compress_time)
+                for s in self.segments
+            ]
+        return region
+
+    def __getstate__(self):
+        # Prepared regions go to worker processes loaded, the store stays behind
+        state = dict(self.__dict__)
+        state['store'] = None
+        return state
+
+
+class Segment:
+    """An erase-aligned slice of a region, ready to be sent."""
+
+    def __init__(self, region, offset, raw_size, payload, compressed, compress_time):
+        self.region = region
+        self.offset = offset
+        self.address = region.address + offset
+        self.raw_size = raw_size
+        self.payload = payload
+        self.compressed = compressed
+        self.compress_time = compress_time
+        self.last = offset + raw_size >= len(region.data)
+
+    def uncompressed(self):
+        """The same segment as plain data, for loaders that cannot inflate."""
+        if not self.compressed:
+            return self
+        raw = self.region.data[self.offset:self.offset + self.raw_size]
+        return Segment(self.region, self.offset, self.raw_size, raw, False, 0.0)
+
+
+def make_segment(region, offset, compress=True, segment_size=SEGMENT_SIZE):
+    raw = region.data[offset:offset + segment_size]
+    start = time.perf_counter()
+    payload = zlib.compress(raw, COMPRESSION_LEVEL) if compress else raw
+    compressed = compress and len(payload) < len(raw)
+    if not compressed:
+        payload = raw
+    return Segment(region, offset, len(raw), payload, compressed, time.perf_counter() - start)
+
+
+def split_segments(region, compress=True, segment_size=SEGMENT_SIZE, start=0):
+    """
+    Yield the segments of a region, deflating each one as it is produced.
+
+    Segments before start are skipped. If start falls inside a prepared
+    segment, only the tail of that segment is recompressed.
+    """
+    if region.segments is not None:
+        for segment in region.segments:
+            end = segment.offset + segment.raw_size
+            if end <= start:
+                continue
+            if segment.offset < start:
+                yield make_segment(region, start, compress, end - start)
+            else:
+                yield segment
+        return
+    data = region.load().data
+    for offset in range(start, len(data), segment_size):
+        yield make_segment(region, offset, compress, segment_size)
+
+
+def validate_regions(regions):
+    """Reject empty files and regions that would overwrite each other."""
+    regions = sorted(regions, key=lambda r: r.address)
+    for region in regions:
+        if not region.data:
+            raise FatalError(f"{region.name} is empty.")
+    for current, following in zip(regions, regions[1:]):
+        if current.address + len(current.data) > following.address:
+            raise FatalError(
+                f"{current.name} ({len(current.data)} bytes at {current.address:#x}) "
+                f"overlaps {following.name} at {following.address:#x}."
+            )
+
+
+class Preparation:
+    """A set of regions being prepared in the background."""
+
+    def __init__(self, futures):
+        self._futures = futures
+        self.elapsed = None  # Wall time of the preparation itself
+
+    def done(self):
+        return all(f.done() for f in self._futures)
+
+    def add_done_callback(self, fn):
+        """Call fn(self) once every region is ready (possibly from a pool thread)."""
+        remaining = [len(self._futures)]
+        lock = threading.Lock()
+
+        def on_done(_):
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                fn(self)
+
+        for future in self._futures:
+            future.add_done_callback(on_done)
+
+    def wait(self):
+        """Block until all regions are ready and return them, validated."""
+        regions = [f.result() for f in self._futures]
+        if self.elapsed is None:
+            self.elapsed = max(r.prepare_time for r in regions) if regions else 0.0
+        validate_regions(regions)
+        return regions
+
+
+class ImagePreparer:
+    """
+    Reads, validates, hashes and compresses regions on a thread pool.
+
+    zlib and hashlib release the GIL on large buffers, so threads give real
+    parallelism here without pickling whole images to another process. The
+    PREPARED_KEPT most recently used results are kept per contents and address
+    (Region.key), so selecting the same images again is free, even from another
+    variant's directory, and clients alternating between profiles reuse them.
+    """
+
+    def __init__(self, max_workers=None):
+        workers = max_workers or os.cpu_count() or 2
+        # Two pools so a region task waiting on its segments can never starve them.
+        self._region_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='prepare-region')
+        self._segment_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='prepare-segment')
+        self._cache = OrderedDict()  # Region.key -> Future, least recently used first
+        self._lock = threading.Lock()
+
+    def _prepare(self, region):
+        start = time.perf_counter()
+        region.prepare(self._segment_executor)
+        region.prepare_time = time.perf_counter() - start
+        return region
+
+    def prepare(self, regions):
+        futures = []
+        with self._lock:
+            for region in regions:
+                try:
+                    key = region.key
+                except OSError as e:
+                    raise FatalError(f"Cannot read {region.path}: {e}")
+                future = self._cache.get(key)
+                if future is None:
+                    future = self._region_executor.submit(self._prepare, region)
+                self._remember(key, future)
+                futures.append(future)
+        return Preparation(futures)
+
+    def _remember(self, key, future):
+        """Cache a preparation as the most recently used one. Called with the lock held."""
+        self._cache[key] = future
+        self._cache.move_to_end(key)
+        while len(self._cache) > PREPARED_KEPT:
+            # Whoever waits on an evicted preparation still gets it, it just is not reused
+            self._cache.popitem(last=False)
+
+    def prepare_files(self, files, store):
+        """
+        prepare() for files that go into an ArtifactStore first: (address, path, name, bootloader) each.
+
+        Adding a changed file hashes and chunks all of it, so that happens on
+        the pool as well. The regions read from the store and are cached by
+        contents, like those of prepare().
+        """
+        futures = [self._region_executor.submit(self._store_and_prepare, store, *file) for file in files]
+        return Preparation(futures)
+
+    def _store_and_prepare(self, store, address, path, name, bootloader):
+        sha256 = store.add(path, name)
+        region = Region.from_store(address, store, sha256, os.path.basename(path), bootloader)
+        with self._lock:
+            future = self._cache.get(region.key)
+            owner = future is None
+            if owner:
+                future = Future()
+            self._remember(region.key, future)
+        if owner:
+            try:
+                future.set_result(self._prepare(region))
+            except BaseException as e:
+                future.set_exception(e)
+        return future.result()
+
+    def shutdown(self):
+        self._region_executor.shutdown(wait=False, cancel_futures=True)
+        self._segment_executor.shutdown(wait=False, cancel_futures=True)
+
+
+class CompressionPipeline:
+    """
+    Produces segments for a list of regions on a background thread.
+
+    Iterating the pipeline yields segments in flash order. The producer stays
+    at most PIPELINE_DEPTH segments ahead, so memory use is bounded by a few
+    segments rather than by the whole image set.
+    """
+
+    _DONE = object()
+
+    def __init__(self, regions, compress=True, depth=PIPELINE_DEPTH, start_offsets=None):
+        self.regions = regions
+        self.compress = compress
+        self.start_offsets = start_offsets or {}
+        self.stall_time = 0.0  # Time the sender spent waiting for the compressor
+        self.compress_time = 0.0
+        self._queue = queue.Queue(maxsize=depth)
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._produce, daemon=True)
+
+    def _produce(self):
+        try:
+            for region in self.regions:
+                prepared = region.segments is not None
+                start = self.start_offsets.get(region.address, 0)
+                for segment in split_segments(region, self.compress, start=start):
+                    if not prepared:
+                        self.compress_time += segment.compress_time
+                    if not self._put(segment):
+                        return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._DONE)
+
+    def _put(self, item):
+        while not self._stopped.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def __iter__(self):
+        self._thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item = self._queue.get()
+                self.stall_time += time.perf_counter() - start
+                if item is self._DONE:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            self.close()
+
+    def close(self):
+        self._stopped.set()
+
+    @property
+    def overlap_time(self):
+        """Compression time hidden behind serial transfers."""
+        return max(self.compress_time - self.stall_time, 0.0)
+
+
+def block_timeout(esp, uncompressed_size):
+    """Per-block timeout, mirroring esptool's allowance for the stub's lazy erases."""
+    size = uncompressed_size
+    if esp.IS_STUB:
+        deflate_buffer, erase_block = 32 * 1024, 64 * 1024
+        size += ((uncompressed_size + deflate_buffer - 1) // deflate_buffer + 1) * erase_block
+    return timeout_per_mb(ERASE_WRITE_TIMEOUT_PER_MB, size)
+
+
+def mirrors_esptool_command(esp):
+    """
+    Whether esp's command() is the one send_blocks_untraced() copies.
+
+    The copy relies on esptool internals (the private _port and
+    _trace_enabled, read() returning one SLIP packet, the ROM's
+    invalid-command reply), as of esptool 5.x. Another
+    signature or a missing attribute means a different esptool, whose own
+    command() is then kept.
+    """
+    try:
+        parameters = list(inspect.signature(type(esp).command).parameters)
+    except (AttributeError, TypeError, ValueError):
+        return False
+    return (
+        parameters == ['self', 'op', 'data', 'chk', 'wait_response', 'timeout']
+        and all(hasattr(esp, name) for name in ('_port', '_trace_enabled', 'read', 'write', 'flush_input'))
+        and isinstance(getattr(esp, 'ROM_INVALID_RECV_MSG', None), int)
+    )
+
+
+def send_blocks_untraced(esp):
+    """
+    Send flash data blocks without building esptool's trace output. Returns whether it was installed.
+
+    esptool's command() formats the hex dump of every request for its trace
+    even when tracing is off, which takes tens of milliseconds of host CPU
+    per 16 KB block, spent between one ACK and the next send. On a native
+    USB link that is several times the transfer itself. With tracing off,
+    data blocks go out through this copy of command(), error handling
+    included; every other command still goes through esptool's. On an
+    esptool whose command() differs, nothing is replaced.
+    """
+    if not mirrors_esptool_command(esp):
+        return False
+    command = esp.command
+    data_ops = {esp.ESP_CMDS['FLASH_DATA'], esp.ESP_CMDS['FLASH_DEFL_DATA']}
+
+    def untraced_command(op=None, data=b"", chk=0, wait_response=True, timeout=DEFAULT_TIMEOUT):
+        if op not in data_ops or not wait_response or esp._trace_enabled:
+            return command(op, data, chk, wait_response, timeout)
+        saved_timeout = esp._port.timeout
+        new_timeout = min(timeout, MAX_TIMEOUT)
+        if new_timeout != saved_timeout:
+            esp._port.timeout = new_timeout
+        try:
+            esp.write(struct.pack('<BBHI', 0x00, op, len(data), chk) + data)
+            for _ in range(100):
+                packet = esp.read()
+                if len(packet) < 8:
+                    continue
+                resp, op_ret, _, val = struct.unpack('<BBHI', packet[:8])
+                if resp != 1:
+                    continue
+                body = packet[8:]
+                if op_ret == op:
+                    return val, body
+                if len(body) > 1 and body[0] != 0 and body[1] == esp.ROM_INVALID_RECV_MSG:
+                    # The loader repeats the complaint; drain it all, as esptool does
+                    time.sleep(0.2)
+                    esp._port.timeout = 0.001
+                    esp._port.read(14 * 8)
+                    esp.flush_input()
+                    raise UnsupportedCommandError(esp, op)
+        finally:
+            esp._port.timeout = saved_timeout
+        raise FatalError("Response doesn't match request.")
+
+    esp.command = untraced_command
+    return True
+
+
+class BlockSizer:
+    """
+    Picks the write block size from the round trip and throughput of the first blocks.
+
+    The begin command of a stub segment carries no data and erases nothing,
+    so it times a bare round trip; the first PROBE_BLOCKS full blocks time
+    the link including the stub's writes. The size chosen applies from the
+    next segment on, since a segment's block size is fixed by its begin.
+    After a failed write, write_failed() falls back to half the block size.
+    """
+
+    def __init__(self, limit, block_size=None, log=print):
+        self.limit = limit
+        self.fixed = block_size is not None
+        self.block_size = min(block_size or limit, limit)
+        self.log = log
+        self.round_trip = None
+        self.rate = None  # Bytes per second on the wire, stub writes included
+        self._samples = []
+
+    def begin_done(self, elapsed):
+        self.round_trip = elapsed if self.round_trip is None else min(self.round_trip, elapsed)
+
+    def block_done(self, size, elapsed):
+        if self.rate is not None or size < self.block_size:
+            return
+        self._samples.append((size, elapsed))
+        if len(self._samples) >= PROBE_BLOCKS:
+            self._choose()
+
+    def _choose(self):
+        round_trip = self.round_trip or 0.0
+        wire_time = sum(max(elapsed - round_trip, 1e-6) for _, elapsed in self._samples)
+        self.rate = sum(size for size, _ in self._samples) / wire_time
+        if not self.fixed:
+            sizes = [self.limit] + [
+                size for size in (MIN_BLOCK_SIZE << n for n in range(16)) if size < self.limit
+            ]
+            fitting = [size for size in sizes if round_trip + size / self.rate <= MAX_BLOCK_TIME]
+            self.block_size = max(fitting) if fitting else min(sizes)
+        self.log(
+            f"Write blocks of {self.block_size:#x} bytes, {BLOCKS_IN_FLIGHT} in flight "
+            f"({'fixed' if self.fixed else f'limit {self.limit:#x}'}): round trip "
+            f"{round_trip * 1000:.1f} ms, {self.rate / 1024:.0f} KB/s on the wire."
+        )
+
+    def write_failed(self):
+        """Halve the block size after a timeout or serial error and probe the new link again."""
+        if self.fixed:
+            return
+        self.limit = max(self.block_size // 2, MIN_BLOCK_SIZE)
+        self.block_size = self.limit
+        self.round_trip = self.rate = None
+        self._samples = []
+
+    @property
+    def params(self):
+        """The chosen parameters and what they were based on, for the job record."""
+        return {
+            'block_size': self.block_size,
+            'in_flight': BLOCKS_IN_FLIGHT,
+            'round_trip_ms': None if self.round_trip is None else round(self.round_trip * 1000, 2),
+            'rate': None if self.rate is None else round(self.rate),
+        }
+
+
+def write_segment(esp, segment, progress=None, sizer=None):
+    """
+    Send one segment. Returns the timeout to use for the final flash_*_finish.
+
+    progress(segment, raw_bytes) is called after every ACKed block with the
+    number of uncompressed bytes of the segment acknowledged so far. A
+    BlockSizer, only used with the stub, sets the block size and is fed the
+    timing of each command.
+    """
+    timeout = DEFAULT_TIMEOUT
+    sizer = sizer if esp.IS_STUB else None
+    if sizer is not None:
+        # flash_*_begin tells the stub the block size it is going to get
+        esp.FLASH_WRITE_SIZE = sizer.block_size
+    block_size = esp.FLASH_WRITE_SIZE
+    payload = segment.payload
+    acked = 0
+    start = time.perf_counter()
+    if segment.compressed:
+        esp.flash_defl_begin(segment.raw_size, len(payload), segment.address)
+        decompress = zlib.decompressobj()
+    else:
+        esp.flash_begin(segment.raw_size, segment.address)
+    if sizer is not None:
+        sizer.begin_done(time.perf_counter() - start)
+
+    for seq, pos in enumerate(range(0, len(payload), block_size)):
+        block = payload[pos:pos + block_size]
+        start = time.perf_counter()
+        if segment.compressed:
+            written = len(decompress.decompress(block))
+            if not esp.IS_STUB:
+                timeout = block_timeout(esp, written)
+            esp.flash_defl_block(block, seq, timeout=timeout)
+            if esp.IS_STUB:
+                # The stub ACKs a block right away and writes it while the next one arrives
+                timeout = block_timeout(esp, written)
+        else:
+            written = len(block)
+            esp.flash_block(block + b'\xff' * (block_size - len(block)), seq)
+        if sizer is not None:
+            sizer.block_done(len(block), time.perf_counter() - start)
+        acked += written
+        if progress:
+            progress(segment, acked)
+    return timeout
+
+
+def write_regions(esp, regions, compress=True, log=print, start_offsets=None, progress=None, sizer=None):
+    """
+    Write all regions through the compression pipeline.
+
+    start_offsets maps a region address to the number of bytes already on the
+    device, which are skipped. progress and sizer are passed on to write_segment.
+    Returns the pipeline so callers can report compress/stall/overlap times.
+    """
+    regions = sorted(regions, key=lambda r: r.address)
+    compress = compress and esp.IS_STUB
+    pipeline = CompressionPipeline(regions, compress=compress, start_offsets=start_offsets)
+    start = time.perf_counter()
+    sent = 0
+    timeout = DEFAULT_TIMEOUT
+    segment = None
+    current = None
+    for segment in pipeline:
+        if not compress:
+            segment = segment.uncompressed()
+        if segment.region is not current:
+            current = segment.region
+            log(f"Writing {segment.region.name} at {segment.address:#010x}...")
+        timeout = write_segment(esp, segment, progress, sizer)
+        sent += len(segment.payload)
+        if segment.last:
+            log(f"Wrote {len(segment.region.data)} bytes at {segment.region.address:#010x}.")
+
+    # The stub only writes each block after ACKing it, so finish with a command
+    # that is not ACKed until the last block has really reached the flash.
+    if segment is not None and esp.IS_STUB:
+        if segment.compressed:
+            esp.flash_defl_finish(reboot=False, timeout=timeout)
+        else:
+            esp.flash_finish(reboot=False, timeout=timeout)
+
+    elapsed = time.perf_counter() - start
+    total = sum(len(r.data) - (start_offsets or {}).get(r.address, 0) for r in regions)
+    message = f"Sent {total} bytes ({sent} on the wire) in {elapsed:.2f} s"
+    if pipeline.compress_time:
+        message += (
+            f", {pipeline.overlap_time:.2f} s of {pipeline.compress_time:.2f} s "
+            "compression overlapped with transfers"
+        )
+    log(message + ".")
+    return pipeline
+
+
+def stream_flash(esp, address, length):
+    """
+    Yield the flash contents at address in chunks as they arrive.
+
+    Uses the stub's bulk READ_FLASH path (one command, sector-sized packets with
+    up to 64 in flight) and checks the device's MD5 of the whole transfer at the
+    end. Only ROM loaders fall back to read_flash_slow. The generator must be
+    consumed to the end, otherwise the link is left mid-transfer.
+    """
+    if not esp.IS_STUB:
+        for pos in range(0, length, esp.FLASH_SECTOR_SIZE):
+            yield esp.read_flash_slow(address + pos, min(esp.FLASH_SECTOR_SIZE, length - pos), None)
+        return
+
+    esp.check_command(
+        "read flash",
+        esp.ESP_CMDS["READ_FLASH"],
+        struct.pack("<IIII", address, length, esp.FLASH_SECTOR_SIZE, 64),
+    )
+    digest = hashlib.md5()
+    received = 0
+    previous_timeout = esp._port.timeout
+    esp._port.timeout = 3
+    try:
+        while received < length:
+            packet = esp.read()
+            received += len(packet)
+            if received < length and len(packet) < esp.FLASH_SECTOR_SIZE:
+                raise FatalError(f"Corrupt data, expected {esp.FLASH_SECTOR_SIZE:#x} bytes but received {len(packet):#x}.")
+            if received > length:
+                raise FatalError("Read more than expected.")
+            esp.write(struct.pack("<I", received))
+            digest.update(packet)
+            yield packet
+        if esp.read() != digest.digest():
+            raise FatalError("Digest mismatch while reading flash, serial errors?")
+    finally:
+        esp._port.timeout = previous_timeout
+
+
+class VerifyResult:
+    """Outcome of verifying one region."""
+
+    def __init__(self, region, mode, ok, elapsed, detail=''):
+        self.name = region.name
+        self.address = region.address
+        self.mode = mode
+        self.ok = ok
+        self.elapsed = elapsed
+        self.detail = detail
+
+    def as_dict(self):
+        return dict(self.__dict__)
+
+    def __str__(self):
+        status = "OK" if self.ok else "FAILED"
+        detail = f" ({self.detail})" if self.detail else ""
+        return f"{self.name} at {self.address:#010x}: {status} by {self.mode}{detail}"
+
+
+def _verify_md5(esp, region):
+    flash_md5 = esp.flash_md5sum(region.address, len(region.data))
+    if flash_md5 == region.md5:
+        return True, ''
+    if flash_md5 == hashlib.md5(b'\xff' * len(region.data)).hexdigest():
+        return False, "region is empty"
+    return False, f"flash MD5 {flash_md5}, expected {region.md5}"
+
+
+def _verify_readback(esp, region):
+    first_mismatch = None
+    mismatched = 0
+    pos = 0
+    for chunk in stream_flash(esp, region.address, len(region.data)):
+        expected = region.data[pos:pos + len(chunk)]
+        if chunk != expected:
+            mismatched += 1
+            if first_mismatch is None:
+                first_mismatch = pos + next(i for i, (a, b) in enumerate(zip(chunk, expected)) if a != b)
+        pos += len(chunk)
+    if first_mismatch is None:
+        return True, ''
+    return False, f"{mismatched} chunk(s) differ, first at {region.address + first_mismatch:#010x}"
+
+
+def verify_regions(esp, regions, mode=VERIFY_MD5, log=print):
+    """
+    Check every region against the local data and return a VerifyResult per region.
+
+    All regions are checked even after a failure so the report is complete;
+    it is up to the caller to fail the job on a bad result.
+    """
+    if esp.secure_download_mode:
+        log("Cannot verify written data in secure download mode.")
+        return []
+    verify = _verify_readback if mode == VERIFY_READBACK else _verify_md5
+    results = []
+    for region in regions:
+        start = time.perf_counter()
+        ok, detail = verify(esp, region)
+        result = VerifyResult(region, mode, ok, time.perf_counter() - start, detail)
+        log(f"Verify {result}")
+        results.append(result)
+    return results
+
+
+def device_mac(esp):
+    """The base MAC as aa:bb:cc:dd:ee:ff, or None if it cannot be read (e.g. secure download mode)."""
+    try:
+        mac = esp.read_mac()
+    except FatalError:
+        return None
+    return ':'.join(f'{b:02x}' for b in mac) if mac else None
+
+
+def written_prefix(esp, region, upper):
+    """
+    Largest erase-block multiple up to upper whose prefix of region already matches the device.
+
+    The stub writes blocks after ACKing them, so a journaled prefix can run a
+    little ahead of the flash. Matching prefixes are monotonic, so a binary
+    search over flash_md5sum finds the real one in a handful of commands.
+    """
+    def matches(blocks):
+        size = min(blocks * ERASE_BLOCK_SIZE, len(region.data))
+        return esp.flash_md5sum(region.address, size) == hashlib.md5(region.data[:size]).hexdigest()
+
+    good, bad = 0, min(upper, len(region.data)) // ERASE_BLOCK_SIZE
+    if bad and matches(bad):
+        return bad * ERASE_BLOCK_SIZE
+    while bad - good > 1:
+        middle = (good + bad) // 2
+        if matches(middle):
+            good = middle
+        else:
+            bad = middle
+    return good * ERASE_BLOCK_SIZE
+
+
+def usb_identity(port):
+    """USB serial number and location of the adapter behind a port (None if unknown)."""
+    for info in list_ports.comports():
+        if info.device == port:
+            return info.serial_number, info.location
+    return None, None
+
+
+def link_type(esp):
+    """The kind of link to a connected loader, from the port's USB VID/PID (no device round trip)."""
+    if esp.uses_usb_jtag_serial():
+        return LINK_USB_JTAG_SERIAL
+    if esp.USB_OTG_SUPPORTED and esp.uses_usb_otg():
+        return LINK_USB_OTG
+    return LINK_UART
+
+
+def chip_key(esp):
+    """The CHIP_DEFS name of a connected loader, as accepted by connect_esp."""
+    for name, cls in CHIP_DEFS.items():
+        if cls.CHIP_NAME == esp.CHIP_NAME:
+            return name
+    return None
+
+
+def place_regions(esp, regions):
+    """Move bootloader regions to the connected chip's bootloader offset."""
+    placed = [
+        region.relocated(esp.BOOTLOADER_FLASH_OFFSET) if region.bootloader else region
+        for region in regions
+    ]
+    validate_regions(placed)
+    return placed
+
+
+def format_timings(timings):
+    return ", ".join(f"{name} {seconds:.2f} s" for name, seconds in timings.items())
+
+
+class FlashJob:
+    """
+    Connects to a device on one port and writes a set of regions to it.
+
+    regions is either a list of Region or a Preparation from ImagePreparer.
+    Per-phase wall times end up in self.timings.
+    """
+
+    def __init__(self, port, regions, chip='auto', baud=DEFAULT_BAUD,
+                 before='default-reset', after='hard-reset', verify=VERIFY_MD5, journal=None,
+                 port_health=None, device_cache=None, history=None, chip_cache=None,
+                 personalization=None, block_size=None, monitor_baud=None, boot_check=None,
+                 progress=None, log=print):
+        self.port = port
+        self.regions = regions
+        self.chip = chip
+        self.baud = baud
+        self.before = before
+        self.after = after
+        self.verify = verify
+        self.journal = journal  # FlashJournal, makes interrupted jobs resumable
+        self.port_health = port_health  # PortHealth, picks the start rate and records errors
+        self.device_cache = device_cache  # DeviceCache, skips regions the device already holds
+        self.history = history  # JobHistory, gets the record of every run
+        self.chip_cache = chip_cache  # ChipCache, skips auto-detection on known adapters
+        self.personalization = personalization  # PersonalizationFactory, adds a per-board NVS region
+        self.block_size = block_size  # Fixed write block size, measured from the link if None
+        self.monitor_baud = monitor_baud  # Keep monitoring the port at this rate after the reset
+        self.boot_check = boot_check  # BootCheck, fails the job if the board does not boot
+        self.handover = None  # The running SerialMonitor, with monitor_baud
+        self.boot = None  # BootResult
+        self.progress = progress  # Called with {'phase': name} per phase and {'written', 'total'} per block
+        self.log = log
+        self.timings = {}
+        self.verification = []  # VerifyResult per region, filled even when verification fails
+        self.mac = None
+        self.resumed_bytes = 0
+        self.skipped_regions = []
+        self.retries = 0
+        self.final_baud = None  # None on native USB links, where the rate does not apply
+        self.link = None  # LINK_UART, LINK_USB_JTAG_SERIAL or LINK_USB_OTG, set on connect
+        self.flash_size = None  # Bytes, detected on connect
+        self.chip_name = None
+        self.chip_description = None
+        self.round_trips = None  # RoundTripCounter of the current connection, from the stub on
+        self.usb_serial = None
+        self.usb_location = None
+        self.bytes_sent = 0  # On the wire, compressed, over all attempts
+        self.sizer = None  # BlockSizer of the write phase
+        self.started_at = None
+        self.finished_at = None
+        self.result = None
+        self.error = None
+        self._prepared = None
+        self._cancel = threading.Event()
+        self._esp = None  # Loader of the current connection, for abort()
+
+    @property
+    def record(self):
+        """Summary of the job for display and storage."""
+        return {
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'result': self.result,
+            'error': self.error,
+            'port': self.port,
+            'usb_serial': self.usb_serial,
+            'chip': self.chip_name or self.chip,
+            'chip_description': self.chip_description,
+            'baud': self.baud,
+            'mac': self.mac,
+            'images': [
+                {'address': r.address, 'name': r.name, 'size': len(r.data), 'md5': r.md5}
+                for r in self._prepared or []
+            ],
+            'bytes_sent': self.bytes_sent,
+            'resumed_bytes': self.resumed_bytes,
+            'skipped_regions': list(self.skipped_regions),
+            'retries': self.retries,
+            'final_baud': self.final_baud,
+            'link': self.link,
+            'write_params': self.sizer.params if self.sizer is not None else None,
+            'boot': self.boot.as_dict() if self.boot is not None else None,
+            'timings': dict(self.timings),
+            'verification': [r.as_dict() for r in self.verification],
+        }
+
+    def cancel(self):
+        """Ask the job to stop at its next block or phase boundary. Safe from any thread."""
+        self._cancel.set()
+
+    def abort(self):
+        """
+        Cancel, reset the board and close the port under the job, for a job that did not stop in time.
+
+        A job waiting on a device that stopped answering is blocked in a
+        serial read or write; pyserial retries a write the device does not
+        take for as long as it has to, so only closing the port ends it.
+        """
+        self.cancel()
+        esp = self._esp
+        if esp is None:
+            return
+        self.reset_cancelled(esp)
+        try:
+            esp._port.close()
+        except (OSError, SerialException):
+            pass
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def check_cancelled(self):
+        if self._cancel.is_set():
+            raise JobCancelled(f"Cancelled on {self.port}.")
+
+    def reset_cancelled(self, esp):
+        """Leave a cancelled job's board running its firmware instead of a half-finished command."""
+        if not esp._port.is_open:
+            return  # Aborted, and reset then
+        try:
+            reset_chip(esp, 'hard-reset')
+        except (OSError, SerialException, FatalError) as e:
+            self.log(f"Could not reset the board after cancelling: {e}")
+            return
+        self.log("Cancelled, the board was reset.")
+
+    @contextmanager
+    def phase(self, name):
+        self.check_cancelled()
+        if self.progress is not None:
+            self.progress({'phase': name})
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - start
+
+    def prepare(self):
+        """Return loaded, compressed and validated regions."""
+        if isinstance(self.regions, Preparation):
+            regions = self.regions.wait()
+        else:
+            with ThreadPoolExecutor(thread_name_prefix='prepare-segment') as executor:
+                regions = [region.prepare(executor) for region in self.regions]
+            validate_regions(regions)
+        self._prepared = regions
+        return regions
+
+    def connect(self, baud=None):
+        """
+        Connect, start the stub and attach the flash.
+
+        On the chip's own USB peripheral the rate is ignored and each command
+        costs USB frames rather than bits, so the baud rate change and the
+        settling delay after it are skipped there.
+        """
+        baud = baud or self.baud
+        initial_baud = min(ESPLoader.ESP_ROM_BAUD, baud)
+        esp = self._connect_chip(initial_baud)
+        self._esp = esp
+        link = link_type(esp)
+        if link != self.link and link != LINK_UART:
+            self.log(f"Native USB link ({link}), skipping the baud rate change.")
+        self.link = link
+        esp = run_stub(esp)
+        # Installed on the loader run_stub returns, it copies the ROM loader's attributes
+        if not send_blocks_untraced(esp) and self.round_trips is None:
+            self.log("esptool's command() is not the one this engine knows, data blocks go through it as they are.")
+        self.round_trips = RoundTripCounter(esp)
+        if self.native_usb:
+            self.final_baud = None
+        else:
+            if baud > initial_baud:
+                esp.change_baud(baud)
+            self.final_baud = baud
+        # From here on each eFuse word is read at most once, whichever getter asks first
+        snapshot_efuses(esp)
+        attach_flash(esp)
+        if not esp.secure_download_mode:
+            flash_size = detect_flash_size(esp)
+            if flash_size is not None:
+                self.flash_size = flash_size_bytes(flash_size)
+                esp.flash_set_parameters(self.flash_size)
+        return esp
+
+    @property
+    def native_usb(self):
+        return self.link in (LINK_USB_JTAG_SERIAL, LINK_USB_OTG)
+
+    def _connect_chip(self, initial_baud):
+        """Connect as the chip cached for this adapter if any, detecting it otherwise."""
+        key = self.usb_serial or self.usb_location
+        chip = self.chip
+        if chip == 'auto' and self.chip_cache is not None:
+            chip = self.chip_cache.lookup(key) or 'auto'
+        try:
+            esp = connect_esp(port=self.port, chip=chip, initial_baud=initial_baud, before=self.before)
+        except FatalError as e:
+            # esptool checks the chip ID even when the chip is named, so a
+            # different board behind a known adapter ends up here
+            if chip == self.chip or 'chip argument' not in str(e):
+                raise
+            self.log(f"Cached chip {chip} does not match ({e}), detecting the chip again...")
+            self.chip_cache.forget(key)
+            esp = connect_esp(port=self.port, chip='auto', initial_baud=initial_baud, before=self.before)
+        if self.chip == 'auto' and self.chip_cache is not None:
+            self.chip_cache.store(key, chip_key(esp))
+        return esp
+
+    def resume(self, esp, regions):
+        """
+        Open the device's journal and find how much of each region is already written.
+
+        Returns the journal entry (or None) and the start offset per region address.
+        """
+        if self.journal is None or self.mac is None or esp.secure_download_mode:
+            return None, {}
+        entry = self.journal.open(self.mac, regions)
+        offsets = {}
+        for region in regions:
+            acked = entry.resumable.get(region.address)
+            # Resuming mid-region must not erase the start of a sector already written
+            if acked and region.address % esp.FLASH_SECTOR_SIZE == 0:
+                offset = written_prefix(esp, region, acked)
+                entry.update(region.address, offset)
+                if offset:
+                    offsets[region.address] = offset
+        self.resumed_bytes = sum(offsets.values())
+        if self.resumed_bytes:
+            self.log(f"Resuming on {self.mac}: {self.resumed_bytes} bytes already on the device are skipped.")
+        return entry, offsets
+
+    def check_cache(self, esp, regions):
+        """
+        Find regions the device already holds according to the device cache.
+
+        A cache hit is confirmed with an on-device MD5 before the region is
+        skipped; a miss costs nothing. Returns a VerifyResult per skipped region.
+        """
+        if self.device_cache is None or self.mac is None or esp.secure_download_mode:
+            return []
+        cached = self.device_cache.lookup(self.mac)
+        confirmed = []
+        for region in regions:
+            if cached.get(region.address) != (len(region.data), region.md5):
+                continue
+            start = time.perf_counter()
+            ok, _ = _verify_md5(esp, region)
+            if ok:
+                confirmed.append(VerifyResult(region, 'cached md5', True, time.perf_counter() - start))
+        if confirmed:
+            self.log(f"{self.mac} already holds {', '.join(r.name for r in confirmed)}, skipping the write.")
+        return confirmed
+
+    def write(self, esp, regions, entry, start_offsets):
+        """
+        Write the regions, retrying after serial errors. Returns the (possibly new) loader.
+
+        After an error the device is reconnected one rung lower on the baud
+        ladder (at the same settings on native USB, where there is no rate to
+        lower), regions that were already completely sent are left alone and
+        the failed one continues from its verified prefix.
+        """
+        ladder = baud_ladder(self.final_baud or self.baud)
+        if self.sizer is None:
+            self.sizer = BlockSizer(esp.FLASH_WRITE_SIZE, self.block_size, log=self.log)
+        done = set()
+        acked = dict(start_offsets)
+        total = sum(len(region.data) for region in regions)
+
+        def progress(segment, segment_acked):
+            address = segment.region.address
+            acked[address] = segment.offset + segment_acked
+            if entry is not None:
+                entry.update(address, acked[address])
+            if self.progress is not None:
+                self.progress({'written': sum(acked.values()), 'total': total})
+            if segment_acked >= segment.raw_size:
+                self.bytes_sent += len(segment.payload)
+                if segment.last:
+                    done.add(address)
+            # The journal has this block, so a cancelled job resumes right after it
+            self.check_cancelled()
+
+        for attempt in range(1, WRITE_ATTEMPTS + 1):
+            pending = [region for region in regions if region.address not in done]
+            try:
+                write_regions(esp, pending, log=self.log, start_offsets=start_offsets, progress=progress,
+                              sizer=self.sizer)
+            except (SerialException, FatalError) as e:
+                # An aborted read looks like a serial error, but it is not the port's fault
+                self.check_cancelled()
+                self._record_outcome(False)
+                if attempt == WRITE_ATTEMPTS:
+                    raise
+                failed = next((r for r in pending if r.address not in done), None)
+                if failed is None:
+                    # Every block was sent, so the finishing command failed: the last region's tail
+                    # may not have reached the flash, it is rechecked and sent again
+                    failed = max(pending, key=lambda r: r.address)
+                    done.discard(failed.address)
+                baud = ladder[min(attempt, len(ladder) - 1)]
+                delay = min(RETRY_BACKOFF * 2 ** (attempt - 1), MAX_RETRY_BACKOFF)
+                if self.native_usb:
+                    baud = self.baud
+                    self.log(f"Writing {failed.name} failed ({e}), retrying in {delay:.1f} s...")
+                else:
+                    self.log(f"Writing {failed.name} failed ({e}), retrying at {baud} baud in {delay:.1f} s...")
+                self.retries += 1
+                self.sizer.write_failed()
+                esp._port.close()
+                if self._cancel.wait(delay):
+                    raise JobCancelled(f"Cancelled on {self.port}.")
+                esp = self.connect(baud)
+                # Regions that did not start yet keep their journal offsets, only the failed one is rechecked
+                start_offsets = dict(start_offsets)
+                start_offsets.pop(failed.address, None)
+                if failed.address % esp.FLASH_SECTOR_SIZE == 0 and acked.get(failed.address):
+                    start_offsets[failed.address] = written_prefix(esp, failed, acked[failed.address])
+                continue
+            self._record_outcome(True)
+            return esp
+
+    def _record_outcome(self, ok):
+        if self.port_health is not None and not self.native_usb:
+            self.port_health.record(self.port, self.final_baud, ok)
+
+    def run(self):
+        """
+        Connect and prepare the images at the same time, then write and verify.
+
+        Reset, sync and stub upload are pure latency while hashing and
+        compression are pure CPU, so the two only join right before the first
+        flash_begin. The time this saves is reported as overlap_saved.
+        Successful or not, the job's record is handed to the job history.
+        A cancelled job raises JobCancelled, whatever it was doing when it
+        noticed.
+        """
+        self.started_at = time.time()
+        try:
+            self._run()
+            self.result = 'ok'
+        except BaseException as e:
+            if self.cancelled:
+                self.result, self.error = 'cancelled', f"Cancelled on {self.port}."
+                if isinstance(e, JobCancelled):
+                    raise
+                raise JobCancelled(self.error) from e
+            self.result, self.error = 'failed', str(e) or type(e).__name__
+            raise
+        finally:
+            self.finished_at = time.time()
+            if self.history is not None:
+                self.history.add(self.record)
+
+    def _run(self):
+        self.timings = {}
+        self.usb_serial, self.usb_location = usb_identity(self.port)
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='prepare')
+        prepared = executor.submit(self._timed, 'prepare', self.prepare)
+        executor.shutdown(wait=False)
+        baud = self.baud
+        if self.port_health is not None:
+            baud = self.port_health.start_baud(self.port, self.baud)
+            if baud != self.baud:
+                self.log(f"{self.port} has been unreliable at higher rates lately, starting at {baud} baud.")
+        try:
+            with self.phase('connect'):
+                esp = self.connect(baud)
+        except BaseException:
+            prepared.cancel()
+            raise
+        try:
+            with self.phase('prepare_wait'):
+                regions = prepared.result()
+            self.timings['overlap_saved'] = max(self.timings['prepare'] - self.timings['prepare_wait'], 0.0)
+            if isinstance(self.regions, Preparation):
+                self.log(f"Images prepared in {self.regions.elapsed:.2f} s ahead of the job.")
+            self.chip_name = esp.CHIP_NAME
+            self.chip_description = chip_summary(esp)
+            self.mac = device_mac(esp)
+            if self.round_trips is not None:
+                self.log(
+                    f"Connected to {self.chip_description}, MAC {self.mac} "
+                    f"({self.round_trips.count} round trips since the stub started)."
+                )
+            if self.personalization is not None:
+                if self.mac is None:
+                    raise FatalError("Personalization needs the MAC address, which could not be read.")
+                table = next((r.data for r in regions if r.data[:2] == PARTITION_TABLE_MAGIC), None)
+                regions = regions + [self.personalization.claim(self.mac, table).prepare()]
+            placed = place_regions(esp, regions)
+            for region, placed_region in zip(regions, placed):
+                if placed_region is not region:
+                    self.log(f"{region.name} goes to {placed_region.address:#x} on {esp.CHIP_NAME}.")
+            regions = self._prepared = placed
+            with self.phase('cache_check'):
+                cached = self.check_cache(esp, regions)
+            self.skipped_regions = [r.name for r in cached]
+            skipped = {r.address for r in cached}
+            pending = [region for region in regions if region.address not in skipped]
+            try:
+                if pending:
+                    with self.phase('resume_check'):
+                        entry, start_offsets = self.resume(esp, pending)
+                    with self.phase('write'):
+                        esp = self.write(esp, pending, entry, start_offsets)
+                # A readback audit covers the skipped regions too, an MD5 check already did
+                to_verify = regions if self.verify == VERIFY_READBACK else pending
+                with self.phase('verify'):
+                    self.verification = verify_regions(esp, to_verify, self.verify, log=self.log)
+                if self.verify != VERIFY_READBACK:
+                    self.verification = cached + self.verification
+                failed = [r.name for r in self.verification if not r.ok]
+                if failed:
+                    raise FatalError(f"Verification failed for {', '.join(failed)}!")
+            except BaseException:
+                if self.device_cache is not None and self.mac is not None and pending:
+                    self.device_cache.forget(self.mac)
+                raise
+            if pending and entry is not None:
+                entry.discard()
+            if self.device_cache is not None and self.mac is not None:
+                # Only what identifies each image, the cache may be a stand-in in another process
+                self.device_cache.store(self.mac, [(r.address, len(r.data), r.md5) for r in regions])
+            if self.personalization is not None:
+                self.personalization.commit(self.mac)
+            self.reset_and_watch(esp)
+        except BaseException:
+            if self.cancelled:
+                # write() may have reconnected, self._esp is the loader on the open port
+                self.reset_cancelled(self._esp or esp)
+            raise
+        finally:
+            if self.handover is None:
+                (self._esp or esp)._port.close()
+            self._esp = None
+        self.log(f"Phase timings: {format_timings(self.timings)}.")
+
+    def reset_and_watch(self, esp):
+        """
+        Reset the board, then monitor and boot-check it on the same open port if asked to.
+
+        The monitor starts on the port the job used, so nothing the board
+        prints after the reset is lost to a reopen.
+        """
+        baud = self.monitor_baud or (self.boot_check.baud if self.boot_check is not None else None)
+        if baud and not self.native_usb:
+            # A UART hard reset only toggles lines, so the first boot byte already arrives at the new rate
+            esp._set_port_baudrate(baud)
+        reset_chip(esp, self.after)
+        reset_at = time.perf_counter()
+        if not baud:
+            return
+        monitor = SerialMonitor(esp._port, baud, log=self.log).start()
+        if self.monitor_baud:
+            self.handover = monitor
+        try:
+            if self.boot_check is not None:
+                with self.phase('boot'):
+                    self.boot = self.boot_check.run(monitor.ring, reset_at, log=self.log)
+        finally:
+            if self.handover is None:
+                monitor.stop()
+        if self.boot is not None and not self.boot.ok:
+            raise FatalError(str(self.boot))
+
+    def _timed(self, name, fn):
+        with self.phase(name):
+            return fn()
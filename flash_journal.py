@@ -0,0 +1,72 @@
+"""
+Journal of acknowledged flash writes, kept per device so an interrupted job can resume.
+
+One small JSON file per MAC address records, for every region of the running
+job, the image MD5 and how many bytes (rounded down to a 64 KB erase block)
+the device has acknowledged. A finished job deletes its file.
+"""
+import json
+import os
+import threading
+
+ERASE_BLOCK_SIZE = 0x10000
+
+
+class JournalEntry:
+    """The journal of one job on one device."""
+
+    def __init__(self, path, mac, regions, previous):
+        self.path = path
+        self.mac = mac
+        self._lock = threading.Lock()
+        self._regions = {}
+        for region in regions:
+            old = previous.get(str(region.address), {})
+            acked = old.get('acked', 0) if old.get('md5') == region.md5 else 0
+            self._regions[str(region.address)] = {'md5': region.md5, 'acked': acked}
+        # What the previous attempt left behind, before this job overwrites it
+        self.resumable = {int(a): r['acked'] for a, r in self._regions.items() if r['acked']}
+        self._save()
+
+    def update(self, address, acked):
+        """Record that the first acked bytes of the region at address were ACKed."""
+        acked -= acked % ERASE_BLOCK_SIZE
+        with self._lock:
+            entry = self._regions[str(address)]
+            if acked == entry['acked']:
+                return
+            entry['acked'] = acked
+            self._save()
+
+    def _save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'mac': self.mac, 'regions': self._regions}, f)
+        os.replace(tmp, self.path)
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class FlashJournal:
+    """Directory of per-device journals."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, mac):
+        return os.path.join(self.directory, mac.replace(':', '') + '.json')
+
+    def open(self, mac, regions):
+        """Start journaling a job, keeping progress of an earlier attempt with the same images."""
+        path = self._path(mac)
+        try:
+            with open(path) as f:
+                previous = json.load(f).get('regions', {})
+        except (OSError, ValueError):
+            previous = {}
+        return JournalEntry(path, mac, regions, previous)
@@ -0,0 +1,547 @@
+"""
+Flash jobs in reusable worker processes, reporting over a pipe with typed messages.
+
+A job run on a thread of the GUI shares the GIL with the GUI, and esptool's
+output could only be captured by swapping the process-wide sys.stdout,
+which mixes the output of jobs running side by side. Here each job runs in
+a worker process of its own: esptool's per-block protocol work runs on its
+own core, a crash takes down one worker instead of the station, and the
+worker's stdout only ever carries the output of its one job.
+
+The worker sends LogLine, Phase and Progress messages while the job runs
+and a Result with its state, record and phase timings at the end. Stores
+shared with the rest of the station (port health, chip and device caches,
+job history, personalization) stay in the parent: the job in the worker
+gets stand-ins whose method calls travel over the pipe as Call messages and
+are answered with a Reply. Only the flash journal, written after every
+block, is opened by the worker itself; it is a file per device, and a
+device only ever has one job.
+
+Workers are started once and reused, so a job costs neither a process
+spawn nor esptool's import. Prepared images are sent once per worker and
+referred to by key afterwards.
+
+RemoteJob stands in for the job on the parent's side. It has a port and a
+run() that blocks until the worker is done, so JobScheduler and HubLimits
+handle it like a FlashJob, cancel() and abort() included.
+"""
+import itertools
+import multiprocessing
+import queue
+import sys
+import threading
+import time
+
+import serial
+from esptool.util import FatalError
+
+from boot_check import reset_and_monitor
+from flash_backup import BackupJob, SectorStore, SnapshotJob
+from flash_engine import DEFAULT_BAUD, FlashJob, JobCancelled
+from flash_journal import FlashJournal
+from job_queue import CANCELLED, DONE, FAILED
+from serial_monitor import SerialMonitor
+
+JOB_CLASSES = {cls.__name__: cls for cls in (FlashJob, BackupJob, SnapshotJob)}
+# Job attributes sent back with the Result and set on the RemoteJob
+RESULT_ATTRIBUTES = ('verification', 'boot', 'path', 'mac', 'chip_name', 'timings', 'retries', 'bytes_sent')
+SPAWN_TIMEOUT = 30  # Seconds a new worker gets to import everything and say it is ready
+STOP_TIMEOUT = 2.0  # Seconds shutdown() waits for a worker to exit before it is terminated
+
+_job_ids = itertools.count(1)  # Never reused, unlike id(), so a late message cannot reach a newer job
+
+
+class Run:
+    """Parent to worker: run a job. regions holds (key, Region or None if the worker has it)."""
+
+    def __init__(self, job_id, kind, port, regions, options, stores):
+        self.job_id = job_id
+        self.kind = kind
+        self.port = port
+        self.regions = regions
+        self.options = options
+        self.stores = stores  # Names of the stores the parent answers calls for
+
+
+class Cancel:
+    """Parent to worker: stop the job at its next boundary, or abort it right away."""
+
+    def __init__(self, job_id, abort=False):
+        self.job_id = job_id
+        self.abort = abort
+
+
+class Call:
+    """Worker to parent: call a method of a store the parent holds."""
+
+    def __init__(self, job_id, store, method, args, kwargs):
+        self.job_id = job_id
+        self.store = store
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+
+
+class Reply:
+    """Parent to worker: what a Call returned, or the error it raised."""
+
+    def __init__(self, job_id, value=None, error=None):
+        self.job_id = job_id
+        self.value = value
+        self.error = error
+
+
+class LogLine:
+    def __init__(self, job_id, text):
+        self.job_id = job_id
+        self.text = text
+
+
+class Phase:
+    def __init__(self, job_id, name):
+        self.job_id = job_id
+        self.name = name
+
+
+class Progress:
+    def __init__(self, job_id, written, total):
+        self.job_id = job_id
+        self.written = written
+        self.total = total
+
+
+class Result:
+    """Worker to parent: the job is over. state is DONE, FAILED or CANCELLED."""
+
+    def __init__(self, job_id, state, error, record, attributes):
+        self.job_id = job_id
+        self.state = state
+        self.error = error
+        self.record = record
+        self.attributes = attributes
+
+
+class Ready:
+    """Worker to parent, once: imports are done and jobs can come."""
+
+
+class _Sender:
+    """The worker's end of the pipe, shared by the job thread and the output writer."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.job_id = None
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.conn.send(message)
+
+
+class _OutputWriter:
+    """The worker's sys.stdout and sys.stderr: whole lines go to the parent as LogLine."""
+
+    def __init__(self, sender):
+        self.sender = sender
+        self._partial = ''
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            lines = (self._partial + str(text)).replace('\r', '\n').split('\n')
+            self._partial = lines.pop()
+        for line in lines:
+            if line.strip():
+                self.sender.send(LogLine(self.sender.job_id, line.rstrip()))
+
+    def flush(self):
+        pass
+
+    def flush_line(self):
+        with self._lock:
+            line, self._partial = self._partial, ''
+        if line.strip():
+            self.sender.send(LogLine(self.sender.job_id, line.rstrip()))
+
+
+class _RemoteStore:
+    """Stands in for a store of the parent: every method call is a Call answered by a Reply."""
+
+    def __init__(self, name, sender, replies):
+        self._name = name
+        self._sender = sender
+        self._replies = replies
+
+    def __getattr__(self, method):
+        def call(*args, **kwargs):
+            self._sender.send(Call(self._sender.job_id, self._name, method, args, kwargs))
+            reply = self._replies.get()
+            if reply.error is not None:
+                raise FatalError(f"{self._name}.{method} failed: {reply.error}")
+            return reply.value
+        return call
+
+
+def _build_job(message, regions, sender, replies):
+    options = dict(message.options)
+    for name in message.stores:
+        options[name] = _RemoteStore(name, sender, replies)
+    if 'journal' in options:
+        options['journal'] = FlashJournal(options['journal'])
+    if message.kind == 'SnapshotJob':
+        return SnapshotJob(message.port, SectorStore(options.pop('store')), **options)
+    if message.kind == 'BackupJob':
+        return BackupJob(message.port, options.pop('path'), **options)
+    return JOB_CLASSES[message.kind](message.port, regions, **options)
+
+
+def _run_job(job, sender, output):
+    try:
+        job.run()
+        state, error = DONE, None
+    except JobCancelled as e:
+        state, error = CANCELLED, str(e)
+    except BaseException as e:
+        state, error = FAILED, str(e) or type(e).__name__
+    output.flush_line()
+    attributes = {name: getattr(job, name) for name in RESULT_ATTRIBUTES if hasattr(job, name)}
+    try:
+        sender.send(Result(sender.job_id, state, error, job.record, attributes))
+    except Exception as e:
+        # Something in the record did not pickle; the outcome still has to get through
+        sender.send(Result(sender.job_id, state, error or f"Could not send the job record: {e}", None, {}))
+
+
+def worker_main(conn):
+    """Body of a worker process: run the jobs the parent sends, one at a time, until told to stop."""
+    sender = _Sender(conn)
+    output = _OutputWriter(sender)
+    sys.stdout = sys.stderr = output
+    replies = queue.Queue()
+    regions = {}  # key -> prepared Region, for the images of the last job
+    job = None
+    sender.send(Ready())
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+        if message is None:
+            break
+        if isinstance(message, Run):
+            regions = {key: region if region is not None else regions[key] for key, region in message.regions}
+            sender.job_id = message.job_id
+
+            def log(text, job_id=message.job_id):
+                sender.send(LogLine(job_id, text))
+
+            def progress(info, job_id=message.job_id):
+                if 'phase' in info:
+                    sender.send(Phase(job_id, info['phase']))
+                else:
+                    sender.send(Progress(job_id, info['written'], info['total']))
+
+            try:
+                job = _build_job(message, list(regions.values()), sender, replies)
+            except Exception as e:
+                sender.send(Result(message.job_id, FAILED, f"Could not start the job: {e}", None, {}))
+                continue
+            job.log = log
+            job.progress = progress
+            threading.Thread(target=_run_job, args=(job, sender, output), daemon=True).start()
+        elif isinstance(message, Cancel):
+            if job is not None and message.job_id == sender.job_id:
+                job.abort() if message.abort else job.cancel()
+        elif isinstance(message, Reply):
+            replies.put(message)
+
+
+class Worker:
+    """A worker process and the parent's end of its pipe."""
+
+    def __init__(self, context):
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=worker_main, args=(child,), name='flash-worker', daemon=True)
+        self.process.start()
+        child.close()
+        self.regions = set()  # Keys of the prepared regions the worker holds
+        self.ready = False
+        self._lock = threading.Lock()
+
+    def send(self, message):
+        with self._lock:
+            self.conn.send(message)
+
+    def wait_ready(self):
+        if self.ready:
+            return
+        if not self.conn.poll(SPAWN_TIMEOUT) or not isinstance(self.conn.recv(), Ready):
+            raise FatalError("A flash worker process did not start.")
+        self.ready = True
+
+    @property
+    def alive(self):
+        return self.process.is_alive()
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        try:
+            self.send(None)
+        except (OSError, ValueError):
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(timeout)
+        self.conn.close()
+
+
+class WorkerPool:
+    """
+    Worker processes, started on demand and reused for later jobs.
+
+    Workers are spawned rather than forked, so they start clean of the
+    parent's threads and GUI state. warm() starts some ahead of the first job.
+    """
+
+    def __init__(self, max_idle=4, log=print):
+        self.max_idle = max_idle
+        self.log = log
+        self._context = multiprocessing.get_context('spawn')
+        self._idle = []
+        self._busy = set()
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def warm(self, count):
+        with self._lock:
+            while len(self._idle) < count and not self._closed:
+                self._idle.append(Worker(self._context))
+
+    def acquire(self):
+        with self._lock:
+            if self._closed:
+                raise FatalError("The worker pool is shut down.")
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.alive:
+                    break
+                self.log(f"A flash worker exited while idle (code {worker.process.exitcode}).")
+                worker.stop()
+            else:
+                worker = Worker(self._context)
+            self._busy.add(worker)
+        try:
+            worker.wait_ready()
+        except BaseException:
+            self.discard(worker)
+            raise
+        return worker
+
+    def release(self, worker):
+        with self._lock:
+            self._busy.discard(worker)
+            if not self._closed and worker.alive and len(self._idle) < self.max_idle:
+                self._idle.append(worker)
+                return
+        worker.stop()
+
+    def discard(self, worker):
+        """Drop a worker that broke or was left in an unknown state."""
+        with self._lock:
+            self._busy.discard(worker)
+        worker.stop()
+
+    def shutdown(self):
+        """Stop every worker, terminating those that do not exit in time."""
+        with self._lock:
+            self._closed = True
+            workers = self._idle + list(self._busy)
+            self._idle = []
+        for worker in workers:
+            worker.stop()
+
+
+class RemoteJob:
+    """
+    A FlashJob, BackupJob or SnapshotJob run in a worker process.
+
+    kind is the class name. regions (a Preparation or a list of prepared
+    Region) is only used by FlashJob. stores maps names of the job's store
+    arguments (port_health, device_cache, ...) to the parent's objects, which
+    answer the job's calls. journal and store are directories, opened by the
+    worker. The other options are passed to the job's constructor as they
+    are. log and progress are called on the thread that runs the job here.
+
+    A monitor cannot cross processes, so with monitor_baud the worker leaves
+    the board in the bootloader and the reset happens here, on a port the
+    monitor already has open: the first boot line still makes it to the view,
+    and a boot check runs here on the monitor's buffer. The record goes to
+    the history from here too, once it has the boot result.
+    """
+
+    def __init__(self, pool, kind, port, regions=None, stores=None, log=print, progress=None, monitor_baud=None,
+                 **options):
+        if kind not in JOB_CLASSES:
+            raise ValueError(f"Unknown job kind {kind}.")
+        self.pool = pool
+        self.job_id = next(_job_ids)
+        self.kind = kind
+        self.port = port
+        self.regions = regions
+        self.stores = dict(stores or {})
+        self.history = self.stores.pop('history', None)
+        self.options = options
+        self.baud = options.get('baud', DEFAULT_BAUD)
+        self.monitor_baud = monitor_baud
+        self.boot_check = None
+        self.reset_here = monitor_baud is not None and options.get('after', 'hard-reset') == 'hard-reset'
+        if self.reset_here:
+            self.options['after'] = 'no-reset'
+            self.boot_check = self.options.pop('boot_check', None)
+        self.log = log
+        self.progress = progress
+        self.record = None
+        self.result = None
+        self.error = None
+        self.verification = []
+        self.timings = {}
+        self.boot = None
+        self.handover = None  # The running SerialMonitor, with monitor_baud
+        self.path = options.get('path')
+        self._cancel = threading.Event()
+        self._abort = threading.Event()
+        self._worker = None
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        self._signal(abort=False)
+
+    def abort(self):
+        self._signal(abort=True)
+
+    def _signal(self, abort):
+        with self._lock:
+            self._cancel.set()
+            if abort:
+                self._abort.set()
+            worker = self._worker
+        if worker is not None:
+            try:
+                worker.send(Cancel(self.job_id, abort))
+            except (OSError, ValueError):
+                pass
+
+    def _region_messages(self, worker):
+        if self.kind != 'FlashJob':
+            return []
+        regions = self.regions.wait() if hasattr(self.regions, 'wait') else self.regions
+        messages = []
+        for region in regions:
+            key = region.key
+            messages.append((key, None if key in worker.regions else region))
+        worker.regions = {key for key, _ in messages}
+        return messages
+
+    def run(self):
+        if self.cancelled:
+            raise JobCancelled(f"Cancelled on {self.port}.")
+        worker = self.pool.acquire()
+        try:
+            message = Run(self.job_id, self.kind, self.port, self._region_messages(worker), self.options,
+                          list(self.stores))
+            worker.send(message)
+            with self._lock:
+                self._worker = worker
+                pending = self._abort.is_set() and 'abort' or self._cancel.is_set() and 'cancel'
+            if pending:
+                # Cancelled while the worker was being set up
+                worker.send(Cancel(self.job_id, pending == 'abort'))
+            result = self._serve(worker)
+        except BaseException:
+            with self._lock:
+                self._worker = None
+            self.pool.discard(worker)
+            if self.cancelled:
+                raise JobCancelled(f"Cancelled on {self.port}.")
+            raise
+        with self._lock:
+            self._worker = None
+        self.pool.release(worker)
+        self.record = result.record
+        for name, value in result.attributes.items():
+            setattr(self, name, value)
+        self.result = {DONE: 'ok', FAILED: 'failed', CANCELLED: 'cancelled'}[result.state]
+        self.error = result.error
+        try:
+            if result.state == CANCELLED:
+                raise JobCancelled(result.error)
+            if result.state == FAILED:
+                raise FatalError(result.error)
+            if self.monitor_baud is not None:
+                self.watch()
+        except FatalError as e:
+            self._update_record(result='failed', error=str(e))
+            raise
+        finally:
+            if self.history is not None and self.record is not None:
+                self.history.add(self.record)
+
+    def watch(self):
+        """Start the monitor for monitor_baud, before the reset and the boot check if the worker left those to us."""
+        if not self.reset_here:
+            try:
+                self.handover = SerialMonitor(self.port, self.monitor_baud, log=self.log).start()
+            except (serial.SerialException, OSError) as e:
+                self.log(f"Could not monitor {self.port}: {e}")
+            return
+        try:
+            self.handover, reset_at = reset_and_monitor(self.port, self.monitor_baud, log=self.log)
+        except (serial.SerialException, OSError) as e:
+            raise FatalError(f"Could not reset {self.port} into the monitor: {e}")
+        if self.boot_check is None:
+            return
+        if self.progress is not None:
+            self.progress({'phase': 'boot'})
+        start = time.perf_counter()
+        self.boot = self.boot_check.run(self.handover.ring, reset_at, log=self.log)
+        self.timings['boot'] = self.timings.get('boot', 0.0) + time.perf_counter() - start
+        self._update_record(boot=self.boot.as_dict(), timings=dict(self.timings))
+        if not self.boot.ok:
+            raise FatalError(str(self.boot))
+
+    def _update_record(self, **fields):
+        if 'result' in fields:
+            self.result, self.error = fields['result'], fields['error']
+        if self.record is not None:
+            self.record.update(fields)
+
+    def _serve(self, worker):
+        """Relay the worker's messages until its Result."""
+        while True:
+            try:
+                message = worker.conn.recv()
+            except (EOFError, OSError):
+                raise FatalError(f"The flash worker for {self.port} exited (code {worker.process.exitcode}).")
+            if getattr(message, 'job_id', None) != self.job_id:
+                continue  # Left over from an earlier job of the worker
+            if isinstance(message, LogLine):
+                self.log(message.text)
+            elif isinstance(message, Phase):
+                if self.progress is not None:
+                    self.progress({'phase': message.name})
+            elif isinstance(message, Progress):
+                if self.progress is not None:
+                    self.progress({'written': message.written, 'total': message.total})
+            elif isinstance(message, Call):
+                try:
+                    value = getattr(self.stores[message.store], message.method)(*message.args, **message.kwargs)
+                    reply = Reply(message.job_id, value)
+                except Exception as e:
+                    reply = Reply(message.job_id, error=str(e) or type(e).__name__)
+                worker.send(reply)
+            elif isinstance(message, Result):
+                return message
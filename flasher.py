@@ -1,14 +1,32 @@
 import sys
 import os
+import re
 import time
+import codecs
+import multiprocessing
 import serial.tools.list_ports
 from PySide6.QtWidgets import (
     QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
     QGroupBox, QLabel, QComboBox, QPushButton, QProgressBar, QMessageBox,
-    QFileDialog, QTextEdit
+    QFileDialog, QTextEdit, QPlainTextEdit, QCheckBox, QLineEdit, QSpinBox,
+    QTableWidget, QTableWidgetItem, QAbstractItemView, QHeaderView
 )
-from PySide6.QtCore import QThread, Signal, QObject, Slot
-from PySide6.QtGui import QFont
+from PySide6.QtCore import Qt, QThread, Signal, QObject, Slot, QTimer, QItemSelectionModel
+from PySide6.QtGui import QFont, QTextCursor
+
+import flash_engine
+from artifact_store import ArtifactStore
+from boot_check import BootCheck
+from chip_cache import ChipCache
+from device_cache import DeviceCache
+from flash_journal import FlashJournal
+from flash_workers import RemoteJob, WorkerPool
+from job_queue import JobScheduler, DEFAULT_CONCURRENCY, PENDING, RUNNING, DONE, FAILED, CANCELLED
+from hub_limits import HubLimits
+from job_history import JobHistory
+from personalization import PersonalizationFactory
+from port_health import PortHealth
+from serial_monitor import SerialMonitor
 
 # Determine the base path for resources (like the 'bin' directory)
 if getattr(sys, 'frozen', False) and hasattr(sys, '_MEIPASS'):
@@ -20,63 +38,20 @@ else:
     base_path = os.path.dirname(os.path.abspath(__file__))
 
 BIN_DIR = os.path.join(base_path, 'bin')  # Directory where the binary files are located
+BACKUP_DIR = os.path.join(base_path, 'backups')  # Default location for flash backups
+PERSONALIZATION_DIR = os.path.join(base_path, 'personalization')  # template.csv + identities, optional
+STATE_DIR = os.path.join(base_path, 'state')  # Journals and caches kept between runs
+LOG_DIR = os.path.join(base_path, 'logs')  # Serial monitor logs, rotated at 10 MB
 
-class StdoutEmitter(QObject):
-    textWritten = Signal(str)
-
-    def write(self, text):
-        self.textWritten.emit(str(text))
-
-    def flush(self):
-        pass
-
-class EsptoolWorker(QObject):
-    """
-    Worker thread for running esptool as a Python library to avoid freezing the GUI.
-    """
-    output = Signal(str)
-    finished = Signal(int)
-
-    def __init__(self, args):
-        super().__init__()
-        self.args = args
-
-    def run(self):
-        """
-        Executes the esptool command by calling its main function and
-        redirecting stdout to capture output in real-time.
-        """
-        original_stdout = sys.stdout
-        original_stderr = sys.stderr
-        
-        emitter = StdoutEmitter()
-        # Connect the emitter's signal to the worker's output signal
-        emitter.textWritten.connect(lambda text: self.output.emit(text.strip()))
-
-        sys.stdout = emitter
-        sys.stderr = emitter
-        
-        exit_code = 0
-        try:
-            import esptool
-            esptool.main(self.args)
-        except SystemExit as e:
-            # esptool calls sys.exit() on completion. 0 is success.
-            exit_code = e.code if e.code is not None else 0
-        except Exception as e:
-            # Print any other exceptions to our redirected output
-            print(f"An error occurred while running esptool:\n{str(e)}")
-            exit_code = 1
-        finally:
-            # Always restore the original stdout/stderr
-            sys.stdout = original_stdout
-            sys.stderr = original_stderr
-
-        self.finished.emit(exit_code)
-
-    def stop(self):
-        pass
+MONITOR_BAUDS = [115200, 460800, 921600, 2000000]
+MONITOR_FPS = 30
+MONITOR_FRAME_BYTES = 64 * 1024  # Shown per frame at most; the log file still gets everything
+MONITOR_LINES = 5000  # Kept in the monitor view
 
+HIGH_PRIORITY = 10  # Queued ahead of normal jobs
+QUEUE_REFRESH = 250  # Milliseconds between queue view updates while it changes
+QUEUE_ROWS = 200  # Finished jobs shown in the queue view
+WARM_WORKERS = 1  # Worker processes started with the window, so the first job does not wait for one
 
 class PortMonitor(QObject):
     """Monitors serial port connections in a background thread."""
@@ -104,13 +79,63 @@ class PortMonitor(QObject):
 
 
 class ESPFlasherApp(QMainWindow):
+    images_prepared = Signal(object)
+    monitor_message = Signal(str)
+    job_changed = Signal(object)
+    log_message = Signal(str)
+
     def __init__(self):
         super().__init__()
         self.setWindowTitle("ESP32 Flasher")
-        self.setGeometry(100, 100, 700, 600)
-
-        self.esptool_thread = None
-        self.esptool_worker = None
+        self.setGeometry(100, 100, 700, 850)
+
+        # Messages from any thread end up in the console; jobs tag theirs with the port
+        self.log_message.connect(self.append_output)
+
+        # Jobs for any number of ports, one at a time per port (see job_queue.py),
+        # and per USB hub only as many as it has been seen to handle (see hub_limits.py)
+        self.hub_limits = HubLimits(os.path.join(STATE_DIR, 'hubs.json'), log=self.log_message.emit)
+        self.scheduler = JobScheduler(DEFAULT_CONCURRENCY, on_change=self.job_changed.emit,
+                                      log=self.log_message.emit, limits=self.hub_limits)
+        # Each job runs in a worker process of its own, reused for later jobs (see flash_workers.py)
+        self.worker_pool = WorkerPool(log=self.log_message.emit)
+        self.worker_pool.warm(WARM_WORKERS)
+        self.job_changed.connect(self.on_job_changed)
+        self.queue_timer = QTimer(self)
+        self.queue_timer.setSingleShot(True)
+        self.queue_timer.setInterval(QUEUE_REFRESH)
+        self.queue_timer.timeout.connect(self.refresh_queue)
+
+        # The monitor reads on its own thread; the view pulls from its ring buffer at MONITOR_FPS
+        self.monitor = None
+        self.monitor_position = 0
+        self.monitor_decoder = None
+        self.monitor_timer = QTimer(self)
+        self.monitor_timer.setInterval(1000 // MONITOR_FPS)
+        self.monitor_timer.timeout.connect(self.render_monitor)
+        self.monitor_message.connect(self.append_output)
+
+        # Selected images are kept once by content, and prepared payloads are keyed by hash
+        self.artifact_store = ArtifactStore(os.path.join(STATE_DIR, 'artifacts'))
+        # Images are read, hashed and compressed as soon as they are selected
+        self.image_preparer = flash_engine.ImagePreparer()
+        self.preparation = None
+        self.images_prepared.connect(self.on_images_prepared)
+
+        # Lets a job interrupted by a cable glitch continue where it stopped
+        self.flash_journal = FlashJournal(os.path.join(STATE_DIR, 'journal'))
+        # Serial error history per port, so flaky ports start at a safer baud rate
+        self.port_health = PortHealth(os.path.join(STATE_DIR, 'port_health.json'))
+        # What was last written to each board, so repeat flashes can skip the write
+        self.device_cache = DeviceCache(os.path.join(STATE_DIR, 'devices.sqlite'))
+        # Chip type per USB adapter, so known adapters skip auto-detection
+        self.chip_cache = ChipCache(os.path.join(STATE_DIR, 'chips.json'))
+        # Every job, kept after the output console is cleared (see job_history.py)
+        self.job_history = JobHistory(os.path.join(STATE_DIR, 'history.sqlite'), log=self.log_message.emit)
+        # Per-board NVS images built ahead of the line, if personalization is set up
+        self.personalization = PersonalizationFactory.from_directory(PERSONALIZATION_DIR, log=self.log_message.emit)
+        if self.personalization is not None:
+            self.personalization.fill()
 
         self.create_widgets()
         self.refresh_ports()
@@ -148,13 +173,63 @@ class ESPFlasherApp(QMainWindow):
         action_layout = QHBoxLayout(action_group)
         self.flash_button = QPushButton("Flash ESP32")
         self.flash_button.clicked.connect(self.flash_esp32)
+        self.flash_all_button = QPushButton("Flash All Ports")
+        self.flash_all_button.clicked.connect(self.flash_all_ports)
+        self.backup_button = QPushButton("Back Up Flash")
+        self.backup_button.clicked.connect(self.backup_flash)
+        self.backup_combo = QComboBox()
+        self.backup_combo.addItem("Backup: incremental snapshot", 'snapshot')
+        self.backup_combo.addItem("Backup: full image file", 'file')
+        self.verify_combo = QComboBox()
+        self.verify_combo.addItem("Verify: MD5", flash_engine.VERIFY_MD5)
+        self.verify_combo.addItem("Verify: full readback", flash_engine.VERIFY_READBACK)
         self.progress_bar = QProgressBar()
         self.progress_bar.setRange(0, 0)  # Indeterminate
         self.progress_bar.hide()
         action_layout.addWidget(self.flash_button)
+        action_layout.addWidget(self.flash_all_button)
+        action_layout.addWidget(self.verify_combo)
+        action_layout.addWidget(self.backup_button)
+        action_layout.addWidget(self.backup_combo)
         action_layout.addWidget(self.progress_bar)
         main_layout.addWidget(action_group)
 
+        # Queued, running and finished jobs
+        queue_group = QGroupBox("Job Queue")
+        queue_layout = QVBoxLayout(queue_group)
+        queue_controls = QHBoxLayout()
+        self.priority_check = QCheckBox("High priority")
+        self.concurrency_spin = QSpinBox()
+        self.concurrency_spin.setRange(1, 32)
+        self.concurrency_spin.setValue(DEFAULT_CONCURRENCY)
+        self.concurrency_spin.setPrefix("Parallel jobs: ")
+        self.concurrency_spin.valueChanged.connect(self.scheduler.set_limit)
+        self.cancel_button = QPushButton("Cancel Selected")
+        self.cancel_button.clicked.connect(self.cancel_selected_jobs)
+        self.queue_summary = QLabel("No jobs queued")
+        queue_controls.addWidget(self.priority_check)
+        queue_controls.addWidget(self.concurrency_spin)
+        queue_controls.addWidget(self.cancel_button)
+        queue_controls.addWidget(self.queue_summary, 1)
+        queue_layout.addLayout(queue_controls)
+        self.queue_table = QTableWidget(0, 8)
+        self.queue_table.setHorizontalHeaderLabels(["#", "Port", "Hub", "Job", "Priority", "State", "Waited", "Ran"])
+        self.queue_table.horizontalHeader().setSectionResizeMode(QHeaderView.ResizeToContents)
+        self.queue_table.horizontalHeader().setStretchLastSection(True)
+        self.queue_table.verticalHeader().hide()
+        self.queue_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.queue_table.setSelectionBehavior(QAbstractItemView.SelectRows)
+        self.queue_table.setMaximumHeight(180)
+        queue_layout.addWidget(self.queue_table)
+        main_layout.addWidget(queue_group)
+
+        # Per-region verification results of the last job
+        verify_group = QGroupBox("Verification")
+        verify_layout = QVBoxLayout(verify_group)
+        self.verify_label = QLabel("No job run yet")
+        verify_layout.addWidget(self.verify_label)
+        main_layout.addWidget(verify_group)
+
         # Output console
         output_group = QGroupBox("Output")
         output_layout = QVBoxLayout(output_group)
@@ -164,6 +239,33 @@ class ESPFlasherApp(QMainWindow):
         output_layout.addWidget(self.output_console)
         main_layout.addWidget(output_group)
 
+        # Serial monitor, opened on the flashed port right after the reset
+        monitor_group = QGroupBox("Serial Monitor")
+        monitor_layout = QVBoxLayout(monitor_group)
+        monitor_controls = QHBoxLayout()
+        self.monitor_baud_combo = QComboBox()
+        for baud in MONITOR_BAUDS:
+            self.monitor_baud_combo.addItem(f"{baud} baud", baud)
+        self.monitor_after_flash = QCheckBox("Open after flashing")
+        self.monitor_after_flash.setChecked(True)
+        self.monitor_log_check = QCheckBox("Log to file")
+        self.monitor_button = QPushButton("Start Monitor")
+        self.monitor_button.clicked.connect(self.toggle_monitor)
+        monitor_controls.addWidget(self.monitor_baud_combo)
+        monitor_controls.addWidget(self.monitor_after_flash)
+        monitor_controls.addWidget(self.monitor_log_check)
+        monitor_controls.addWidget(self.monitor_button)
+        monitor_layout.addLayout(monitor_controls)
+        self.boot_expect_edit = QLineEdit()
+        self.boot_expect_edit.setPlaceholderText("Boot check: regex a good board prints after flashing, e.g. READY (empty: off)")
+        monitor_layout.addWidget(self.boot_expect_edit)
+        self.monitor_view = QPlainTextEdit()
+        self.monitor_view.setReadOnly(True)
+        self.monitor_view.setFont(QFont("Courier", 10))
+        self.monitor_view.setMaximumBlockCount(MONITOR_LINES)
+        monitor_layout.addWidget(self.monitor_view)
+        main_layout.addWidget(monitor_group)
+
         # Status label
         self.status_label = QLabel("Ready")
         main_layout.addWidget(self.status_label)
@@ -181,6 +283,7 @@ class ESPFlasherApp(QMainWindow):
         parent_layout.addLayout(row_layout)
 
         browse_button.clicked.connect(lambda: self.browse_file(combobox))
+        combobox.currentTextChanged.connect(self.prepare_images)
         return combobox
 
     def browse_file(self, combobox):
@@ -218,12 +321,57 @@ class ESPFlasherApp(QMainWindow):
 
     def update_combo_box(self, combobox, items):
         current_text = combobox.currentText()
+        # Refilling with the same files must not look like a new selection
+        combobox.blockSignals(True)
         combobox.clear()
         combobox.addItems(items)
         if current_text in items:
             combobox.setCurrentText(current_text)
         elif items:
             combobox.setCurrentIndex(0)
+        combobox.blockSignals(False)
+        if combobox.currentText() != current_text:
+            self.prepare_images()
+
+    def selected_files(self):
+        """(address, path, catalog name, bootloader) of the selected images, or None."""
+        files = [
+            (0x0, self.bootloader_combo.currentText()),
+            (0x8000, self.partition_combo.currentText()),
+            (0xe000, self.ota_data_combo.currentText()),
+            (0x10000, self.bin_combo.currentText())
+        ]
+        if not all(path for _, path in files):
+            return None
+        return [
+            # The bootloader follows the detected chip (0x1000 on ESP32, 0x0 on ESP32-C3)
+            (address, path,
+             os.path.relpath(path, BIN_DIR) if path.startswith(BIN_DIR + os.sep) else os.path.basename(path),
+             address == 0x0)
+            for address, path in files
+        ]
+
+    @Slot()
+    def prepare_images(self):
+        # Files are added to the artifact store on the preparer's pool; unchanged ones are not rehashed
+        self.preparation = None
+        files = self.selected_files()
+        if files is None:
+            return
+        self.preparation = self.image_preparer.prepare_files(files, self.artifact_store)
+        self.preparation.add_done_callback(self.images_prepared.emit)
+
+    @Slot(object)
+    def on_images_prepared(self, preparation):
+        counts = self.scheduler.counts()
+        if preparation is not self.preparation or counts[RUNNING] or counts[PENDING]:
+            return
+        try:
+            preparation.wait()
+        except Exception as e:
+            self.status_label.setText(f"Image error: {e}")
+            return
+        self.status_label.setText(f"Ready (images prepared in {preparation.elapsed:.2f} s)")
 
     def start_port_monitor(self):
         self.port_monitor_thread = QThread()
@@ -234,88 +382,318 @@ class ESPFlasherApp(QMainWindow):
         self.port_monitor_thread.start()
 
     def closeEvent(self, event):
+        self.stop_monitor()
         self.port_monitor.stop()
         self.port_monitor_thread.quit()
         self.port_monitor_thread.wait()
-        
-        # The esptool function call cannot be forcefully stopped.
-        # We just wait for the thread to finish its work if it's running.
-        if self.esptool_thread and self.esptool_thread.isRunning():
-            self.esptool_thread.quit()
-            self.esptool_thread.wait()
+        self.image_preparer.shutdown()
+        if self.personalization is not None:
+            self.personalization.shutdown()
+
+        # Pending jobs are dropped and running ones stop at their next block,
+        # with the board reset. Shutdown gives up after SHUTDOWN_TIMEOUT.
+        if not self.scheduler.shutdown():
+            self.append_output("Some jobs did not stop in time and are abandoned.")
+        # Workers still busy with an abandoned job are terminated
+        self.worker_pool.shutdown()
+        # Images replaced by a rebuild are no longer named; nothing reads them once the jobs are gone
+        self.artifact_store.prune()
+        self.job_history.close()
 
         super().closeEvent(event)
 
     def flash_esp32(self):
         selected_port_desc = self.port_combo.currentText()
+        if not selected_port_desc:
+            QMessageBox.critical(self, "Error", "All binary files and a COM port must be selected.")
+            return
+        self.queue_flash([selected_port_desc.split(' - ')[0]])
+
+    def flash_all_ports(self):
+        ports = [self.port_combo.itemText(i).split(' - ')[0] for i in range(self.port_combo.count())]
+        if not ports:
+            QMessageBox.critical(self, "Error", "No COM ports found.")
+            return
+        self.queue_flash(ports)
+
+    def queue_flash(self, ports):
+        """Queue a flash job per port, all with the selected images and settings."""
         selected_bootloader = self.bootloader_combo.currentText()
         selected_partition = self.partition_combo.currentText()
         selected_ota_data = self.ota_data_combo.currentText()
         selected_bin = self.bin_combo.currentText()
 
-        if not all([selected_port_desc, selected_bootloader, selected_partition, selected_ota_data, selected_bin]):
+        if not all([selected_bootloader, selected_partition, selected_ota_data, selected_bin]):
             QMessageBox.critical(self, "Error", "All binary files and a COM port must be selected.")
             return
 
-        self.flash_button.setEnabled(False)
-        self.progress_bar.show()
-        self.status_label.setText("Flashing in progress...")
-        self.output_console.clear()
+        # Cached per file, so this only does work if a file changed on disk
+        self.prepare_images()
+        if self.preparation is None:
+            QMessageBox.critical(self, "Error", "All binary files must be selected.")
+            return
 
+        boot_check = None
+        if self.boot_expect_edit.text().strip():
+            try:
+                boot_check = BootCheck([self.boot_expect_edit.text().strip()], baud=self.monitor_baud_combo.currentData())
+            except re.error as e:
+                QMessageBox.critical(self, "Error", f"The boot check pattern is not a valid regex: {e}")
+                return
+
+        # Only the selected port's output fits the monitor pane
+        monitored_port = self.port_combo.currentText().split(' - ')[0]
+        stores = {
+            'port_health': self.port_health,
+            'device_cache': self.device_cache,
+            'history': self.job_history,
+            'chip_cache': self.chip_cache,
+        }
+        if self.personalization is not None:
+            stores['personalization'] = self.personalization
+        for port in ports:
+            job = RemoteJob(
+                self.worker_pool, 'FlashJob', port, self.preparation,
+                stores=stores,
+                log=self.job_log(port),
+                monitor_baud=(self.monitor_baud_combo.currentData()
+                              if self.monitor_after_flash.isChecked() and port == monitored_port else None),
+                chip='auto',
+                baud=921600,
+                before='default-reset',
+                after='hard-reset',
+                verify=self.verify_combo.currentData(),
+                journal=self.flash_journal.directory,
+                boot_check=boot_check
+            )
+            self.queue_job(job)
+        self.status_label.setText(f"Flashing queued for {', '.join(ports)}")
+
+    def backup_flash(self):
+        selected_port_desc = self.port_combo.currentText()
+        if not selected_port_desc:
+            QMessageBox.critical(self, "Error", "A COM port must be selected.")
+            return
         port = selected_port_desc.split(' - ')[0]
 
-        esptool_args = [
-            '--chip', 'esp32c3',
-            '--port', port,
-            '--baud', '921600',
-            '--before', 'default-reset',
-            '--after', 'hard-reset',
-            'write_flash',
-            '--flash-mode', 'keep',
-            '--flash-freq', 'keep',
-            '--flash-size', 'keep',
-            '-z',
-            '0x0', os.path.abspath(selected_bootloader),
-            '0x8000', os.path.abspath(selected_partition),
-            '0xe000', os.path.abspath(selected_ota_data),
-            '0x10000', os.path.abspath(selected_bin)
-        ]
-        
-        self.esptool_thread = QThread()
-        self.esptool_worker = EsptoolWorker(esptool_args)
-        self.esptool_worker.moveToThread(self.esptool_thread)
+        if self.backup_combo.currentData() == 'snapshot':
+            # Only sectors changed since the board's last snapshot are read
+            self.status_label.setText(f"Snapshot queued for {port}")
+            job = RemoteJob(
+                self.worker_pool, 'SnapshotJob', port,
+                stores={'port_health': self.port_health, 'chip_cache': self.chip_cache},
+                log=self.job_log(port),
+                store=os.path.join(BACKUP_DIR, 'store'),
+                baud=921600
+            )
+            self.queue_job(job)
+            return
 
-        self.esptool_worker.output.connect(self.append_output)
-        self.esptool_worker.finished.connect(self.on_flash_finished)
-        self.esptool_thread.started.connect(self.esptool_worker.run)
-        
-        # Clean up thread and worker
-        self.esptool_worker.finished.connect(self.esptool_thread.quit)
-        self.esptool_worker.finished.connect(self.esptool_worker.deleteLater)
-        self.esptool_thread.finished.connect(self.esptool_thread.deleteLater)
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        default_name = f"backup-{os.path.basename(port)}-{time.strftime('%Y%m%d-%H%M%S')}.bin"
+        path, _ = QFileDialog.getSaveFileName(
+            self, "Save Flash Backup", os.path.join(BACKUP_DIR, default_name), "Binary Files (*.bin)"
+        )
+        if not path:
+            return
+
+        self.status_label.setText(f"Backup queued for {port}")
+        job = RemoteJob(
+            self.worker_pool, 'BackupJob', port,
+            stores={'port_health': self.port_health, 'chip_cache': self.chip_cache},
+            log=self.job_log(port),
+            path=path,
+            baud=921600
+        )
+        self.queue_job(job)
+
+    def job_log(self, port):
+        """A log callable for a job on port, safe to call from its thread."""
+        return lambda text: self.log_message.emit(f"[{port}] {text}")
+
+    def queue_job(self, job):
+        """Queue a flash or backup job; it starts once its port and a slot are free."""
+        if self.monitor is not None and self.monitor.port == job.port:
+            self.stop_monitor()
+        self.scheduler.submit(job, HIGH_PRIORITY if self.priority_check.isChecked() else 0)
+
+    @Slot(object)
+    def on_job_changed(self, queued):
+        if queued.state == RUNNING and self.monitor is not None and self.monitor.port == queued.port:
+            # Opened by hand while the job was waiting
+            self.stop_monitor()
+        elif queued.state == CANCELLED and queued.started_at is not None:
+            self.append_output(f"[{queued.port}] Cancelled.")
+            self.status_label.setText(f"{queued.port}: cancelled.")
+            self.refresh_ports()
+        elif queued.state in (DONE, FAILED):
+            if queued.error:
+                self.append_output(f"[{queued.port}] An error occurred while running esptool:\n{queued.error}")
+            if queued.kind in ('BackupJob', 'SnapshotJob'):
+                self.on_backup_finished(queued)
+            else:
+                self.on_flash_finished(queued)
+        counts = self.scheduler.counts()
+        self.progress_bar.setVisible(bool(counts[RUNNING] or counts[PENDING]))
+        if not self.queue_timer.isActive():
+            self.queue_timer.start()
+
+    @Slot()
+    def refresh_queue(self):
+        """Redraw the queue view, at most every QUEUE_REFRESH ms however many jobs change."""
+        pending, running, finished = self.scheduler.snapshot()
+        selected = set(self.selected_job_ids())
+        rows = running + pending + finished[:QUEUE_ROWS]
+        self.queue_table.setRowCount(len(rows))
+        self.queue_table.clearSelection()
+        for row, queued in enumerate(rows):
+            run_time = queued.run_time
+            values = [
+                str(queued.id), queued.port, queued.group or "", queued.kind.replace('Job', ''), str(queued.priority),
+                queued.state if not queued.error else f"{queued.state}: {queued.error}",
+                f"{queued.wait_time:.1f} s", f"{run_time:.1f} s" if run_time is not None else "",
+            ]
+            for column, value in enumerate(values):
+                item = self.queue_table.item(row, column)
+                if item is None:
+                    item = QTableWidgetItem()
+                    self.queue_table.setItem(row, column, item)
+                item.setText(value)
+            self.queue_table.item(row, 0).setData(Qt.UserRole, queued.id)
+            if queued.id in selected:
+                self.queue_table.selectionModel().select(
+                    self.queue_table.model().index(row, 0), QItemSelectionModel.Select | QItemSelectionModel.Rows
+                )
+        self.queue_summary.setText(f"{len(running)} running, {len(pending)} pending, {len(finished)} finished")
+        if running or pending:
+            # Keeps the timings ticking
+            self.queue_timer.start()
+
+    def selected_job_ids(self):
+        ids = []
+        for index in self.queue_table.selectionModel().selectedRows():
+            item = self.queue_table.item(index.row(), 0)
+            if item is not None:
+                ids.append(item.data(Qt.UserRole))
+        return ids
 
-        self.esptool_thread.start()
+    @Slot()
+    def cancel_selected_jobs(self):
+        """Drop the selected pending jobs and stop the selected running ones at their next block."""
+        for job_id in self.selected_job_ids():
+            self.scheduler.cancel(job_id)
 
     @Slot(str)
     def append_output(self, text):
         self.output_console.append(text)
 
-    @Slot(int)
-    def on_flash_finished(self, exit_code):
-        self.progress_bar.hide()
-        self.flash_button.setEnabled(True)
-        
-        if exit_code == 0:
-            self.status_label.setText("Flashing completed successfully!")
-            QMessageBox.information(self, "Success", "Flashing completed successfully!")
+    @Slot()
+    def toggle_monitor(self):
+        if self.monitor is not None:
+            self.stop_monitor()
+            return
+        selected_port_desc = self.port_combo.currentText()
+        if not selected_port_desc:
+            QMessageBox.critical(self, "Error", "A COM port must be selected.")
+            return
+        self.start_monitor(selected_port_desc.split(' - ')[0])
+
+    def start_monitor(self, port):
+        """Monitor a port by name, or take over the running monitor a flash job handed over."""
+        self.stop_monitor()
+        if isinstance(port, SerialMonitor):
+            monitor = port
+            monitor.log = self.monitor_message.emit
+            if self.monitor_log_check.isChecked():
+                monitor.log_to(os.path.join(LOG_DIR, f"monitor-{os.path.basename(monitor.port)}.log"))
+        else:
+            log_path = None
+            if self.monitor_log_check.isChecked():
+                log_path = os.path.join(LOG_DIR, f"monitor-{os.path.basename(port)}.log")
+            monitor = SerialMonitor(port, self.monitor_baud_combo.currentData(), log_path, log=self.monitor_message.emit)
+            try:
+                monitor.start()
+            except Exception as e:
+                monitor.stop()
+                self.status_label.setText(f"Could not open {port}: {e}")
+                return
+        self.monitor = monitor
+        self.monitor_position = 0
+        self.monitor_decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.monitor_view.clear()
+        self.monitor_timer.start()
+        self.monitor_button.setText("Stop Monitor")
+
+    def stop_monitor(self):
+        if self.monitor is None:
+            return
+        self.monitor_timer.stop()
+        self.render_monitor()
+        self.monitor.stop()
+        self.monitor = None
+        self.monitor_button.setText("Start Monitor")
+
+    @Slot()
+    def render_monitor(self):
+        """Append what arrived since the last frame, skipping ahead if the view fell behind."""
+        data, self.monitor_position, skipped = self.monitor.ring.read_since(
+            self.monitor_position, MONITOR_FRAME_BYTES
+        )
+        if not data:
+            return
+        text = self.monitor_decoder.decode(data).replace('\r\n', '\n')
+        if skipped:
+            text = f"\n[{skipped} bytes not shown, see the log file]\n" + text
+        scrollbar = self.monitor_view.verticalScrollBar()
+        follow = scrollbar.value() == scrollbar.maximum()
+        cursor = QTextCursor(self.monitor_view.document())
+        cursor.movePosition(QTextCursor.End)
+        cursor.insertText(text)
+        if follow:
+            scrollbar.setValue(scrollbar.maximum())
+
+    def show_verification(self, results):
+        if not results:
+            self.verify_label.setText("Not verified")
+            return
+        self.verify_label.setText("\n".join(str(result) for result in results))
+
+    def on_backup_finished(self, queued):
+        if queued.state == DONE:
+            self.status_label.setText(f"{queued.port}: backup saved to {queued.job.path}")
+        else:
+            self.status_label.setText(f"{queued.port}: backup failed!")
+            self.report_failure(f"Backup of {queued.port} failed. Check the output console for details.")
+
+        self.refresh_ports()
+
+    def on_flash_finished(self, queued):
+        job = queued.job
+        self.show_verification(job.verification)
+        self.verify_label.setText(f"{queued.port}:\n{self.verify_label.text()}")
+        if job.boot is not None:
+            self.verify_label.setText(f"{self.verify_label.text()}\n{job.boot}")
+        if job.handover is not None:
+            # Already running since the reset, so the view starts with the first boot line
+            self.start_monitor(job.handover)
+
+        if queued.state == DONE:
+            self.status_label.setText(f"{queued.port}: flashing completed successfully!")
         else:
-            self.status_label.setText("Flashing failed!")
-            QMessageBox.critical(self, "Error", "Flashing failed. Check the output console for details.")
+            self.status_label.setText(f"{queued.port}: flashing failed!")
+            self.report_failure(f"Flashing {queued.port} failed. Check the output console for details.")
 
         self.refresh_ports()
         self.refresh_bins()
 
+    def report_failure(self, message):
+        """A dialog for a lone job; while others run or wait, the queue view and status line say it."""
+        counts = self.scheduler.counts()
+        if not counts[RUNNING] and not counts[PENDING]:
+            QMessageBox.critical(self, "Error", message)
+
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Personalization images are built in worker processes
     app = QApplication(sys.argv)
     window = ESPFlasherApp()
     window.show()
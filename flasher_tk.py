@@ -1,25 +1,56 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, filedialog
 import serial.tools.list_ports
+import multiprocessing
 import threading
-import esptool
+import queue
 import os
-import time
+
+import flash_engine
+from chip_cache import ChipCache
+from flash_workers import RemoteJob, WorkerPool
 
 BIN_DIR = 'bin'  # Directory where the binary files are located
+STATE_DIR = 'state'  # Caches kept between runs
+
+POLL_INTERVAL = 50  # Milliseconds between checks for events from the worker thread
+PORT_SCAN_INTERVAL = 1.0  # Seconds between serial port scans
+LOG_LINES = 2000  # Kept in the log view
+PHASE_STATUS = {
+    'connect': "Resetting into the bootloader and connecting...",
+    'write': "Writing...",
+    'verify': "Verifying...",
+    'boot': "Checking that the board boots...",
+}
+NO_BOOTLOADER_HINT = (
+    "If the board has no auto-reset circuit, hold BOOT, tap EN (RESET), release BOOT and flash again."
+)
 
 class ESPFlasherApp:
     def __init__(self, root):
         self.root = root
         self.root.title("ESP32 Flasher")
-        self.root.geometry("600x400")
+        self.root.geometry("600x600")
+
+        # Chip type per USB adapter, so known adapters skip auto-detection
+        self.chip_cache = ChipCache(os.path.join(STATE_DIR, 'chips.json'))
+        # The job runs in a worker process, whose esptool output ends up in the log view
+        self.worker_pool = WorkerPool(max_idle=1, log=self.post_log)
+        self.worker_pool.warm(1)
+        self.job = None
+
+        # Tk may only be touched from this thread: other threads put (kind, value) here,
+        # and poll_events() handles them every POLL_INTERVAL ms
+        self.events = queue.Queue()
+        self.stopping = threading.Event()
 
         self.create_widgets()
         self.refresh_ports()
         self.refresh_bins()
 
-        # Start a thread to update COM ports dynamically
         threading.Thread(target=self.dynamic_port_update, daemon=True).start()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.root.after(POLL_INTERVAL, self.poll_events)
 
     def create_widgets(self):
         # Main container frame
@@ -58,6 +89,15 @@ class ESPFlasherApp:
         self.status_label = ttk.Label(main_frame, text="", relief=tk.SUNKEN, anchor=tk.W)
         self.status_label.pack(fill=tk.X, pady=5)
 
+        # Log view: the job's messages and esptool's output
+        log_frame = ttk.LabelFrame(main_frame, text="Log", padding="5")
+        log_frame.pack(fill=tk.BOTH, expand=True, pady=5)
+        self.log_view = tk.Text(log_frame, height=12, wrap=tk.WORD, state=tk.DISABLED)
+        scrollbar = ttk.Scrollbar(log_frame, command=self.log_view.yview)
+        self.log_view.config(yscrollcommand=scrollbar.set)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+        self.log_view.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+
     def create_file_selection(self, parent_frame, label_text, attr_name, button_text):
         row = ttk.Frame(parent_frame)
         row.pack(fill=tk.X, pady=5)
@@ -80,8 +120,10 @@ class ESPFlasherApp:
             combo['values'] = [file_path]
             combo.set(file_path)
 
-    def refresh_ports(self):
-        ports = serial.tools.list_ports.comports()
+    def refresh_ports(self, ports=None):
+        """Fill the port list, from a fresh scan unless the ports are given."""
+        if ports is None:
+            ports = serial.tools.list_ports.comports()
         port_list = [f"{port.device} - {port.description}" for port in ports]
         current_selection = self.port_combo.get()
         self.port_combo['values'] = port_list
@@ -131,13 +173,66 @@ class ESPFlasherApp:
             self.partition_combo.set('')
 
     def dynamic_port_update(self):
-        previous_ports = set()
-        while True:
-            ports = set(serial.tools.list_ports.comports())
-            if ports != previous_ports:
-                self.root.after(0, self.refresh_ports)
-                previous_ports = ports
-            time.sleep(1)
+        """Scan the ports on this thread and post the list when the set of device names changes."""
+        previous_devices = None
+        while not self.stopping.wait(PORT_SCAN_INTERVAL if previous_devices is not None else 0):
+            try:
+                ports = serial.tools.list_ports.comports()
+            except Exception:
+                # Ignore errors during port scanning
+                continue
+            devices = {port.device for port in ports}
+            if devices != previous_devices:
+                previous_devices = devices
+                self.events.put(('ports', ports))
+
+    def poll_events(self):
+        """Handle whatever other threads posted since the last poll, on the Tk thread."""
+        try:
+            while True:
+                kind, value = self.events.get_nowait()
+                if kind == 'log':
+                    self.append_log(value)
+                elif kind == 'phase':
+                    self.on_phase(value)
+                elif kind == 'progress':
+                    self.on_progress(value)
+                elif kind == 'ports':
+                    self.refresh_ports(value)
+                elif kind == 'finished':
+                    self.on_finished(value)
+        except queue.Empty:
+            pass
+        if not self.stopping.is_set():
+            self.root.after(POLL_INTERVAL, self.poll_events)
+
+    def post_log(self, text):
+        self.events.put(('log', text))
+
+    def post_progress(self, info):
+        if 'phase' in info:
+            self.events.put(('phase', info['phase']))
+        else:
+            self.events.put(('progress', info))
+
+    def append_log(self, text):
+        self.log_view.config(state=tk.NORMAL)
+        self.log_view.insert(tk.END, text + '\n')
+        lines = int(self.log_view.index('end-1c').split('.')[0])
+        if lines > LOG_LINES:
+            self.log_view.delete('1.0', f"{lines - LOG_LINES}.0")
+        self.log_view.config(state=tk.DISABLED)
+        self.log_view.see(tk.END)
+
+    def on_phase(self, phase):
+        if phase in PHASE_STATUS:
+            self.update_status(PHASE_STATUS[phase])
+
+    def on_progress(self, info):
+        if str(self.progress_bar['mode']) != 'determinate':
+            self.progress_bar.stop()
+            self.progress_bar.config(mode='determinate')
+        self.progress_bar.config(maximum=max(info['total'], 1), value=info['written'])
 
     def flash_esp32(self):
         selected_port_desc = self.port_combo.get()
@@ -149,62 +244,71 @@ class ESPFlasherApp:
             messagebox.showerror("Error", "All fields must be selected.")
             return
 
+        # The chip is detected (or taken from the cache) and the
+        # bootloader goes to its offset: 0x1000 on ESP32, 0x0 on ESP32-C3
+        regions = [
+            flash_engine.Region(0x0, selected_bootloader_bin, bootloader=True),
+            flash_engine.Region(0x8000, selected_partition_bin),
+            flash_engine.Region(0x10000, selected_bin)
+        ]
+        port = selected_port_desc.split(' - ')[0]
+        # esptool resets the board into the bootloader over DTR/RTS (or the USB
+        # sequence on native USB) and retries the sync, so nothing waits for a button
+        self.job = RemoteJob(
+            self.worker_pool, 'FlashJob', port, regions,
+            stores={'chip_cache': self.chip_cache},
+            log=self.post_log,
+            progress=self.post_progress,
+            chip='auto',
+            baud=460800,
+            before='default-reset',
+            after='hard-reset'
+        )
+
         self.flash_button.config(state=tk.DISABLED)
+        self.progress_bar.config(mode='indeterminate', value=0)
         self.progress_bar.start()
+        self.update_status("Flashing in progress...")
+        self.append_log(f"Flashing {port}...")
+        threading.Thread(target=self.run_esptool, args=(self.job,), daemon=True).start()
 
-        threading.Thread(
-            target=self.run_esptool,
-            args=(
-                selected_port_desc.split(' - ')[0],
-                selected_bin,
-                selected_bootloader_bin,
-                selected_partition_bin
-            ),
-            daemon=True
-        ).start()
-
-    def run_esptool(self, port, app_bin_file, bootloader_file, partitions_file):
+    def run_esptool(self, job):
+        """Worker thread: run the job and post how it ended. Never touches Tk."""
         try:
-            self.update_status("Flashing in progress...")
-            time.sleep(2)  # Short delay to allow user to press the BOOT button
-
-            # Ensure file paths are absolute
-            app_bin_file = os.path.abspath(app_bin_file)
-            bootloader_file = os.path.abspath(bootloader_file)
-            partitions_file = os.path.abspath(partitions_file)
-
-            # esptool command
-            esptool_args = [
-                '--chip', 'esp32', # check for chip type !
-                '--port', port,
-                '--baud', '460800',
-                '--before', 'default_reset',
-                '--after', 'hard_reset',
-                'write_flash', '-z',
-                '0x1000', bootloader_file, #check for addresses !
-                '0x8000', partitions_file,
-                '0x10000', app_bin_file
-            ]
-
-            esptool.main(esptool_args)
+            job.run()
+            self.events.put(('finished', None))
+        except Exception as e:
+            self.events.put(('finished', str(e) or type(e).__name__))
 
+    def on_finished(self, error):
+        self.job = None
+        self.progress_bar.stop()
+        self.progress_bar.config(mode='determinate', value=0)
+        self.flash_button.config(state=tk.NORMAL)
+        self.refresh_ports()
+        self.refresh_bins()
+        if error is None:
             self.update_status("Flashing completed successfully!")
             messagebox.showinfo("Success", "Flashing completed successfully!")
-
-        except Exception as e:
-            self.update_status("An error occurred.")
-            messagebox.showerror("Error", f"An error occurred:\n{str(e)}")
-
-        finally:
-            self.progress_bar.stop()
-            self.flash_button.config(state=tk.NORMAL)
-            self.refresh_ports()
-            self.refresh_bins()
+            return
+        self.update_status("An error occurred.")
+        self.append_log(f"Error: {error}")
+        if 'connect' in error.lower() or 'download mode' in error.lower():
+            self.append_log(NO_BOOTLOADER_HINT)
+        messagebox.showerror("Error", f"An error occurred:\n{error}")
+
+    def on_close(self):
+        self.stopping.set()
+        if self.job is not None:
+            self.job.abort()
+        self.worker_pool.shutdown()
+        self.root.destroy()
 
     def update_status(self, message):
         self.status_label.config(text=message)
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()  # Jobs run in worker processes
     root = tk.Tk()
     app = ESPFlasherApp(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,208 @@
+"""
+Per-hub limits for the job queue, learned from how jobs behind each USB hub went.
+
+Boards behind one hub share its upstream link, and with full-speed adapters
+(CH340, CP210x) on a USB 2.0 hub they share a single transaction translator.
+Past a few boards, every extra one slows the others down and serial errors
+climb. So ports are grouped by the hub they hang off, from the USB location
+serial.tools.list_ports reports ("1-1.4.2:1.0" is port 2 of hub 1-1.4), and
+each hub gets a cap on jobs at a time and on the sum of their baud rates.
+
+The cap is learned. Every finished job is recorded with the number of jobs
+its hub was running when it started; per level, boards per hour is that
+level times its success rate over its mean job time. The hub runs at the
+best level measured so far, after trying one board more and one fewer
+than that, and backs off while its best level fails too often. Outcomes
+expire, so a hub that was rewired gets measured again.
+
+    python hub_limits.py state/hubs.json                       # hubs, ports and learned limits
+    python hub_limits.py state/hubs.json --set 1-1.4 --max 6 --budget 4000000
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from serial.tools import list_ports
+
+INITIAL_CONCURRENCY = 4  # Jobs at a time on a hub nothing was learned about
+MAX_CONCURRENCY = 8  # Most the learning goes up to, unless configured per hub
+BAUD_BUDGET = 6000000  # Sum of baud rates per hub, about half of a full-speed USB bus (12 Mbit/s)
+MAX_ERROR_RATE = 0.2  # Above this, a level counts as failing and the hub backs off
+MIN_SAMPLES = 4  # Outcomes needed before a level can be judged
+MAX_SAMPLES = 30  # Outcomes kept per hub and level
+MAX_AGE = 24 * 3600  # Seconds an outcome stays relevant
+TOPOLOGY_REFRESH = 2.0  # Seconds the port -> hub map is reused before list_ports is asked again
+
+
+def hub_of(location):
+    """The hub a USB location hangs off ('1-1.4' for '1-1.4.2:1.0'), or None without one."""
+    if not location:
+        return None
+    path = location.split(':')[0]
+    if '-' not in path:
+        return None
+    bus, ports = path.split('-', 1)
+    if '.' not in ports:
+        return f"{bus}-root"  # Plugged straight into the host controller
+    return f"{bus}-{ports.rsplit('.', 1)[0]}"
+
+
+class HubLimits:
+    """
+    Learned jobs-at-a-time and a baud budget per hub, persisted as JSON.
+
+    JobScheduler(limits=...) asks group() for a port's hub when a job is
+    queued, admits() before starting it and record() when it finished.
+    Ports without a USB location each count as their own group.
+    """
+
+    def __init__(self, path=None, initial=INITIAL_CONCURRENCY, maximum=MAX_CONCURRENCY,
+                 baud_budget=BAUD_BUDGET, log=print):
+        self.path = path
+        self.initial = initial
+        self.maximum = maximum
+        self.baud_budget = baud_budget
+        self.log = log
+        self._lock = threading.Lock()
+        self._hubs = {}  # hub -> {'config': {...}, 'levels': {level: [[time, run_time, ok], ...]}}
+        self._limits = {}  # hub -> current limit, as last logged
+        self._ports = {}  # port -> hub
+        self._ports_at = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._hubs = json.load(f)
+            except (OSError, ValueError):
+                self._hubs = {}
+
+    def group(self, port):
+        """The hub of a port, or the port itself if it has no USB location."""
+        with self._lock:
+            if port not in self._ports or time.monotonic() - self._ports_at > TOPOLOGY_REFRESH:
+                self._ports = {info.device: hub_of(info.location) for info in list_ports.comports()}
+                self._ports_at = time.monotonic()
+            return self._ports.get(port) or port
+
+    def configure(self, hub, maximum=None, baud_budget=None):
+        """Pin the most jobs at a time and the baud budget for one hub (None keeps the default)."""
+        with self._lock:
+            config = self._hubs.setdefault(hub, {}).setdefault('config', {})
+            config['max'] = maximum
+            config['budget'] = baud_budget
+            self._save()
+
+    def _config(self, hub, key, default):
+        value = self._hubs.get(hub, {}).get('config', {}).get(key)
+        return default if value is None else value
+
+    def _levels(self, hub):
+        """level -> recent (run_time, ok) outcomes."""
+        cutoff = time.time() - MAX_AGE
+        levels = {}
+        for level, outcomes in self._hubs.get(hub, {}).get('levels', {}).items():
+            recent = [(run_time, ok) for t, run_time, ok in outcomes if t >= cutoff]
+            if recent:
+                levels[int(level)] = recent
+        return levels
+
+    def estimates(self, hub):
+        """level -> (boards per hour, error rate, samples), for levels with enough samples."""
+        with self._lock:
+            levels = self._levels(hub)
+        estimates = {}
+        for level, outcomes in levels.items():
+            if len(outcomes) < MIN_SAMPLES:
+                continue
+            successes = sum(1 for _, ok in outcomes if ok)
+            mean_time = sum(run_time for run_time, _ in outcomes) / len(outcomes)
+            per_hour = level * successes / len(outcomes) * 3600 / max(mean_time, 1e-3)
+            estimates[level] = (per_hour, 1 - successes / len(outcomes), len(outcomes))
+        return estimates
+
+    def limit(self, hub):
+        """Jobs at a time for a hub: the best measured level, or its untried neighbour."""
+        maximum = self._config(hub, 'max', self.maximum)
+        estimates = self.estimates(hub)
+        if not estimates:
+            return min(self.initial, maximum)
+        best = max(estimates, key=lambda level: estimates[level][0])
+        _, error_rate, _ = estimates[best]
+        if error_rate > MAX_ERROR_RATE:
+            # Failing at its best, so fewer boards until a level works
+            lower = [level for level in estimates if level < best and estimates[level][1] <= MAX_ERROR_RATE]
+            limit = max(lower) if lower else max(best - 1, 1)
+        elif best + 1 <= maximum and best + 1 not in estimates:
+            limit = best + 1  # Clean, so see whether one more board still pays off
+        elif best > 1 and best - 1 not in estimates:
+            limit = best - 1  # And whether one fewer gets more through
+        else:
+            limit = best
+        return max(1, min(limit, maximum))
+
+    def admits(self, hub, running, job):
+        """Whether job may start on hub next to the running jobs."""
+        if not running:
+            return True
+        if len(running) >= self.limit(hub):
+            return False
+        budget = self._config(hub, 'budget', self.baud_budget)
+        if budget:
+            return sum(getattr(q.job, 'baud', 0) for q in running) + getattr(job, 'baud', 0) <= budget
+        return True
+
+    def record(self, hub, level, run_time, ok):
+        """A job on hub finished after run_time seconds, started with level jobs running there."""
+        with self._lock:
+            levels = self._hubs.setdefault(hub, {}).setdefault('levels', {})
+            cutoff = time.time() - MAX_AGE
+            outcomes = [o for o in levels.get(str(level), []) if o[0] >= cutoff]
+            levels[str(level)] = (outcomes + [[time.time(), run_time, bool(ok)]])[-MAX_SAMPLES:]
+            self._save()
+        limit = self.limit(hub)
+        if self._limits.get(hub, limit) != limit:
+            self.log(f"Hub {hub}: now {limit} jobs at a time.")
+        self._limits[hub] = limit
+
+    def summary(self):
+        """hub -> (limit, estimates), for every hub with a record."""
+        with self._lock:
+            hubs = list(self._hubs)
+        return {hub: (self.limit(hub), self.estimates(hub)) for hub in hubs}
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._hubs, f)
+        os.replace(tmp, self.path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Show or configure per-hub job limits.")
+    parser.add_argument('path')
+    parser.add_argument('--set', metavar='HUB', help="Hub to configure, as listed")
+    parser.add_argument('--max', type=int, help="Most jobs at a time on the hub")
+    parser.add_argument('--budget', type=int, help="Sum of baud rates allowed on the hub")
+    args = parser.parse_args()
+
+    limits = HubLimits(args.path)
+    if args.set:
+        limits.configure(args.set, args.max, args.budget)
+
+    ports = {}
+    for info in list_ports.comports():
+        ports.setdefault(hub_of(info.location) or info.device, []).append(info.device)
+    summary = limits.summary()
+    for hub in sorted(set(summary) | set(ports)):
+        limit, estimates = summary.get(hub, (limits.limit(hub), {}))
+        print(f"{hub}: {limit} at a time, ports: {', '.join(ports.get(hub, [])) or 'none attached'}")
+        for level, (per_hour, error_rate, samples) in sorted(estimates.items()):
+            print(f"  {level} at a time: {per_hour:.0f} boards/h, {error_rate:.0%} failed ({samples} jobs)")
+
+
+if __name__ == '__main__':
+    main()
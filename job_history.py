@@ -0,0 +1,233 @@
+"""
+Indexed SQLite history of every flash job.
+
+Jobs are queued by the flasher and written by a background thread in batches,
+one transaction per batch, so recording a job never blocks the GUI or a flash
+worker. The database runs in WAL mode, so station leads can query it while
+the flasher keeps writing.
+
+    python job_history.py state/history.sqlite --hours 24
+"""
+import argparse
+import hashlib
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL,
+    finished_at REAL NOT NULL,
+    port TEXT,
+    usb_serial TEXT,
+    mac TEXT,
+    chip TEXT,
+    firmware TEXT,
+    result TEXT NOT NULL,
+    error TEXT,
+    baud INTEGER,
+    final_baud INTEGER,
+    retries INTEGER,
+    bytes_total INTEGER,
+    bytes_sent INTEGER,
+    resumed_bytes INTEGER,
+    prepare_s REAL,
+    connect_s REAL,
+    write_s REAL,
+    verify_s REAL,
+    timings TEXT
+);
+CREATE TABLE IF NOT EXISTS job_images (
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    address INTEGER NOT NULL,
+    name TEXT,
+    size INTEGER,
+    md5 TEXT NOT NULL
+);
+-- Covers the throughput query, so time-range summaries never touch the table
+CREATE INDEX IF NOT EXISTS jobs_started_at ON jobs(started_at, result, bytes_total);
+CREATE INDEX IF NOT EXISTS jobs_mac ON jobs(mac, started_at);
+CREATE INDEX IF NOT EXISTS jobs_usb_serial ON jobs(usb_serial, started_at);
+CREATE INDEX IF NOT EXISTS jobs_firmware ON jobs(firmware, started_at);
+CREATE INDEX IF NOT EXISTS jobs_port ON jobs(port, started_at);
+CREATE INDEX IF NOT EXISTS job_images_md5 ON job_images(md5);
+CREATE INDEX IF NOT EXISTS job_images_job ON job_images(job_id);
+"""
+
+JOB_COLUMNS = (
+    'started_at', 'finished_at', 'port', 'usb_serial', 'mac', 'chip', 'firmware', 'result', 'error',
+    'baud', 'final_baud', 'retries', 'bytes_total', 'bytes_sent', 'resumed_bytes',
+    'prepare_s', 'connect_s', 'write_s', 'verify_s', 'timings',
+)
+
+BATCH_SIZE = 500  # Records per transaction at most
+FLUSH_INTERVAL = 0.5  # Seconds a record may wait for its batch
+
+
+def firmware_id(images):
+    """Identifies a set of images regardless of file names: hash of address + MD5 pairs."""
+    digest = hashlib.sha256()
+    for image in sorted(images, key=lambda i: i['address']):
+        digest.update(f"{image['address']:x}:{image['md5']};".encode())
+    return digest.hexdigest()[:32]
+
+
+def connect(path):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    db = sqlite3.connect(path, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    db.executescript(SCHEMA)
+    return db
+
+
+class JobHistory:
+    """Queues job records and writes them in batches on a background thread."""
+
+    _STOP = object()
+
+    def __init__(self, path, log=print):
+        self.path = path
+        self.log = log
+        self._queue = queue.Queue()
+        self._db = connect(path)
+        self._thread = threading.Thread(target=self._writer, name='job-history', daemon=True)
+        self._thread.start()
+
+    def add(self, record):
+        """Queue a job record (FlashJob.record). Never blocks on the database."""
+        self._queue.put(record)
+
+    def _writer(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE and batch[-1] is not self._STOP:
+                try:
+                    batch.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            stop = batch[-1] is self._STOP
+            records = [r for r in batch if r is not self._STOP]
+            if records:
+                self._write_batch(records)
+            if stop:
+                return
+
+    def _write_batch(self, records):
+        """Write a batch, or each record on its own if the batch fails, so one bad record loses only itself."""
+        try:
+            self._write(records)
+            return
+        except Exception as e:
+            if len(records) == 1:
+                self.log(f"Could not record a job in {self.path}: {e}")
+                return
+        for record in records:
+            try:
+                self._write([record])
+            except Exception as e:
+                self.log(f"Could not record a job in {self.path}: {e}")
+
+    def _write(self, records):
+        with self._db:
+            for record in records:
+                row = self._row(record)
+                cursor = self._db.execute(
+                    f"INSERT INTO jobs ({', '.join(JOB_COLUMNS)}) VALUES ({', '.join('?' * len(JOB_COLUMNS))})",
+                    [row[c] for c in JOB_COLUMNS],
+                )
+                self._db.executemany(
+                    "INSERT INTO job_images (job_id, address, name, size, md5) VALUES (?, ?, ?, ?, ?)",
+                    [(cursor.lastrowid, i['address'], i['name'], i['size'], i['md5']) for i in record.get('images', [])],
+                )
+
+    @staticmethod
+    def _row(record):
+        timings = record.get('timings', {})
+        images = record.get('images', [])
+        row = {c: record.get(c) for c in JOB_COLUMNS}
+        row.update(
+            firmware=firmware_id(images) if images else None,
+            bytes_total=sum(i['size'] for i in images),
+            prepare_s=timings.get('prepare'),
+            connect_s=timings.get('connect'),
+            write_s=timings.get('write'),
+            verify_s=timings.get('verify'),
+            timings=json.dumps(timings),
+        )
+        return row
+
+    def close(self):
+        """Write everything still queued and stop the writer."""
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._db.close()
+
+
+def throughput(db, since, bucket=3600):
+    """Jobs, successes and bytes per time bucket since a timestamp."""
+    return db.execute(
+        """
+        SELECT CAST(started_at / :bucket AS INTEGER) * :bucket AS slot,
+               COUNT(*), SUM(result = 'ok'), SUM(bytes_total)
+        FROM jobs WHERE started_at >= :since
+        GROUP BY slot ORDER BY slot
+        """,
+        {'bucket': bucket, 'since': since},
+    ).fetchall()
+
+
+def failure_rates(db, since, by='port'):
+    """Jobs and failure rate per port, chip or firmware since a timestamp. Cancelled jobs do not count."""
+    if by not in ('port', 'chip', 'firmware', 'usb_serial'):
+        raise ValueError(f"Cannot group by {by}")
+    return db.execute(
+        f"""
+        SELECT {by}, COUNT(*), AVG(result != 'ok')
+        FROM jobs WHERE started_at >= ? AND result != 'cancelled'
+        GROUP BY {by} ORDER BY 3 DESC
+        """,
+        (since,),
+    ).fetchall()
+
+
+def device_history(db, mac):
+    """Every job on one device, newest first."""
+    return db.execute(
+        "SELECT started_at, port, firmware, result, error FROM jobs WHERE mac = ? ORDER BY started_at DESC",
+        (mac,),
+    ).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize the flash job history.")
+    parser.add_argument('database')
+    parser.add_argument('--hours', type=float, default=24, help="How far back to look")
+    parser.add_argument('--by', default='port', choices=('port', 'chip', 'firmware', 'usb_serial'))
+    parser.add_argument('--mac', help="Show every job on this device instead")
+    args = parser.parse_args()
+
+    db = sqlite3.connect(f"file:{args.database}?mode=ro", uri=True)
+    if args.mac:
+        for started_at, port, firmware, result, error in device_history(db, args.mac):
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(started_at))}  {port}  {firmware}  {result}  {error or ''}")
+        return
+
+    since = time.time() - args.hours * 3600
+    print(f"{'Hour':<16}  {'Jobs':>9} {'OK':>6} {'MB':>5}")
+    for slot, jobs, ok, size in throughput(db, since):
+        print(f"{time.strftime('%Y-%m-%d %H:00', time.localtime(slot))}  {jobs:>9} {ok:>6} {(size or 0) / 1e6:>5.1f}")
+    print(f"\n{args.by:<30} Jobs  Failure rate")
+    for key, jobs, rate in failure_rates(db, since, args.by):
+        print(f"{str(key):<30} {jobs:>4}  {rate:>11.1%}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,301 @@
+"""
+Job queue in front of the flash engine: priorities, a global concurrency limit and one job per port.
+
+Jobs are anything with a port and a run() method (FlashJob, BackupJob, ...).
+The highest priority runs first and jobs of equal priority run in the order
+they were queued, but a job never waits behind one for a busy port: each
+port keeps its own queue, and only the head of every idle port competes for
+a free slot. Submitting, dispatching and finishing are heap operations, so
+hundreds of queued jobs cost microseconds per decision. There is no
+dispatcher thread; the next job starts from submit() or from the thread of
+the job that just finished.
+
+With limits (a HubLimits, see hub_limits.py), ports are also grouped by the
+USB hub they hang off, and a job only starts while its hub is under its
+limits. Heads of a full hub wait aside until a job on that hub finishes, so
+they hold up neither other hubs nor the heap.
+
+Jobs with a cancel() method (FlashJob and its subclasses) can also be
+cancelled while they run: they stop at their next block or phase boundary,
+and a job that does not get there in time is aborted mid-read at shutdown.
+"""
+import heapq
+import itertools
+import threading
+import time
+from collections import deque
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+CANCELLED = 'cancelled'
+
+DEFAULT_CONCURRENCY = 4
+FINISHED_KEPT = 500  # Finished jobs kept for the queue view
+CANCEL_GRACE = 1.0  # Seconds running jobs get at shutdown to stop at a boundary before they are aborted
+SHUTDOWN_TIMEOUT = 5.0  # Seconds shutdown() waits for running jobs in all
+
+
+class QueuedJob:
+    """A job with its place in the queue and its timings."""
+
+    def __init__(self, job, priority, seq):
+        self.job = job
+        self.port = job.port
+        self.priority = priority
+        self.id = seq
+        self.key = (-priority, seq)
+        self.group = None  # Hub the port hangs off, with limits
+        self.level = None  # Jobs running on the group when this one started, itself included
+        self.state = PENDING
+        self.error = None
+        self.queued_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+    @property
+    def kind(self):
+        # A RemoteJob names the job it runs
+        return getattr(self.job, 'kind', None) or type(self.job).__name__
+
+    @property
+    def wait_time(self):
+        if self.started_at is None:
+            return (self.finished_at or time.time()) - self.queued_at
+        return self.started_at - self.queued_at
+
+    @property
+    def run_time(self):
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'port': self.port,
+            'group': self.group,
+            'kind': self.kind,
+            'priority': self.priority,
+            'state': self.state,
+            'error': self.error,
+            'queued_at': self.queued_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'wait_time': self.wait_time,
+            'run_time': self.run_time,
+        }
+
+
+class JobScheduler:
+    """
+    Runs queued jobs on threads, at most max_concurrent at a time and one per port.
+
+    limits, if given, has group(port), admits(group, running, job) and
+    record(group, level, run_time, ok), as HubLimits does.
+
+    on_change(queued_job) is called, outside the scheduler's lock, whenever a
+    job is queued, starts, finishes or is cancelled.
+    """
+
+    def __init__(self, max_concurrent=DEFAULT_CONCURRENCY, on_change=None, log=print, limits=None):
+        self.max_concurrent = max_concurrent
+        self.on_change = on_change
+        self.log = log
+        self.limits = limits
+        self._lock = threading.Condition()
+        self._seq = itertools.count(1)
+        self._ports = {}  # port -> heap of pending QueuedJob
+        self._ready = []  # Heap of the heads of idle ports' queues; stale entries are skipped
+        self._busy = set()  # Ports with a running job
+        self._running = {}  # id -> QueuedJob
+        self._groups = {}  # group -> running QueuedJobs
+        self._parked = {}  # group -> heads that did not fit while it was full
+        self._finished = deque(maxlen=FINISHED_KEPT)
+        self._jobs = {}  # id -> QueuedJob, pending and running
+        self._closed = False
+
+    def submit(self, job, priority=0):
+        """Queue a job. Higher priorities run first. Returns its QueuedJob."""
+        group = self.limits.group(job.port) if self.limits is not None else None
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("The scheduler is shut down.")
+            queued = QueuedJob(job, priority, next(self._seq))
+            queued.group = group
+            self._jobs[queued.id] = queued
+            heapq.heappush(self._ports.setdefault(queued.port, []), queued)
+            if queued.port not in self._busy:
+                heapq.heappush(self._ready, queued)
+            started = self._dispatch()
+        self._changed([queued] + started)
+        return queued
+
+    def cancel(self, job_id):
+        """
+        Drop a pending job, or ask a running one to stop.
+
+        Returns whether the job was pending, or running and cancellable. A
+        running job ends up cancelled once its thread stops.
+        """
+        with self._lock:
+            queued = self._jobs.get(job_id)
+            if queued is None:
+                return False
+            if queued.state == RUNNING:
+                cancel = getattr(queued.job, 'cancel', None)
+                if cancel is None:
+                    return False
+                cancel()
+                return True
+            queued.state = CANCELLED
+            queued.finished_at = time.time()
+            del self._jobs[job_id]
+            self._finished.append(queued)
+            # The entry stays in the heaps and is skipped when it comes up
+            self._lock.notify_all()
+        self._changed([queued])
+        return True
+
+    def set_limit(self, max_concurrent):
+        with self._lock:
+            self.max_concurrent = max_concurrent
+            started = self._dispatch()
+        self._changed(started)
+
+    def _head(self, port):
+        """The next pending job of a port, dropping cancelled ones."""
+        queue = self._ports.get(port)
+        while queue and queue[0].state != PENDING:
+            heapq.heappop(queue)
+        if not queue:
+            self._ports.pop(port, None)
+            return None
+        return queue[0]
+
+    def _dispatch(self):
+        """Start jobs while there are free slots. Called with the lock held."""
+        started = []
+        while len(self._running) < self.max_concurrent and self._ready and not self._closed:
+            queued = heapq.heappop(self._ready)
+            if queued.port in self._busy or queued.state != PENDING or self._head(queued.port) is not queued:
+                continue
+            if self.limits is not None:
+                running = self._groups.get(queued.group, [])
+                if not self.limits.admits(queued.group, running, queued.job):
+                    self._parked.setdefault(queued.group, []).append(queued)
+                    continue
+                running.append(queued)
+                self._groups[queued.group] = running
+                queued.level = len(running)
+            heapq.heappop(self._ports[queued.port])
+            self._busy.add(queued.port)
+            self._running[queued.id] = queued
+            queued.state = RUNNING
+            queued.started_at = time.time()
+            threading.Thread(target=self._run, args=(queued,), name=f"job-{queued.id}-{queued.port}",
+                             daemon=True).start()
+            started.append(queued)
+        return started
+
+    def _run(self, queued):
+        try:
+            queued.job.run()
+            state, error = DONE, None
+        except BaseException as e:
+            state, error = FAILED, str(e) or type(e).__name__
+            if getattr(queued.job, 'cancelled', False):
+                state = CANCELLED
+        # A cancelled job says nothing about what its hub can take
+        if self.limits is not None and state != CANCELLED:
+            try:
+                self.limits.record(queued.group, queued.level, time.time() - queued.started_at, state == DONE)
+            except Exception as e:
+                self.log(f"Could not record the job on hub {queued.group}: {e}")
+        with self._lock:
+            queued.state, queued.error = state, error
+            queued.finished_at = time.time()
+            del self._running[queued.id]
+            del self._jobs[queued.id]
+            self._busy.discard(queued.port)
+            self._finished.append(queued)
+            head = self._head(queued.port)
+            if head is not None:
+                heapq.heappush(self._ready, head)
+            if self.limits is not None:
+                running = self._groups[queued.group]
+                running.remove(queued)
+                if not running:
+                    del self._groups[queued.group]
+                # The hub has room again, so its waiting heads compete again
+                for parked in self._parked.pop(queued.group, []):
+                    heapq.heappush(self._ready, parked)
+            started = self._dispatch()
+            self._lock.notify_all()
+        self._changed([queued] + started)
+
+    def _changed(self, jobs):
+        if self.on_change is None:
+            return
+        for queued in jobs:
+            try:
+                self.on_change(queued)
+            except Exception as e:
+                self.log(f"Queue listener failed: {e}")
+
+    def snapshot(self):
+        """(pending in run order, running, finished newest first), as QueuedJob lists."""
+        with self._lock:
+            pending = sorted(q for q in self._jobs.values() if q.state == PENDING)
+            running = sorted(self._running.values(), key=lambda q: q.started_at)
+            finished = list(reversed(self._finished))
+        return pending, running, finished
+
+    def get(self, job_id):
+        """A queued, running or recently finished job by id, or None."""
+        with self._lock:
+            queued = self._jobs.get(job_id)
+            if queued is None:
+                queued = next((q for q in self._finished if q.id == job_id), None)
+        return queued
+
+    def counts(self):
+        with self._lock:
+            return {
+                PENDING: len(self._jobs) - len(self._running),
+                RUNNING: len(self._running),
+                'finished': len(self._finished),
+            }
+
+    def wait(self, timeout=None):
+        """Wait until nothing is pending or running. Returns whether that happened in time."""
+        with self._lock:
+            return self._lock.wait_for(lambda: not self._jobs, timeout)
+
+    def shutdown(self, timeout=SHUTDOWN_TIMEOUT):
+        """
+        Cancel everything pending and running. Returns whether every job stopped within timeout.
+
+        Running jobs get CANCEL_GRACE seconds to stop at a boundary, then the
+        ones with an abort() are interrupted in whatever read they wait in.
+        Jobs that still run after that are left to their daemon threads.
+        """
+        with self._lock:
+            self._closed = True
+            queued_jobs = sorted(self._jobs.values(), key=lambda q: q.state != PENDING)
+        for queued in queued_jobs:
+            self.cancel(queued.id)
+        deadline = time.monotonic() + timeout
+        if self.wait(min(CANCEL_GRACE, timeout)):
+            return True
+        with self._lock:
+            running = list(self._running.values())
+        for queued in running:
+            abort = getattr(queued.job, 'abort', None)
+            if abort is not None:
+                abort()
+        return self.wait(max(deadline - time.monotonic(), 0))
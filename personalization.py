@@ -0,0 +1,239 @@
+"""
+Per-device NVS partitions (serial number, calibration slot, certificates), generated ahead of the line.
+
+The layout of the partition comes from a template CSV in the format of
+Espressif's manufacturing tool, one `key,type,encoding` row per entry
+(`type` is namespace, data or file). Identities come from a CSV with one
+column per data/file key, or from the `identities` table of a SQLite
+database; the first column identifies the identity.
+
+Images are built on a process pool with Espressif's NVS partition generator
+(pip install esp-idf-nvs-partition-gen) and kept in ready/. A job claims one
+per board by renaming it into claimed/, which is atomic, so concurrent jobs
+never get the same identity. It moves on to used/ once the board verified.
+A board that comes back gets the identity it already has.
+
+The image goes where the partition table flashed with it puts the nvs
+partition, which must be as large as the images are built; a table without
+one is refused rather than guessed at.
+"""
+import csv
+import io
+import os
+import re
+import sqlite3
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from esptool.util import FatalError
+
+from flash_engine import PARTITION_TABLE_MAGIC, Region
+
+NVS_SIZE = 0x5000  # The nvs partition of the default Arduino/ESP-IDF partition tables
+PARTITION_ENTRY_SIZE = 32
+DATA_TYPE, NVS_SUBTYPE = 0x01, 0x02
+READY_AHEAD = 20  # Images kept ready ahead of the line
+
+
+def load_template(path):
+    """(key, type, encoding) rows of a template CSV, skipping comments."""
+    with open(path, newline='', encoding='utf8') as f:
+        rows = [row for row in csv.reader(f) if row and not row[0].startswith('#')]
+    if rows and rows[0][:3] == ['key', 'type', 'encoding']:
+        rows = rows[1:]
+    return [tuple(cell.strip() for cell in row[:3]) for row in rows]
+
+
+def load_identities(path):
+    """Identity rows as dicts, from a CSV or the identities table of a SQLite database."""
+    if path.endswith('.csv'):
+        with open(path, newline='', encoding='utf8') as f:
+            return list(csv.DictReader(f))
+    db = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        cursor = db.execute("SELECT * FROM identities")
+        columns = [c[0] for c in cursor.description]
+        return [dict(zip(columns, (str(v) for v in row))) for row in cursor]
+    finally:
+        db.close()
+
+
+def build_image(template, identity, size, base_dir):
+    """Build one NVS partition image. Runs in a worker process."""
+    from esp_idf_nvs_partition_gen import nvs_partition_gen as nvs
+
+    out = io.BytesIO()
+    # The generator adds the page NVS keeps free for garbage collection on top of the size
+    with nvs.nvs_open(out, size - nvs.Page.PAGE_PARAMS['max_size'], nvs.Page.VERSION2) as partition:
+        for key, kind, encoding in template:
+            if kind == 'namespace':
+                nvs.write_entry(partition, key, kind, '', None)
+                continue
+            value = identity[key]
+            if kind == 'file' and not os.path.isabs(value):
+                value = os.path.join(base_dir, value)
+            nvs.write_entry(partition, key, kind, encoding, value)
+    return out.getvalue()
+
+
+def nvs_partition(table):
+    """
+    (offset, size) of the nvs partition in a binary partition table (gen_esp32part format), or None.
+
+    A partition labelled nvs wins over other data/nvs partitions, such as an
+    nvs_keys or a second NVS for the application's own use.
+    """
+    found = []
+    for pos in range(0, len(table) - PARTITION_ENTRY_SIZE + 1, PARTITION_ENTRY_SIZE):
+        entry = table[pos:pos + PARTITION_ENTRY_SIZE]
+        if entry[:2] != PARTITION_TABLE_MAGIC:
+            break  # The MD5 entry or the end of the table
+        kind, subtype, offset, size = struct.unpack('<BBII', entry[2:12])
+        label = entry[12:28].split(b'\0', 1)[0].decode('ascii', 'replace')
+        if kind == DATA_TYPE and subtype == NVS_SUBTYPE:
+            found.append((label != 'nvs', offset, size))
+    if not found:
+        return None
+    _, offset, size = min(found, key=lambda f: f[0])
+    return offset, size
+
+
+def file_id(identity_id):
+    return re.sub(r'[^A-Za-z0-9.-]', '-', identity_id)
+
+
+class PersonalizationFactory:
+    """Keeps personalization images ready and hands out one per board."""
+
+    def __init__(self, directory, template, identities, size=NVS_SIZE,
+                 ahead=READY_AHEAD, max_workers=None, log=print):
+        if size < 0x3000 or size % 0x1000:
+            raise ValueError(f"An NVS partition needs at least 3 pages of 4 KB, not {size:#x} bytes.")
+        self.size = size
+        self.ahead = ahead
+        self.log = log
+        self.template = load_template(template)
+        self.identities_path = identities
+        self.identities = load_identities(identities)
+        self.ready_dir = os.path.join(directory, 'ready')
+        self.claimed_dir = os.path.join(directory, 'claimed')
+        self.used_dir = os.path.join(directory, 'used')
+        for d in (self.ready_dir, self.claimed_dir, self.used_dir):
+            os.makedirs(d, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._failed = set()  # Identities whose image could not be built, not retried
+        self._executor = ProcessPoolExecutor(max_workers)
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """The factory for directory/template.csv and identities.csv (or .sqlite), or None."""
+        template = os.path.join(directory, 'template.csv')
+        for name in ('identities.csv', 'identities.sqlite'):
+            identities = os.path.join(directory, name)
+            if os.path.exists(template) and os.path.exists(identities):
+                return cls(directory, template, identities, **kwargs)
+        return None
+
+    def _taken(self):
+        """Identities that already have an image, ready, claimed or used."""
+        taken = {name[:-4] for name in os.listdir(self.ready_dir) if name.endswith('.bin')}
+        for directory in (self.claimed_dir, self.used_dir):
+            taken.update(name[:-4].split('_', 1)[1] for name in os.listdir(directory) if name.endswith('.bin'))
+        return taken
+
+    def ready_count(self):
+        return sum(1 for name in os.listdir(self.ready_dir) if name.endswith('.bin'))
+
+    def fill(self):
+        """Start building images until READY_AHEAD are ready or on their way."""
+        with self._lock:
+            missing = self.ahead - self.ready_count() - len(self._pending)
+            if missing <= 0:
+                return
+            taken = self._taken() | self._pending | self._failed
+            base_dir = os.path.dirname(os.path.abspath(self.identities_path))
+            for identity in self.identities:
+                if missing <= 0:
+                    break
+                name = file_id(next(iter(identity.values())))
+                if name in taken:
+                    continue
+                future = self._executor.submit(build_image, self.template, identity, self.size, base_dir)
+                future.add_done_callback(lambda f, name=name: self._built(name, f))
+                self._pending.add(name)
+                missing -= 1
+
+    def _built(self, name, future):
+        try:
+            if future.cancelled():
+                return
+            error = future.exception()
+            if error is not None:
+                self.log(f"Could not build the personalization image for {name}: {error}")
+                with self._lock:
+                    self._failed.add(name)
+                return
+            path = os.path.join(self.ready_dir, name + '.bin')
+            with open(path + '.tmp', 'wb') as f:
+                f.write(future.result())
+            os.replace(path + '.tmp', path)
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+    def _find(self, directory, mac):
+        prefix = mac.replace(':', '') + '_'
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name.endswith('.bin'):
+                return os.path.join(directory, name)
+        return None
+
+    def placement(self, table):
+        """Where the partition table (bytes, or None) puts the image: its nvs partition's offset."""
+        if table is None:
+            raise FatalError("Personalization needs a partition table among the images, to find the nvs partition.")
+        location = nvs_partition(table)
+        if location is None:
+            raise FatalError("The partition table has no nvs partition to personalize.")
+        offset, size = location
+        if size != self.size:
+            raise FatalError(
+                f"The nvs partition at {offset:#x} is {size:#x} bytes, personalization images are {self.size:#x}."
+            )
+        return offset
+
+    def claim(self, mac, table):
+        """
+        The personalization region for a board, claiming a new identity if it has none.
+
+        table is the partition table flashed with it, see placement().
+        """
+        address = self.placement(table)
+        path = self._find(self.used_dir, mac) or self._find(self.claimed_dir, mac)
+        if path is None:
+            for name in sorted(os.listdir(self.ready_dir)):
+                if not name.endswith('.bin'):
+                    continue
+                target = os.path.join(self.claimed_dir, f"{mac.replace(':', '')}_{name}")
+                try:
+                    os.rename(os.path.join(self.ready_dir, name), target)
+                except FileNotFoundError:
+                    continue  # Claimed by another job in the meantime
+                path = target
+                break
+            self.fill()
+        if path is None:
+            raise FatalError("No personalization image is ready, check the identities list.")
+        self.log(f"Personalizing {mac} as {os.path.basename(path)[:-4].split('_', 1)[1]}.")
+        return Region(address, path)
+
+    def commit(self, mac):
+        """Mark the board's identity as used once it was written and verified."""
+        path = self._find(self.claimed_dir, mac)
+        if path is not None:
+            os.replace(path, os.path.join(self.used_dir, os.path.basename(path)))
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
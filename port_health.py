@@ -0,0 +1,77 @@
+"""
+Per-port history of serial errors, used to pick a baud rate a port can sustain.
+
+Every write attempt is recorded as an outcome for its port and baud rate. A
+job starts at the fastest rung of the baud ladder whose recent error rate is
+acceptable, so chronically flaky ports (bad hub, long cable, marginal
+adapter) stop failing at full speed while good ports keep it. Outcomes expire
+after a while, so a port that was fixed gets to try full speed again.
+"""
+import json
+import os
+import threading
+import time
+
+# Rates tried from fastest to slowest after a serial error
+BAUD_LADDER = (2000000, 1500000, 921600, 460800, 230400, 115200)
+
+MAX_ERROR_RATE = 0.25  # Above this, a rate is skipped when a job starts
+MIN_SAMPLES = 4  # Outcomes needed before a rate can be judged
+MAX_SAMPLES = 20  # Outcomes kept per port and rate
+MAX_AGE = 12 * 3600  # Seconds an outcome stays relevant
+
+
+def baud_ladder(baud):
+    """The requested rate followed by every slower ladder rung."""
+    return [baud] + [rate for rate in BAUD_LADDER if rate < baud]
+
+
+class PortHealth:
+    """Error history per port and baud rate, persisted as JSON."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._lock = threading.Lock()
+        self._history = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self._history = json.load(f)
+            except (OSError, ValueError):
+                self._history = {}
+
+    def _outcomes(self, port, baud):
+        cutoff = time.time() - MAX_AGE
+        outcomes = self._history.get(port, {}).get(str(baud), [])
+        return [(t, ok) for t, ok in outcomes if t >= cutoff]
+
+    def error_rate(self, port, baud):
+        """Fraction of recent attempts that failed, or None without enough samples."""
+        with self._lock:
+            outcomes = self._outcomes(port, baud)
+        if len(outcomes) < MIN_SAMPLES:
+            return None
+        return sum(1 for _, ok in outcomes if not ok) / len(outcomes)
+
+    def start_baud(self, port, baud):
+        """The fastest rate at or below baud this port has been reliable at lately."""
+        for rate in baud_ladder(baud):
+            error_rate = self.error_rate(port, rate)
+            if error_rate is None or error_rate <= MAX_ERROR_RATE:
+                return rate
+        return baud_ladder(baud)[-1]
+
+    def record(self, port, baud, ok):
+        with self._lock:
+            outcomes = self._outcomes(port, baud) + [(time.time(), bool(ok))]
+            self._history.setdefault(port, {})[str(baud)] = outcomes[-MAX_SAMPLES:]
+            self._save()
+
+    def _save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self._history, f)
+        os.replace(tmp, self.path)
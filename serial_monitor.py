@@ -0,0 +1,251 @@
+"""
+Serial monitor that takes over a board's port right after it was flashed.
+
+A dedicated thread reads whatever the driver has in large chunks into a ring
+buffer and, optionally, a rotated log file, so it keeps up with 2 Mbaud of
+boot log output whatever the display does. The display pulls from the ring
+buffer at its own frame rate; when it falls behind by more than the ring
+holds, it skips ahead and says how much it skipped. The log file gets every
+byte.
+
+FlashJob(monitor_baud=...) switches its open port to the monitor rate before
+the hard reset and starts a monitor on it right after, so the first boot
+lines are not lost in a reopen. The running monitor is handed over as
+job.handover; log_to() adds a log file later, starting from what the ring
+buffer already holds.
+
+    python serial_monitor.py /dev/ttyUSB0 --baud 115200 --log logs/monitor.log
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+import serial
+
+RING_SIZE = 4 * 1024 * 1024
+READ_SIZE = 64 * 1024  # Bytes asked of the driver per read at most
+READ_TIMEOUT = 0.02  # Seconds a read waits for the first byte
+DRIVER_BUFFER = 1024 * 1024  # Requested receive buffer, honoured on Windows only
+LOG_MAX_BYTES = 10 * 1024 * 1024
+LOG_BACKUPS = 5
+REOPEN_INTERVAL = 0.2  # Seconds between attempts after the port went away (USB-OTG re-enumerating)
+
+
+class RingBuffer:
+    """The last capacity bytes of a stream, read by position so a slow reader can tell what it missed."""
+
+    def __init__(self, capacity=RING_SIZE):
+        self.capacity = capacity
+        self._buffer = bytearray(capacity)
+        self._lock = threading.Condition()
+        self.total = 0  # Bytes written since the start
+
+    def write(self, data):
+        with self._lock:
+            if len(data) >= self.capacity:
+                self.total += len(data) - self.capacity
+                data = data[-self.capacity:]
+            start = self.total % self.capacity
+            first = min(len(data), self.capacity - start)
+            self._buffer[start:start + first] = data[:first]
+            self._buffer[:len(data) - first] = data[first:]
+            self.total += len(data)
+            self._lock.notify_all()
+
+    def wait(self, position, timeout):
+        """Wait until there is data past position. Returns whether there is."""
+        with self._lock:
+            return self._lock.wait_for(lambda: self.total > position, timeout)
+
+    def read_since(self, position, limit=None):
+        """
+        (data, next_position, skipped): the bytes written since position.
+
+        skipped counts the bytes that were already overwritten, or passed
+        over to keep data within limit, which keeps the newest bytes.
+        """
+        with self._lock:
+            available = self.total - position
+            keep = min(available, self.capacity)
+            if limit is not None:
+                keep = min(keep, limit)
+            start = (self.total - keep) % self.capacity
+            end = start + keep
+            if end <= self.capacity:
+                data = bytes(self._buffer[start:end])
+            else:
+                data = bytes(self._buffer[start:]) + bytes(self._buffer[:end - self.capacity])
+            return data, self.total, available - keep
+
+
+class RotatingLog:
+    """Raw bytes to path, moved to path.1 (path.2, ...) once it reaches max_bytes."""
+
+    def __init__(self, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(path, 'ab')
+
+    def write(self, data):
+        self._file.write(data)
+        if self._file.tell() >= self.max_bytes:
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        for n in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{n}"):
+                os.replace(f"{self.path}.{n}", f"{self.path}.{n + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        self._file = open(self.path, 'wb')
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class SerialMonitor:
+    """
+    Reads a port on its own thread into a RingBuffer and an optional RotatingLog.
+
+    Pass the open serial.Serial a FlashJob handed over, or a port name to
+    open. Errors and reconnects are reported through log, not raised.
+    """
+
+    def __init__(self, port, baud=115200, log_path=None, ring_size=RING_SIZE, log=print):
+        if isinstance(port, serial.Serial):
+            self._serial = port
+            self.port = port.port
+        else:
+            self._serial = None
+            self.port = port
+        self.baud = baud
+        self.log = log
+        self.ring = RingBuffer(ring_size)
+        self.log_file = RotatingLog(log_path) if log_path else None
+        self._log_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._serial is None:
+            self._serial = self._open()
+        else:
+            self._configure(self._serial)
+        self._thread = threading.Thread(target=self._read_loop, name=f"monitor-{self.port}", daemon=True)
+        self._thread.start()
+        return self
+
+    def _open(self):
+        port = serial.Serial()
+        port.port = self.port
+        port.baudrate = self.baud
+        # Opening must not reset the board, which is what DTR/RTS would do on most adapters
+        port.dtr = False
+        port.rts = False
+        port.open()
+        self._configure(port)
+        return port
+
+    def _configure(self, port):
+        port.baudrate = self.baud
+        port.timeout = READ_TIMEOUT
+        if hasattr(port, 'set_buffer_size'):
+            try:
+                port.set_buffer_size(rx_size=DRIVER_BUFFER)
+            except serial.SerialException:
+                pass
+
+    def _read_loop(self):
+        while not self._stop.is_set():
+            try:
+                data = self._serial.read(min(max(self._serial.in_waiting, 1), READ_SIZE))
+            except (serial.SerialException, OSError, TypeError) as e:
+                if self._stop.is_set():
+                    break
+                self.log(f"{self.port} went away ({e}), waiting for it to come back...")
+                self._reopen()
+                continue
+            with self._log_lock:
+                if data:
+                    self.ring.write(data)
+                    if self.log_file is not None:
+                        self.log_file.write(data)
+                elif self.log_file is not None:
+                    self.log_file.flush()  # Idle, so the file catches up
+
+    def log_to(self, path):
+        """Also write the output to a rotated log, starting with what the ring buffer holds."""
+        with self._log_lock:
+            if self.log_file is not None:
+                return
+            self.log_file = RotatingLog(path)
+            data, _, _ = self.ring.read_since(0)
+            self.log_file.write(data)
+
+    def _reopen(self):
+        try:
+            self._serial.close()
+        except (serial.SerialException, OSError):
+            pass
+        while not self._stop.wait(REOPEN_INTERVAL):
+            try:
+                self._serial = self._open()
+            except (serial.SerialException, OSError):
+                continue
+            self.log(f"Monitoring {self.port} again.")
+            return
+
+    def stop(self, timeout=1.0):
+        """Stop reading and release the port. Bounded by timeout plus one read."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self._serial is not None:
+            try:
+                self._serial.close()
+            except (serial.SerialException, OSError):
+                pass
+        with self._log_lock:
+            if self.log_file is not None:
+                self.log_file.close()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Watch a board's serial output.")
+    parser.add_argument('port')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--log', help="Also write the raw output to this file, rotated at 10 MB")
+    args = parser.parse_args()
+
+    monitor = SerialMonitor(args.port, args.baud, args.log, log=lambda m: print(m, file=sys.stderr)).start()
+    position = 0
+    try:
+        while True:
+            time.sleep(0.05)
+            data, position, skipped = monitor.ring.read_since(position)
+            if skipped:
+                print(f"[{skipped} bytes skipped]", file=sys.stderr)
+            sys.stdout.buffer.write(data)
+            sys.stdout.flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        monitor.stop()
+
+
+if __name__ == '__main__':
+    main()
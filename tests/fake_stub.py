@@ -0,0 +1,138 @@
+"""
+A stub loader in memory, for driving the write path without a device.
+
+Like the real stub it ACKs a block before writing it: the block is only
+committed to flash when the next command arrives, so a failure drops the
+last ACKed block, the way a reset mid-write does.
+"""
+import hashlib
+import random
+import zlib
+
+from esptool.util import FatalError
+
+import flash_engine
+
+
+class FakePort:
+    def __init__(self):
+        self.is_open = True
+        self.timeout = 3
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeStub:
+    IS_STUB = True
+    CHIP_NAME = 'ESP32'
+    FLASH_WRITE_SIZE = 0x4000
+    FLASH_SECTOR_SIZE = 0x1000
+    BOOTLOADER_FLASH_OFFSET = 0x1000
+    USB_OTG_SUPPORTED = False
+    ESP_CMDS = {'FLASH_DATA': 0x03, 'FLASH_DEFL_DATA': 0x11}
+    MAC = bytes.fromhex('aabbccddeeff')
+    secure_download_mode = False
+    _trace_enabled = False
+
+    def __init__(self, flash_size=0x400000):
+        self.flash = bytearray(b'\xff' * flash_size)
+        self.sent = []  # (address, size) of every flash_*_begin
+        self.blocks = 0  # Data blocks received over all segments
+        self.fail_blocks = set()  # Numbers of the data blocks that fail, counting from 1
+        self.fail_finish = 0  # How many flash_*_finish commands fail
+        self.on_fail = None  # Called with the stub after a failure dropped the pending block
+        self.md5_calls = 0
+        self.reads = 0  # read_flash_slow commands
+        self._port = FakePort()
+        self._pending = None
+        self._address = self._end = 0
+        self._inflate = None
+
+    # What FlashJob.connect() and the checks around the write ask of a loader
+
+    def command(self, op=None, data=b"", chk=0, wait_response=True, timeout=None):
+        raise NotImplementedError("The fake stub only takes flash commands")
+
+    def uses_usb_jtag_serial(self):
+        return False
+
+    def change_baud(self, baud):
+        self.baud = baud
+
+    def flash_set_parameters(self, size):
+        self.flash_size = size
+
+    def read_mac(self):
+        return self.MAC
+
+    def _commit(self):
+        if self._pending is not None:
+            address, data = self._pending
+            self.flash[address:address + len(data)] = data
+            self._pending = None
+
+    def _fail(self, message):
+        self._pending = None
+        if self.on_fail is not None:
+            self.on_fail(self)
+        raise FatalError(message)
+
+    def _begin(self, size, offset, inflate):
+        self._commit()
+        self.sent.append((offset, size))
+        self._address, self._end, self._inflate = offset, offset + size, inflate
+
+    def flash_begin(self, size, offset):
+        self._begin(size, offset, None)
+
+    def flash_defl_begin(self, size, compsize, offset):
+        self._begin(size, offset, zlib.decompressobj())
+
+    def _block(self, data):
+        self.blocks += 1
+        if self.blocks in self.fail_blocks:
+            self._fail(f"Block {self.blocks} timed out")
+        self._commit()
+        data = data[:self._end - self._address]  # Padding of the last plain block
+        self._pending = (self._address, data)
+        self._address += len(data)
+
+    def flash_block(self, data, seq, timeout=None):
+        self._block(data)
+
+    def flash_defl_block(self, data, seq, timeout=None):
+        self._block(self._inflate.decompress(data))
+
+    def flash_finish(self, reboot=False, timeout=None):
+        if self.fail_finish:
+            self.fail_finish -= 1
+            self._fail("Timed out waiting for packet header")
+        self._commit()
+
+    flash_defl_finish = flash_finish
+
+    def read_flash_slow(self, offset, length, progress_fn=None):
+        self._commit()
+        self.reads += 1
+        return bytes(self.flash[offset:offset + length])
+
+    def flash_md5sum(self, address, size):
+        self._commit()
+        self.md5_calls += 1
+        return hashlib.md5(self.flash[address:address + size]).hexdigest()
+
+
+def image(size, seed, compressible=False):
+    """Reproducible image contents; compressible ones deflate to about half."""
+    rng = random.Random(seed)
+    if compressible:
+        return bytes(rng.getrandbits(4) for _ in range(size))
+    return rng.randbytes(size)
+
+
+def region(address, data, name=None):
+    """A prepared Region holding data, without a file behind it."""
+    result = flash_engine.Region(address, name or f"image-{address:#x}.bin")
+    result.data, result.md5 = data, hashlib.md5(data).hexdigest()
+    return result.prepare()
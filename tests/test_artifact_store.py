@@ -0,0 +1,82 @@
+import os
+import sqlite3
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import artifact_store
+from artifact_store import CHUNK_SIZE, PRUNE_GRACE, ArtifactStore
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """The store's clock, set by the test. Chunk files keep their real mtime."""
+    now = SimpleNamespace(value=time.time())
+    monkeypatch.setattr(artifact_store, 'time', SimpleNamespace(time=lambda: now.value))
+    return now
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = ArtifactStore(str(tmp_path))
+    yield store
+    store.close()
+
+
+def chunk_files(store):
+    return {name for _, _, names in os.walk(store.chunk_dir) for name in names}
+
+
+def image(*fills):
+    """An image of one chunk per fill byte."""
+    return b''.join(bytes([fill]) * CHUNK_SIZE for fill in fills)
+
+
+def test_prune_drops_only_orphans_past_the_grace_period(store, clock):
+    shared = image(1)
+    old = store.put(shared + image(2))
+    store.name('app.bin', old)
+    new = store.put(shared + image(3))
+    store.name('app.bin', new)
+    kept = store.put(image(4))
+    store.name('bootloader.bin', kept)
+    chunks = chunk_files(store)
+
+    assert store.prune() == (0, 0)  # The old app is unreferenced but inside the grace period
+
+    clock.value += PRUNE_GRACE + 1
+    assert store.prune() == (1, 1)
+    assert store.size(old) is None
+    assert chunks - chunk_files(store) == {store._put_chunk(image(2))}
+    assert store.read(new) == shared + image(3)
+    assert store.read(kept) == image(4)
+    assert [name for name, _, _ in store.names()] == ['app.bin', 'bootloader.bin']
+
+
+def test_image_being_added_survives_a_prune(store, clock):
+    # Between put() and name() the upload has no name yet
+    digest = store.put(image(5, 6))
+    assert store.prune() == (0, 0)
+    store.name('upload.bin', digest)
+    assert store.read(digest) == image(5, 6)
+
+    clock.value += PRUNE_GRACE + 1
+    assert store.prune() == (0, 0)
+
+
+def test_catalog_without_added_at_is_upgraded(tmp_path, clock):
+    db = sqlite3.connect(str(tmp_path / 'catalog.sqlite'))
+    db.executescript("""
+        CREATE TABLE artifacts (sha256 TEXT PRIMARY KEY, size INTEGER NOT NULL, chunks TEXT NOT NULL);
+        INSERT INTO artifacts VALUES ('00', 0, '');
+    """)
+    db.commit()
+    db.close()
+
+    store = ArtifactStore(str(tmp_path))
+    try:
+        # Images from before the upgrade count as old
+        assert store.prune() == (1, 0)
+    finally:
+        store.close()
@@ -0,0 +1,62 @@
+import asyncio
+import os
+import sys
+import threading
+
+import pytest
+
+import async_engine
+import flash_engine
+from fake_stub import image, region
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks'))
+
+from bench_async_scaling import open_boards, serve  # noqa: E402
+
+
+@pytest.fixture
+def board():
+    """The path of a simulated ESP32, served from a thread."""
+    masters, paths, keep = open_boards(1)
+    ready, stop = threading.Event(), threading.Event()
+    thread = threading.Thread(target=serve, args=(masters, ready, stop), daemon=True)
+    thread.start()
+    ready.wait()
+    yield paths[0]
+    stop.set()
+    thread.join()
+    for fd in masters + keep:
+        os.close(fd)
+
+
+@pytest.fixture
+def preparer():
+    preparer = flash_engine.ImagePreparer()
+    yield preparer
+    preparer.shutdown()
+
+
+def prepared(preparer, address, data):
+    r = region(address, data)
+    r.sha256 = r.md5  # Keys the preparer's cache without a file behind the region
+    return preparer.prepare([r])
+
+
+def test_flash_a_simulated_board(board, preparer):
+    job = async_engine.AsyncFlashJob(board, prepared(preparer, 0x10000, image(0x8000, 1, compressible=True)),
+                                     chip='esp32', before='no-reset', after='no-reset', log=lambda *a: None)
+    asyncio.run(job.run())
+    assert job.result == 'ok'
+    assert job.flash_size == 4 * 1024 * 1024
+    assert [v.ok for v in job.verification] == [True]
+
+
+def test_a_port_that_does_not_open_fails_the_job(tmp_path, preparer):
+    lines = []
+    job = async_engine.AsyncFlashJob(str(tmp_path / 'ttyMISSING'), prepared(preparer, 0x10000, image(0x1000, 2)),
+                                     log=lines.append)
+    with pytest.raises(Exception):
+        asyncio.run(job.run())
+    assert job.result == 'failed'
+    assert 'ttyMISSING' in job.error
+    assert 'connect' in job.timings
@@ -0,0 +1,94 @@
+import pytest
+
+import flash_engine
+from fake_stub import FakeStub, image, region
+from flash_engine import MIN_BLOCK_SIZE, PROBE_BLOCKS, BlockSizer
+
+LIMIT = 0x4000  # The stubs' FLASH_WRITE_SIZE
+
+
+def probe(sizer, round_trip, rate):
+    """Feed the sizer a begin and PROBE_BLOCKS full blocks over a link of the given round trip and bytes/s."""
+    sizer.begin_done(round_trip)
+    for _ in range(PROBE_BLOCKS):
+        sizer.block_done(sizer.block_size, round_trip + sizer.block_size / rate)
+
+
+def uart(baud):
+    """Bytes per second of a UART bridge, 10 bits a byte."""
+    return baud / 10
+
+
+@pytest.mark.parametrize('link, round_trip, rate, block_size', [
+    ('native USB', 0.0005, 1_000_000, 0x4000),
+    ('UART bridge, 2000000 baud', 0.004, uart(2_000_000), 0x4000),
+    ('UART bridge, 460800 baud', 0.004, uart(460_800), 0x2000),
+    ('UART bridge, 115200 baud', 0.004, uart(115_200), 0x800),
+    ('UART bridge, 9600 baud', 0.004, uart(9_600), MIN_BLOCK_SIZE),
+])
+def test_choice(link, round_trip, rate, block_size):
+    sizer = BlockSizer(LIMIT, log=lambda *a: None)
+    probe(sizer, round_trip, rate)
+    assert sizer.block_size == block_size, link
+    assert sizer.params['round_trip_ms'] == round(round_trip * 1000, 2)
+    assert sizer.params['rate'] == pytest.approx(rate, rel=0.01)
+
+
+def test_fixed_block_size_is_kept():
+    sizer = BlockSizer(LIMIT, 0x1000, log=lambda *a: None)
+    probe(sizer, 0.004, uart(115_200))
+    assert sizer.block_size == 0x1000
+    assert sizer.rate == pytest.approx(uart(115_200))
+    sizer.write_failed()
+    assert sizer.block_size == 0x1000
+
+
+def test_short_blocks_are_not_probes():
+    sizer = BlockSizer(LIMIT, log=lambda *a: None)
+    sizer.begin_done(0.004)
+    for _ in range(PROBE_BLOCKS):
+        sizer.block_done(0x100, 1.0)
+    assert sizer.rate is None and sizer.block_size == LIMIT
+
+
+@pytest.mark.parametrize('rate_after, block_size_after', [
+    # The link is as fast as before: the halved size stays the limit
+    (uart(2_000_000), 0x2000),
+    # The reconnect went down the baud ladder: the new link is measured
+    (uart(115_200), 0x800),
+])
+def test_fallback_after_a_block_timeout(rate_after, block_size_after):
+    sizer = BlockSizer(LIMIT, log=lambda *a: None)
+    probe(sizer, 0.004, uart(2_000_000))
+    assert sizer.block_size == 0x4000
+
+    sizer.write_failed()
+    assert sizer.block_size == 0x2000
+    assert sizer.params['rate'] is None and sizer.params['round_trip_ms'] is None
+
+    probe(sizer, 0.004, rate_after)
+    assert sizer.block_size == block_size_after
+
+
+def test_fallback_stops_at_the_smallest_block():
+    sizer = BlockSizer(LIMIT, log=lambda *a: None)
+    for _ in range(8):
+        sizer.write_failed()
+    assert sizer.block_size == MIN_BLOCK_SIZE
+
+
+def test_failed_write_halves_the_job_blocks(monkeypatch):
+    monkeypatch.setattr(flash_engine, 'RETRY_BACKOFF', 0.0)
+    a = region(0x10000, image(0x40000, 5))
+    esp = FakeStub()
+    esp.fail_blocks = {10}
+    job = flash_engine.FlashJob('fake', [a], log=lambda *a: None)
+    job.mac = 'aa:bb:cc:dd:ee:ff'
+    job.connect = lambda baud=None: esp
+
+    job.write(esp, [a], None, {})
+
+    assert job.retries == 1
+    assert job.sizer.limit == 0x2000
+    assert esp.FLASH_WRITE_SIZE == 0x2000
+    assert esp.flash[a.address:a.address + len(a.data)] == a.data
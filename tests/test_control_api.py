@@ -0,0 +1,179 @@
+import http.client
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import flash_engine
+from artifact_store import ArtifactStore
+from control_api import ControlServer, Station
+from fake_stub import FakeStub, image
+
+WAIT = 10.0
+
+
+@pytest.fixture
+def serve():
+    """Serves stations on free ports, returns a request function per station."""
+    running = []
+
+    def start(station):
+        server = ControlServer(station, '127.0.0.1', 0)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        running.append((server, station))
+
+        def request(method, path, body=None):
+            connection = http.client.HTTPConnection('127.0.0.1', server.server_address[1], timeout=WAIT)
+            if isinstance(body, dict):
+                body = json.dumps(body)
+            connection.request(method, path, body)
+            response = connection.getresponse()
+            reply = json.loads(response.read() or b'null')
+            connection.close()
+            return response.status, reply
+
+        return request
+
+    yield start
+    for server, station in running:
+        server.shutdown()
+        server.server_close()
+        station.shutdown(timeout=1.0)
+
+
+@pytest.fixture
+def api(tmp_path, serve):
+    return serve(Station(ArtifactStore(str(tmp_path / 'artifacts')), state_dir=None, simulate=2, log=lambda *a: None))
+
+
+def wait_for(request, job_id, states):
+    deadline = time.monotonic() + WAIT
+    while time.monotonic() < deadline:
+        status, job = request('GET', f'/jobs/{job_id}')
+        assert status == 200
+        if job['state'] in states:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f"job {job_id} never reached {states}")
+
+
+def test_flash_simulated_board(api):
+    status, artifact = api('PUT', '/artifacts/app.bin', os.urandom(8192))
+    assert status == 201
+    status, artifacts = api('GET', '/artifacts')
+    assert [a['name'] for a in artifacts['artifacts']] == ['app.bin']
+
+    status, queued = api('POST', '/jobs', {'port': 'sim0', 'images': [{'address': '0x10000', 'name': 'app.bin'}]})
+    assert status == 202
+    job = wait_for(api, queued['id'], ('done', 'failed', 'cancelled'))
+    assert job['state'] == 'done'
+    assert job['record']['result'] == 'ok'
+    assert job['record']['images'] == [
+        {'address': 0x10000, 'name': 'app.bin', 'size': 8192, 'md5': job['record']['images'][0]['md5']}
+    ]
+    status, jobs = api('GET', '/jobs?state=done')
+    assert [j['id'] for j in jobs['jobs']] == [queued['id']]
+
+
+def test_images_by_hash(api):
+    _, artifact = api('PUT', '/artifacts/app.bin', os.urandom(4096))
+    image = {'address': 0x10000, 'sha256': artifact['sha256']}
+    status, queued = api('POST', '/jobs', {'port': 'sim1', 'images': [image]})
+    assert status == 202
+    assert wait_for(api, queued['id'], ('done', 'failed'))['state'] == 'done'
+
+
+def test_cancel_pending_job(api):
+    api('PUT', '/artifacts/app.bin', os.urandom(32 * 1024))
+    images = [{'address': '0x10000', 'name': 'app.bin'}]
+    _, running = api('POST', '/jobs', {'port': 'sim0', 'images': images})
+    _, waiting = api('POST', '/jobs', {'port': 'sim0', 'images': images})
+    status, job = api('DELETE', f"/jobs/{waiting['id']}")
+    assert (status, job['state']) == (200, 'cancelled')
+    assert api('DELETE', f"/jobs/{waiting['id']}")[0] == 409
+    assert wait_for(api, running['id'], ('done', 'failed'))['state'] == 'done'
+
+
+def test_cancel_running_job(api):
+    api('PUT', '/artifacts/big.bin', os.urandom(256 * 1024))
+    status, queued = api('POST', '/jobs', {
+        'port': 'sim0', 'baud': 115200, 'images': [{'address': '0x10000', 'name': 'big.bin'}],
+    })
+    assert status == 202
+    wait_for(api, queued['id'], ('running',))
+    status, job = api('DELETE', f"/jobs/{queued['id']}")
+    assert status == 200
+    job = wait_for(api, queued['id'], ('done', 'failed', 'cancelled'))
+    assert job['state'] == 'cancelled'
+    status, _ = api('DELETE', f"/jobs/{queued['id']}")
+    assert status == 409
+
+
+def test_bad_requests(api):
+    assert api('POST', '/jobs', b'not json')[0] == 400
+    assert api('POST', '/jobs', {'port': 'sim0'})[0] == 400
+    assert api('POST', '/jobs', {'port': 'sim0', 'images': 'app.bin'})[0] == 400
+    assert api('POST', '/jobs', {'port': 'sim0', 'images': [{'address': '0x0', 'name': 'missing.bin'}]})[0] == 404
+    assert api('POST', '/jobs', {'port': 'sim0', 'profile': 'missing'})[0] == 404
+    assert api('GET', '/jobs/abc')[0] == 400
+    assert api('GET', '/jobs/999')[0] == 404
+    assert api('GET', '/nothing')[0] == 404
+
+
+def test_flash_job_on_a_stubbed_loader(tmp_path, serve, monkeypatch):
+    esp = FakeStub()
+    resets = []
+    monkeypatch.setattr(flash_engine, 'connect_esp', lambda port, chip, initial_baud, before: esp)
+    monkeypatch.setattr(flash_engine, 'run_stub', lambda loader: loader)
+    monkeypatch.setattr(flash_engine, 'attach_flash', lambda loader: None)
+    monkeypatch.setattr(flash_engine, 'detect_flash_size', lambda loader: '4MB')
+    monkeypatch.setattr(flash_engine, 'reset_chip', lambda loader, mode: resets.append(mode))
+    station = Station(ArtifactStore(str(tmp_path / 'artifacts')), state_dir=str(tmp_path / 'state'),
+                      log=lambda *a: None)
+    api = serve(station)
+    bootloader, app = image(0x5000, 1), image(0x30000, 2, compressible=True)
+    api('PUT', '/artifacts/bootloader.bin', bootloader)
+    api('PUT', '/artifacts/app.bin', app)
+
+    status, queued = api('POST', '/jobs', {'port': '/dev/ttyFAKE0', 'images': [
+        {'address': '0x0', 'name': 'bootloader.bin'}, {'address': '0x10000', 'name': 'app.bin'},
+    ]})
+    assert status == 202
+    job = wait_for(api, queued['id'], ('done', 'failed', 'cancelled'))
+    assert job['state'] == 'done', job.get('error')
+    record = job['record']
+    assert (record['result'], record['chip'], record['mac']) == ('ok', 'ESP32', 'aa:bb:cc:dd:ee:ff')
+    # The bootloader went to the ESP32's offset
+    assert [(i['address'], i['size']) for i in record['images']] == [(0x1000, 0x5000), (0x10000, 0x30000)]
+    assert all(v['ok'] for v in record['verification'])
+    assert esp.flash[0x1000:0x6000] == bootloader
+    assert esp.flash[0x10000:0x40000] == app
+    assert esp.flash_size == 4 * 1024 * 1024
+    assert resets == ['hard-reset']
+    assert not esp._port.is_open
+    cached = station.state['device_cache'].lookup('aa:bb:cc:dd:ee:ff')
+    assert cached == {i['address']: (i['size'], i['md5']) for i in record['images']}
+
+
+def test_alternating_profiles_reuse_preparations(tmp_path, monkeypatch):
+    monkeypatch.setattr(flash_engine, 'PREPARED_KEPT', 2)
+    store = ArtifactStore(str(tmp_path / 'artifacts'))
+    station = Station(store, state_dir=None, log=lambda *a: None)
+    profiles = [[{'address': '0x10000', 'sha256': store.put(image(0x8000, seed))}] for seed in range(3)]
+
+    def prepare(images):
+        [region] = station.preparer.prepare(station.regions(images)).wait()
+        return region
+
+    try:
+        first, second = prepare(profiles[0]), prepare(profiles[1])
+        assert prepare(profiles[0]) is first
+        assert prepare(profiles[1]) is second
+        # A third profile pushes out the least recently used one
+        prepare(profiles[2])
+        assert prepare(profiles[1]) is second
+        assert prepare(profiles[0]) is not first
+    finally:
+        station.shutdown()
@@ -0,0 +1,80 @@
+import hashlib
+
+import pytest
+
+from fake_stub import FakeStub, image
+from flash_backup import SectorStore, changed_sectors, read_sectors, sector_runs
+from flash_engine import JobCancelled
+from flash_journal import ERASE_BLOCK_SIZE
+
+SECTOR = 0x1000
+FLASH_SIZE = 0x40000
+
+
+def device():
+    esp = FakeStub(FLASH_SIZE)
+    esp.flash[:] = image(FLASH_SIZE, 1)
+    return esp
+
+
+def md5(data):
+    return hashlib.md5(data).hexdigest()
+
+
+def snapshot_of(flash):
+    return {
+        'sector_md5': [md5(flash[i:i + SECTOR]) for i in range(0, len(flash), SECTOR)],
+        'block_md5': [md5(flash[i:i + ERASE_BLOCK_SIZE]) for i in range(0, len(flash), ERASE_BLOCK_SIZE)],
+    }
+
+
+def cancel_after(calls):
+    count = [0]
+
+    def check_cancelled():
+        count[0] += 1
+        if count[0] > calls:
+            raise JobCancelled("Cancelled on fake.")
+
+    return check_cancelled
+
+
+def test_sector_runs():
+    assert sector_runs([1, 2, 3, 7, 9, 10]) == [[1, 3], [7, 1], [9, 2]]
+    assert sector_runs([]) == []
+
+
+def test_changed_sectors():
+    esp = device()
+    previous = snapshot_of(esp.flash)
+    esp.flash[0x21010] ^= 0xff
+    esp.flash[0x3f000] ^= 0xff
+    assert changed_sectors(esp, previous, SECTOR) == [0x21, 0x3f]
+    # One command per block, then one per sector of the two changed blocks
+    assert esp.md5_calls == FLASH_SIZE // ERASE_BLOCK_SIZE + 2 * ERASE_BLOCK_SIZE // SECTOR
+
+
+def test_changed_sectors_stops_when_cancelled():
+    esp = device()
+    previous = snapshot_of(esp.flash)
+    with pytest.raises(JobCancelled):
+        changed_sectors(esp, previous, SECTOR, cancel_after(2))
+    assert esp.md5_calls == 2
+
+
+def test_read_sectors(tmp_path):
+    esp = device()
+    esp.IS_STUB = False  # Sector by sector through the ROM path, so a read is one chunk
+    store = SectorStore(str(tmp_path))
+    digests = read_sectors(esp, store, [2, 3, 8], SECTOR)
+    assert sorted(digests) == [2, 3, 8]
+    for index, digest in digests.items():
+        assert store.get(digest) == esp.flash[index * SECTOR:(index + 1) * SECTOR]
+
+
+def test_read_sectors_stops_when_cancelled(tmp_path):
+    esp = device()
+    esp.IS_STUB = False
+    with pytest.raises(JobCancelled):
+        read_sectors(esp, SectorStore(str(tmp_path)), range(FLASH_SIZE // SECTOR), SECTOR, cancel_after(3))
+    assert esp.reads == 4
@@ -0,0 +1,99 @@
+import json
+import os
+
+import pytest
+
+import flash_engine
+from fake_stub import FakeStub, image, region
+from flash_journal import ERASE_BLOCK_SIZE, FlashJournal
+
+MAC = 'aa:bb:cc:dd:ee:ff'
+ADDRESS = 0x10000
+
+
+@pytest.mark.parametrize('size, held, upper, expected', [
+    (0x30000, 0, 0x30000, 0),  # Nothing on the device
+    (0x30000, 0x1ffff, 0x30000, 0x10000),  # One byte short of the second erase block
+    (0x30000, 0x20000, 0x30000, 0x20000),
+    (0x30000, 0x30000, 0x30000, 0x30000),  # All of it
+    (0x30000, 0x30000, 0x20000, 0x20000),  # Never past what the journal says
+    (0x30000, 0x30000, 0x2ffff, 0x20000),
+    (0x28000, 0x28000, 0x28000, 0x20000),  # The unaligned last erase block is always sent again
+    (0x28000, 0x27fff, 0x28000, 0x20000),
+    (0x28000, 0x20000, 0x28000, 0x20000),
+    (0x8000, 0x8000, 0x8000, 0),  # Smaller than an erase block
+])
+def test_written_prefix(size, held, upper, expected):
+    r = region(ADDRESS, image(size, size))
+    esp = FakeStub()
+    esp.flash[ADDRESS:ADDRESS + held] = r.data[:held]
+    assert flash_engine.written_prefix(esp, r, upper) == expected
+    assert esp.md5_calls <= 1 + (size // ERASE_BLOCK_SIZE).bit_length()
+
+
+def test_written_prefix_stops_at_the_first_bad_block():
+    r = region(ADDRESS, image(0x40000, 1))
+    esp = FakeStub()
+    esp.flash[ADDRESS:ADDRESS + 0x40000] = r.data
+    esp.flash[ADDRESS + 0x18000] ^= 0xff
+    assert flash_engine.written_prefix(esp, r, 0x40000) == 0x10000
+
+
+def test_journal_rounds_down_and_reloads(tmp_path):
+    a = region(0x10000, image(0x30000, 2))
+    b = region(0x100000, image(0x20000, 3))
+    entry = FlashJournal(str(tmp_path)).open(MAC, [a, b])
+    entry.update(a.address, 0x2ffff)
+    entry.update(b.address, 0x0ffff)
+    with open(entry.path) as f:
+        saved = json.load(f)
+    assert saved['mac'] == MAC
+    assert saved['regions'] == {
+        str(a.address): {'md5': a.md5, 'acked': 0x20000},
+        str(b.address): {'md5': b.md5, 'acked': 0},
+    }
+
+    reloaded = FlashJournal(str(tmp_path)).open(MAC, [a, b])
+    assert reloaded.resumable == {a.address: 0x20000}
+    # Another image at the same address starts over
+    other = region(0x10000, image(0x30000, 4))
+    assert FlashJournal(str(tmp_path)).open(MAC, [other, b]).resumable == {}
+
+
+def test_resume_from_a_reloaded_journal(tmp_path):
+    a = region(0x10000, image(0x30000, 5))
+    b = region(0x100000, image(0x28000, 6))
+    esp = FakeStub()
+    # The journal got ahead of the flash on b: its last ACKed block was never written
+    esp.flash[a.address:a.address + 0x20000] = a.data[:0x20000]
+    esp.flash[b.address:b.address + 0x18000] = b.data[:0x18000]
+    earlier = FlashJournal(str(tmp_path)).open(MAC, [a, b])
+    earlier.update(a.address, 0x20000)
+    earlier.update(b.address, 0x20000)
+
+    job = flash_engine.FlashJob('fake', [a, b], journal=FlashJournal(str(tmp_path)), log=lambda *args: None)
+    job.mac = MAC
+    entry, start_offsets = job.resume(esp, [a, b])
+    assert start_offsets == {a.address: 0x20000, b.address: 0x10000}
+    assert job.resumed_bytes == 0x30000
+    with open(entry.path) as f:
+        regions = json.load(f)['regions']
+    assert {int(k): v['acked'] for k, v in regions.items()} == {a.address: 0x20000, b.address: 0x10000}
+
+    job.write(esp, [a, b], entry, start_offsets)
+    assert esp.sent == [(a.address + 0x20000, 0x10000), (b.address + 0x10000, 0x18000)]
+    for r in (a, b):
+        assert esp.flash[r.address:r.address + len(r.data)] == r.data
+    entry.discard()
+    assert not os.path.exists(entry.path)
+
+
+def test_no_resume_off_a_sector_boundary(tmp_path):
+    r = region(0x10800, image(0x20000, 7))
+    esp = FakeStub()
+    esp.flash[r.address:r.address + 0x20000] = r.data
+    FlashJournal(str(tmp_path)).open(MAC, [r]).update(r.address, 0x10000)
+    job = flash_engine.FlashJob('fake', [r], journal=FlashJournal(str(tmp_path)), log=lambda *args: None)
+    job.mac = MAC
+    _, start_offsets = job.resume(esp, [r])
+    assert start_offsets == {}
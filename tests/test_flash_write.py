@@ -0,0 +1,122 @@
+import json
+
+import pytest
+
+import flash_engine
+from fake_stub import FakeStub, image, region
+from flash_journal import ERASE_BLOCK_SIZE, FlashJournal
+
+MAC = 'aa:bb:cc:dd:ee:ff'
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(flash_engine, 'RETRY_BACKOFF', 0.0)
+
+
+def flash_job(esp, regions):
+    """A FlashJob whose reconnects hand back the same stub, as after a reset."""
+    job = flash_engine.FlashJob('fake', regions, log=lambda *a: None)
+    job.mac = MAC
+    job.connect = lambda baud=None: esp
+    return job
+
+
+def journal_acked(path):
+    with open(path) as f:
+        return {int(a): r['acked'] for a, r in json.load(f)['regions'].items()}
+
+
+def written_oracle(esp, r):
+    """The largest erase-block prefix of a region the flash really holds, found the slow way."""
+    size = len(r.data) - len(r.data) % ERASE_BLOCK_SIZE
+    while size and esp.flash[r.address:r.address + size] != r.data[:size]:
+        size -= ERASE_BLOCK_SIZE
+    return size
+
+
+def assert_written(esp, regions):
+    for r in regions:
+        assert esp.flash[r.address:r.address + len(r.data)] == r.data
+
+
+def test_block_failure_resends_the_failed_region_from_its_prefix(tmp_path):
+    a = region(0x10000, image(0x30000, 1))
+    b = region(0x100000, image(0x50000, 2))
+    esp = FakeStub()
+    entry = FlashJournal(str(tmp_path)).open(MAC, [a, b])
+    # a takes 12 blocks, b's 7th block fails after 6 were ACKed and 5 reached the flash
+    esp.fail_blocks = {12 + 7}
+    at_failure = []
+    esp.on_fail = lambda stub: at_failure.append(journal_acked(entry.path))
+    job = flash_job(esp, [a, b])
+
+    job.write(esp, [a, b], entry, {})
+
+    assert at_failure == [{a.address: 0x30000, b.address: 0x10000}]
+    assert esp.sent == [
+        (a.address, 0x30000),
+        (b.address, 0x40000),
+        # The journal's 64 KB, checked against the flash, and nothing of a
+        (b.address + 0x10000, 0x30000),
+        (b.address + 0x40000, 0x10000),
+    ]
+    assert job.retries == 1
+    assert journal_acked(entry.path) == {a.address: 0x30000, b.address: 0x50000}
+    assert_written(esp, [a, b])
+
+
+def test_failed_finish_resends_the_tail_of_the_last_region(tmp_path):
+    a = region(0x10000, image(0x20000, 3, compressible=True))
+    b = region(0x100000, image(0x30000, 4, compressible=True))
+    assert all(s.compressed for r in (a, b) for s in r.segments)
+    esp = FakeStub()
+    entry = FlashJournal(str(tmp_path)).open(MAC, [a, b])
+    esp.fail_finish = 1
+    at_failure = []
+    esp.on_fail = lambda stub: at_failure.append((journal_acked(entry.path), written_oracle(stub, b)))
+    job = flash_job(esp, [a, b])
+
+    job.write(esp, [a, b], entry, {})
+
+    # Every block was ACKed, but the last one never reached the flash
+    [(acked, prefix)] = at_failure
+    assert acked == {a.address: 0x20000, b.address: 0x30000}
+    assert prefix < 0x30000
+    assert esp.sent == [(a.address, 0x20000), (b.address, 0x30000), (b.address + prefix, 0x30000 - prefix)]
+    assert journal_acked(entry.path) == {a.address: 0x20000, b.address: 0x30000}
+    assert_written(esp, [a, b])
+
+
+def test_retry_keeps_the_journal_offsets_of_untouched_regions(tmp_path):
+    a = region(0x10000, image(0x30000, 5))
+    b = region(0x100000, image(0x20000, 6))
+    c = region(0x200000, image(0x40000, 7))
+    esp = FakeStub()
+    # An earlier attempt got through 64 KB of a and 128 KB of c
+    esp.flash[a.address:a.address + 0x10000] = a.data[:0x10000]
+    esp.flash[c.address:c.address + 0x20000] = c.data[:0x20000]
+    journal = FlashJournal(str(tmp_path))
+    earlier = journal.open(MAC, [a, b, c])
+    earlier.update(a.address, 0x10000)
+    earlier.update(c.address, 0x20000)
+    job = flash_job(esp, [a, b, c])
+    job.journal = journal
+    entry, start_offsets = job.resume(esp, [a, b, c])
+    assert start_offsets == {a.address: 0x10000, c.address: 0x20000}
+    # a sends 8 blocks, b's 3rd block fails
+    esp.fail_blocks = {8 + 3}
+    at_failure = []
+    esp.on_fail = lambda stub: at_failure.append(journal_acked(entry.path))
+
+    job.write(esp, [a, b, c], entry, start_offsets)
+
+    assert at_failure == [{a.address: 0x30000, b.address: 0, c.address: 0x20000}]
+    assert esp.sent == [
+        (a.address + 0x10000, 0x20000),
+        (b.address, 0x20000),
+        (b.address, 0x20000),
+        (c.address + 0x20000, 0x20000),
+    ]
+    assert journal_acked(entry.path) == {a.address: 0x30000, b.address: 0x20000, c.address: 0x40000}
+    assert_written(esp, [a, b, c])
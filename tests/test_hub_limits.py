@@ -0,0 +1,75 @@
+from hub_limits import MAX_ERROR_RATE, MIN_SAMPLES, HubLimits, hub_of
+
+HUB = '1-1.4'
+
+
+def limits(**kwargs):
+    return HubLimits(None, log=lambda *a: None, **kwargs)
+
+
+def record(hub_limits, level, count, run_time=10.0, failures=0):
+    for n in range(count):
+        hub_limits.record(HUB, level, run_time, n >= failures)
+
+
+def test_hub_of():
+    assert hub_of('1-1.4.2:1.0') == '1-1.4'
+    assert hub_of('1-3:1.0') == '1-root'
+    assert hub_of(None) is None
+    assert hub_of('platform') is None
+
+
+def test_initial_limit_without_outcomes():
+    assert limits().limit(HUB) == 4
+    assert limits(initial=3).limit(HUB) == 3
+    assert limits(initial=6, maximum=5).limit(HUB) == 5
+
+
+def test_too_few_samples_keep_the_initial_limit():
+    hub_limits = limits()
+    record(hub_limits, 4, MIN_SAMPLES - 1)
+    assert hub_limits.limit(HUB) == 4
+
+
+def test_clean_level_explores_one_more_then_one_fewer():
+    hub_limits = limits()
+    record(hub_limits, 4, MIN_SAMPLES)
+    assert hub_limits.limit(HUB) == 5
+    # One more board was not worth it: the jobs got much slower
+    record(hub_limits, 5, MIN_SAMPLES, run_time=20.0)
+    assert hub_limits.limit(HUB) == 3
+    record(hub_limits, 3, MIN_SAMPLES, run_time=10.0)
+    assert hub_limits.limit(HUB) == 4
+
+
+def test_failing_best_level_backs_off():
+    hub_limits = limits()
+    failures = int(MIN_SAMPLES * MAX_ERROR_RATE) + 2
+    record(hub_limits, 4, MIN_SAMPLES + 2, run_time=1.0, failures=failures)
+    assert hub_limits.limit(HUB) == 3
+    record(hub_limits, 2, MIN_SAMPLES, run_time=10.0)
+    assert hub_limits.limit(HUB) == 2
+
+
+def test_configured_maximum_caps_the_limit():
+    hub_limits = limits()
+    hub_limits.configure(HUB, maximum=4)
+    record(hub_limits, 4, MIN_SAMPLES)
+    assert hub_limits.limit(HUB) == 3  # 5 is out of reach, so it tries one fewer
+    hub_limits.configure(HUB, maximum=2)
+    assert hub_limits.limit(HUB) == 2
+
+
+def test_baud_budget():
+    class Job:
+        def __init__(self, baud):
+            self.baud = baud
+
+    class Queued:
+        def __init__(self, baud):
+            self.job = Job(baud)
+
+    hub_limits = limits(baud_budget=2000000)
+    assert hub_limits.admits(HUB, [], Job(3000000))
+    assert hub_limits.admits(HUB, [Queued(921600)], Job(921600))
+    assert not hub_limits.admits(HUB, [Queued(921600), Queued(921600)], Job(921600))
@@ -0,0 +1,140 @@
+import threading
+
+from job_queue import CANCELLED, DONE, PENDING, RUNNING, JobScheduler
+
+WAIT = 5.0
+
+
+class FakeJob:
+    """Runs until released, and records the order jobs started in."""
+
+    def __init__(self, port, started=None, release=None):
+        self.port = port
+        self.started = started if started is not None else []
+        self.release = release or threading.Event()
+        self.running = threading.Event()
+
+    def run(self):
+        self.started.append(self)
+        self.running.set()
+        if not self.release.wait(WAIT):
+            raise TimeoutError("never released")
+
+
+class CancellableJob(FakeJob):
+    def __init__(self, port):
+        super().__init__(port)
+        self._cancel = threading.Event()
+
+    def cancel(self):
+        self._cancel.set()
+        self.release.set()
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def run(self):
+        super().run()
+        if self.cancelled:
+            raise RuntimeError("cancelled")
+
+
+class StubbornJob(FakeJob):
+    """Ignores cancel() and abort() until released."""
+
+    def cancel(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+def test_priority_then_fifo():
+    scheduler = JobScheduler(max_concurrent=1, log=lambda *a: None)
+    started = []
+    blocker = FakeJob('A', started)
+    scheduler.submit(blocker)
+    assert blocker.running.wait(WAIT)
+    release = threading.Event()
+    low = FakeJob('B', started, release)
+    first = FakeJob('C', started, release)
+    second = FakeJob('D', started, release)
+    scheduler.submit(low, priority=0)
+    scheduler.submit(first, priority=5)
+    scheduler.submit(second, priority=5)
+    release.set()
+    blocker.release.set()
+    assert scheduler.wait(WAIT)
+    assert started == [blocker, first, second, low]
+
+
+def test_one_job_per_port():
+    scheduler = JobScheduler(max_concurrent=4, log=lambda *a: None)
+    a1, a2, b1 = FakeJob('A'), FakeJob('A'), FakeJob('B')
+    q1, q2, q3 = scheduler.submit(a1), scheduler.submit(a2), scheduler.submit(b1)
+    assert a1.running.wait(WAIT) and b1.running.wait(WAIT)
+    assert (q1.state, q2.state, q3.state) == (RUNNING, PENDING, RUNNING)
+    a1.release.set()
+    assert a2.running.wait(WAIT)
+    a2.release.set()
+    b1.release.set()
+    assert scheduler.wait(WAIT)
+    assert {q1.state, q2.state, q3.state} == {DONE}
+
+
+def test_cancel_pending_job():
+    scheduler = JobScheduler(max_concurrent=1, log=lambda *a: None)
+    blocker, waiting = FakeJob('A'), FakeJob('B')
+    scheduler.submit(blocker)
+    queued = scheduler.submit(waiting)
+    assert scheduler.cancel(queued.id)
+    assert queued.state == CANCELLED
+    blocker.release.set()
+    assert scheduler.wait(WAIT)
+    assert not waiting.running.is_set()
+    assert scheduler.get(queued.id) is queued
+
+
+def test_cancel_running_job():
+    scheduler = JobScheduler(max_concurrent=1, log=lambda *a: None)
+    job = CancellableJob('A')
+    queued = scheduler.submit(job)
+    assert job.running.wait(WAIT)
+    assert scheduler.cancel(queued.id)
+    assert scheduler.wait(WAIT)
+    assert queued.state == CANCELLED
+
+
+def test_running_job_without_cancel_cannot_be_cancelled():
+    scheduler = JobScheduler(max_concurrent=1, log=lambda *a: None)
+    job = FakeJob('A')
+    queued = scheduler.submit(job)
+    assert job.running.wait(WAIT)
+    assert not scheduler.cancel(queued.id)
+    assert queued.state == RUNNING
+    job.release.set()
+    assert scheduler.wait(WAIT)
+    assert queued.state == DONE
+
+
+def test_shutdown_times_out_on_a_stuck_job():
+    scheduler = JobScheduler(max_concurrent=1, log=lambda *a: None)
+    stuck, waiting = StubbornJob('A'), FakeJob('B')
+    stuck_queued = scheduler.submit(stuck)
+    waiting_queued = scheduler.submit(waiting)
+    assert stuck.running.wait(WAIT)
+    assert not scheduler.shutdown(timeout=0.2)
+    assert waiting_queued.state == CANCELLED
+    assert stuck_queued.state == RUNNING
+    stuck.release.set()
+    assert scheduler.wait(WAIT)
+
+
+def test_shutdown_stops_cancellable_jobs():
+    scheduler = JobScheduler(max_concurrent=2, log=lambda *a: None)
+    jobs = [CancellableJob('A'), CancellableJob('B')]
+    queued = [scheduler.submit(job) for job in jobs]
+    assert all(job.running.wait(WAIT) for job in jobs)
+    assert scheduler.shutdown(timeout=WAIT)
+    assert {q.state for q in queued} == {CANCELLED}
@@ -0,0 +1,138 @@
+import os
+import struct
+import threading
+
+import pytest
+from esptool.util import FatalError
+
+import flash_engine
+from fake_stub import FakeStub, image, region
+from personalization import PersonalizationFactory, build_image, nvs_partition
+
+MAC = 'aa:bb:cc:dd:ee:ff'
+TEMPLATE = [('device', 'namespace', ''), ('serial', 'data', 'string')]
+NVS_OFFSET, NVS_SIZE = 0xd000, 0x6000  # Not where the default tables put it, nor as large
+APP, DATA = 0x00, 0x01
+NVS, NVS_KEYS, PHY, FACTORY = 0x02, 0x04, 0x01, 0x00
+
+
+def partition_table(*entries):
+    """A binary partition table of (label, type, subtype, offset, size) entries, MD5 entry left out."""
+    table = b''.join(
+        struct.pack('<2sBBII16sI', b'\xaa\x50', kind, subtype, offset, size, label.encode(), 0)
+        for label, kind, subtype, offset, size in entries
+    )
+    return table + b'\xff' * (0xc00 - len(table))
+
+
+TABLE = partition_table(
+    ('appdata', DATA, NVS, 0x9000, 0x4000),
+    ('nvs', DATA, NVS, NVS_OFFSET, NVS_SIZE),
+    ('nvs_keys', DATA, NVS_KEYS, 0x13000, 0x1000),
+    ('phy_init', DATA, PHY, 0x14000, 0x1000),
+    ('factory', APP, FACTORY, 0x20000, 0x100000),
+)
+
+
+@pytest.fixture
+def factory(tmp_path):
+    """A factory that builds nothing by itself; tests put images in ready/."""
+    (tmp_path / 'template.csv').write_text('key,type,encoding\ndevice,namespace,\nserial,data,string\n')
+    (tmp_path / 'identities.csv').write_text('serial\nSN-1\nSN-2\nSN-3\n')
+    factory = PersonalizationFactory.from_directory(str(tmp_path), size=NVS_SIZE, ahead=0, log=lambda *a: None)
+    yield factory
+    factory.shutdown()
+
+
+def make_ready(factory, *serials, build=False):
+    """Images in ready/, built by the NVS generator or as placeholders."""
+    for serial in serials:
+        with open(os.path.join(factory.ready_dir, serial + '.bin'), 'wb') as f:
+            if build:
+                f.write(build_image(TEMPLATE, {'serial': serial}, factory.size, ''))
+            else:
+                f.write(serial.encode().ljust(factory.size, b'\xff'))
+
+
+def listing(factory):
+    directories = (factory.ready_dir, factory.claimed_dir, factory.used_dir)
+    return {os.path.basename(d): sorted(os.listdir(d)) for d in directories}
+
+
+def test_nvs_partition_is_found_by_label():
+    assert nvs_partition(TABLE) == (NVS_OFFSET, NVS_SIZE)
+    assert nvs_partition(partition_table(('appdata', DATA, NVS, 0x9000, 0x4000))) == (0x9000, 0x4000)
+    assert nvs_partition(partition_table(('factory', APP, FACTORY, 0x10000, 0x100000))) is None
+
+
+def test_placement_follows_the_table(factory):
+    assert factory.placement(TABLE) == NVS_OFFSET
+    with pytest.raises(FatalError, match='needs a partition table'):
+        factory.placement(None)
+    with pytest.raises(FatalError, match='no nvs partition'):
+        factory.placement(partition_table(('factory', APP, FACTORY, 0x10000, 0x100000)))
+    with pytest.raises(FatalError, match='is 0x5000 bytes'):
+        factory.placement(partition_table(('nvs', DATA, NVS, 0x9000, 0x5000)))
+
+
+def test_claim_and_commit_move_the_image(factory):
+    make_ready(factory, 'SN-1', 'SN-2')
+
+    first = factory.claim(MAC, TABLE)
+    assert first.address == NVS_OFFSET
+    assert listing(factory) == {'ready': ['SN-2.bin'], 'claimed': ['aabbccddeeff_SN-1.bin'], 'used': []}
+    # Until the board verified, it gets the identity it claimed
+    assert factory.claim(MAC, TABLE).path == first.path
+
+    factory.commit(MAC)
+    assert listing(factory) == {'ready': ['SN-2.bin'], 'claimed': [], 'used': ['aabbccddeeff_SN-1.bin']}
+    # A board that comes back keeps its identity
+    again = factory.claim(MAC, TABLE)
+    assert os.path.basename(again.path) == 'aabbccddeeff_SN-1.bin'
+    assert listing(factory)['ready'] == ['SN-2.bin']
+    assert factory._taken() == {'SN-1', 'SN-2'}
+
+    factory.claim('11:22:33:44:55:66', TABLE)
+    with pytest.raises(FatalError, match='No personalization image is ready'):
+        factory.claim('11:22:33:44:55:77', TABLE)
+
+
+def test_concurrent_claims_get_different_identities(factory):
+    make_ready(factory, 'SN-1', 'SN-2', 'SN-3')
+    macs = [f'aa:bb:cc:dd:ee:{n:02x}' for n in range(3)]
+    claimed = {}
+    start = threading.Barrier(len(macs))
+
+    def claim(mac):
+        start.wait()
+        claimed[mac] = os.path.basename(factory.claim(mac, TABLE).path).split('_', 1)[1]
+
+    threads = [threading.Thread(target=claim, args=(mac,)) for mac in macs]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(claimed.values()) == ['SN-1.bin', 'SN-2.bin', 'SN-3.bin']
+    assert listing(factory)['ready'] == []
+
+
+def test_flash_job_writes_the_image_to_the_tables_nvs(factory, monkeypatch):
+    pytest.importorskip('esp_idf_nvs_partition_gen')
+    esp = FakeStub()
+    monkeypatch.setattr(flash_engine, 'connect_esp', lambda port, chip, initial_baud, before: esp)
+    monkeypatch.setattr(flash_engine, 'run_stub', lambda loader: loader)
+    monkeypatch.setattr(flash_engine, 'attach_flash', lambda loader: None)
+    monkeypatch.setattr(flash_engine, 'detect_flash_size', lambda loader: '4MB')
+    monkeypatch.setattr(flash_engine, 'reset_chip', lambda loader, mode: None)
+    make_ready(factory, 'SN-1', build=True)
+    with open(os.path.join(factory.ready_dir, 'SN-1.bin'), 'rb') as f:
+        nvs = f.read()
+    app = image(0x20000, 1)
+    regions = [region(0x8000, TABLE, 'partitions.bin'), region(0x20000, app, 'app.bin')]
+
+    job = flash_engine.FlashJob('/dev/ttyFAKE0', regions, personalization=factory, log=lambda *a: None)
+    job.run()
+
+    assert esp.flash[NVS_OFFSET:NVS_OFFSET + NVS_SIZE] == nvs
+    assert esp.flash[0x20000:0x40000] == app
+    assert listing(factory) == {'ready': [], 'claimed': [], 'used': ['aabbccddeeff_SN-1.bin']}
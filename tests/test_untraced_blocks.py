@@ -0,0 +1,105 @@
+"""
+send_blocks_untraced() against an esptool loader on a scripted serial port.
+"""
+import struct
+
+import pytest
+from esptool.loader import slip_reader
+from esptool.targets import ESP32ROM
+from esptool.util import UnsupportedCommandError
+
+import flash_engine
+
+FLASH_DEFL_DATA = ESP32ROM.ESP_CMDS['FLASH_DEFL_DATA']
+READ_REG = ESP32ROM.ESP_CMDS['READ_REG']
+
+
+class ScriptedPort:
+    """Serial port whose input is set up front; what is written is kept."""
+
+    def __init__(self, *packets):
+        self.input = bytearray(b''.join(slip(packet) for packet in packets))
+        self.written = []
+        self.timeout = 3
+        self.flushed = 0
+
+    def write(self, data):
+        self.written.append(bytes(data))
+
+    def inWaiting(self):
+        return len(self.input)
+
+    def read(self, size=1):
+        data = bytes(self.input[:size])
+        del self.input[:size]
+        return data
+
+    def flushInput(self):
+        self.flushed += 1
+        self.input.clear()
+
+
+def slip(packet):
+    return b'\xc0' + packet.replace(b'\xdb', b'\xdb\xdd').replace(b'\xc0', b'\xdb\xdc') + b'\xc0'
+
+
+def response(op, val=0, body=b'\x00\x00'):
+    return struct.pack('<BBHI', 1, op, len(body), val) + body
+
+
+def loader(port):
+    esp = ESP32ROM.__new__(ESP32ROM)
+    esp._port = port
+    esp._trace_enabled = False
+    esp.secure_download_mode = False
+    esp._slip_reader = slip_reader(port, esp.trace)
+    return esp
+
+
+def test_block_is_acked_without_esptool_command(monkeypatch):
+    port = ScriptedPort(response(FLASH_DEFL_DATA, val=7))
+    esp = loader(port)
+    assert flash_engine.send_blocks_untraced(esp)
+    monkeypatch.setattr(ESP32ROM, 'command', None)  # Would fail if the data block went through it
+    assert esp.command(FLASH_DEFL_DATA, b'\xc0data', 0xef) == (7, b'\x00\x00')
+    assert port.written == [slip(struct.pack('<BBHI', 0, FLASH_DEFL_DATA, 5, 0xef) + b'\xc0data')]
+    assert port.timeout == 3
+
+
+def test_responses_to_other_commands_are_skipped():
+    port = ScriptedPort(response(READ_REG, val=1), b'\x01', response(FLASH_DEFL_DATA, val=2))
+    esp = loader(port)
+    flash_engine.send_blocks_untraced(esp)
+    assert esp.command(FLASH_DEFL_DATA, b'data') == (2, b'\x00\x00')
+
+
+def test_invalid_command_reply_raises_and_drains(monkeypatch):
+    monkeypatch.setattr(flash_engine.time, 'sleep', lambda seconds: None)
+    complaint = response(0, body=bytes([1, ESP32ROM.ROM_INVALID_RECV_MSG]))
+    port = ScriptedPort(complaint, complaint, complaint)
+    esp = loader(port)
+    flash_engine.send_blocks_untraced(esp)
+    with pytest.raises(UnsupportedCommandError):
+        esp.command(FLASH_DEFL_DATA, b'data')
+    assert port.input == b'' and port.flushed == 1
+    assert port.timeout == 3
+
+
+def test_other_commands_go_through_esptool(monkeypatch):
+    esp = loader(ScriptedPort())
+    calls = []
+    monkeypatch.setattr(ESP32ROM, 'command', lambda self, op=None, data=b'', chk=0, wait_response=True, timeout=3:
+                        calls.append(op) or (0, b''))
+    flash_engine.send_blocks_untraced(esp)
+    esp.command(READ_REG, b'')
+    assert calls == [READ_REG]
+
+
+def test_different_esptool_command_is_kept(monkeypatch):
+    def command(self, op=None, data=b'', chk=0, wait_response=True, timeout=3, retries=5):
+        return 0, b''
+
+    monkeypatch.setattr(ESP32ROM, 'command', command)
+    esp = loader(ScriptedPort())
+    assert not flash_engine.send_blocks_untraced(esp)
+    assert 'command' not in vars(esp)